@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+import numpy as np
+import soap
+import time
+log = soap.log
+
+def evaluate_soap(configs, options):
+    dset = soap.DMapMatrixSet()
+    for cidx, config in enumerate(configs):
+        spectrum = soap.soapy.PowerSpectrum(
+            config=config, 
+            options=options,
+            label="config-%d" % cidx)
+        dset.append(spectrum.exportDMapMatrix())
+    return dset
+
+def evaluate_kernel(dset, kernel_options):
+    kernel = soap.Kernel(kernel_options)
+    t0 = time.time()
+    kernel.evaluateAll(dset, dset, True)
+    t1 = time.time()
+    K = []
+    for slot in range(kernel.n_output):
+        Ks = kernel.getOutput(slot, "float64")
+        Ks = Ks + Ks.T - np.diag(Ks.diagonal())
+        z = 1./np.sqrt(Ks.diagonal())
+        K.append(Ks*np.outer(z,z))
+    return K, t1-t0, kernel.getBasekernelInfo()
+
+if __name__ == "__main__":
+    configs = soap.tools.io.read('data/structures.xyz')
+    options = soap.soapy.configure_default()
+    dset = evaluate_soap(configs, options)
+
+    kernel_options = soap.Options()
+    kernel_options.set("basekernel_type", "dot")
+    kernel_options.set("base_exponent", 2.)
+    kernel_options.set("base_filter", False)
+    kernel_options.set("base_seed", 7)
+    kernel_options.set("base_error_samples", 500)
+    kernel_options.set("base_error_tol", 0.05)
+    kernel_options.set("topkernel_type", "average;rematch")
+    kernel_options.set("rematch_gamma", 0.05)
+    kernel_options.set("rematch_eps", 1e-6)
+    kernel_options.set("rematch_omega", 1.0)
+
+    # Exact reference
+    K_exact, t_exact, _ = evaluate_kernel(dset, kernel_options)
+    log << "%-14s %5s %10s %12s %12s %12s" % (
+        "basekernel", "dim", "time [s]", "base rms", "avg max|dK|", "rem max|dK|") << log.endl
+    log << "%-14s %5s %10.3f %12s %12s %12s" % ("dot", "-", t_exact, "-", "-", "-") << log.endl
+
+    # Approximate base kernels
+    for basekernel in [ "dot-maclaurin", "dot-nystrom" ]:
+        for dim in [ 64, 256, 1024 ]:
+            kernel_options.set("basekernel_type", basekernel)
+            kernel_options.set("base_dim", dim)
+            K, t, info = evaluate_kernel(dset, kernel_options)
+            dK = [ np.max(np.abs(K[s]-K_exact[s])) for s in range(len(K)) ]
+            log << "%-14s %5d %10.3f %12.2e %12.2e %12.2e" % (
+                basekernel, info["dim"], t, info["error_rms"], dK[0], dK[1]) << log.endl
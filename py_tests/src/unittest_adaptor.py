@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+import soap
+import soap.tools
+
+import os
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.kernel import KernelAdaptorFTD, KernelAdaptorSpecificUnique
+from soap.soapy.kernel import KernelAdaptorSpecific, KernelAdaptorGlobalSpecific
+from soap.soapy.kernel import KernelAdaptorGeneric, KernelAdaptorGlobalGeneric
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s', 
+    datefmt='%I:%M:%S', 
+    level=logging.ERROR)
+
+class TestAdaptor(unittest.TestCase):
+    def setUp(self):
+        self.setUp_Options()
+        self.setUp_Spectrum()
+    def setUp_Options(self):
+        options = soap.Options()
+        options.excludeCenters([])
+        options.excludeTargets([])
+        options.excludeCenterIds([])
+        options.excludeTargetIds([])
+        options.set('radialbasis.type', 'gaussian')
+        options.set('radialbasis.mode', 'adaptive')
+        options.set('radialbasis.N', 5)
+        options.set('radialbasis.sigma', 0.5)
+        options.set('radialbasis.integration_steps', 15)
+        options.set('radialcutoff.Rc', 4.)
+        options.set('radialcutoff.Rc_width', 0.5)
+        options.set('radialcutoff.type', 'heaviside')
+        options.set('radialcutoff.center_weight', 0.5)
+        options.set('angularbasis.type', 'spherical-harmonic')
+        options.set('angularbasis.L', 3)
+        options.set('densitygrid.N', 20)
+        options.set('densitygrid.dx', 0.15)
+        options.set('spectrum.gradients', False)
+        options.set('spectrum.2l1_norm', False)
+        options.set('spectrum.2d', False)
+        # STORE
+        self.options = options
+        # 'O' is absent from the structure => zero blocks in the layouts
+        self.types = ['C', 'H', 'O']
+        return
+    def setUp_Spectrum(self):
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        xyzfile = os.path.join(data_root, 'config_simple_CH.xyz')
+        config = soap.tools.ase_load_single(xyzfile)
+        structure = soap.tools.setup_structure_ase(config.config_file, config.atoms)
+        basis = soap.Basis(self.options)
+        spectrum = soap.Spectrum(structure, self.options, basis)
+        spectrum.compute()
+        spectrum.computePower()
+        spectrum.computeGlobal()
+        # STORE
+        self.structure = structure
+        self.basis = basis
+        self.spectrum = spectrum
+        return
+    def assertAdaptorEquivalent(self, adaptor, atomics):
+        # Native Spectrum::adapt vs. per-centre Python adaptScalar
+        IX = adaptor.adapt(self.spectrum)
+        IX_ref = np.array([ adaptor.adaptScalar(atomic)[1] for atomic in atomics ])
+        self.assertEqual(IX.dtype, np.dtype('float64'))
+        self.assertEqual(IX.shape, IX_ref.shape)
+        self.assertTrue(np.allclose(IX, IX_ref, rtol=1e-10, atol=1e-12))
+        return
+
+class TestAdaptorLayouts(TestAdaptor):
+    def test_Full(self):
+        adaptor = KernelAdaptorFTD(self.options, self.types)
+        self.assertAdaptorEquivalent(adaptor, list(self.spectrum))
+    def test_Unique(self):
+        adaptor = KernelAdaptorSpecificUnique(self.options, self.types)
+        self.assertAdaptorEquivalent(adaptor, list(self.spectrum))
+    def test_Specific(self):
+        adaptor = KernelAdaptorSpecific(self.options, self.types)
+        self.assertAdaptorEquivalent(adaptor, list(self.spectrum))
+    def test_GlobalSpecific(self):
+        adaptor = KernelAdaptorGlobalSpecific(self.options, self.types)
+        self.assertAdaptorEquivalent(adaptor, [ self.spectrum.getGlobal() ])
+    def test_Dimension(self):
+        N = self.basis.N
+        L = self.basis.L
+        S = len(self.types)
+        self.assertEqual(self.spectrum.adaptDimension(self.types, "full"), S*S*N*N*(L+1))
+        self.assertEqual(self.spectrum.adaptDimension(self.types, "unique"), 
+            S*(N*N+N)/2*(L+1) + (S*S-S)/2*N*N*(L+1))
+        self.assertEqual(self.spectrum.adaptDimension(self.types, "specific"), 
+            (S*S+S)/2*N*N*(L+1))
+        self.assertEqual(self.spectrum.adaptDimension(self.types, "generic"), N*N*(L+1))
+        self.assertRaises(RuntimeError, self.spectrum.adaptDimension, self.types, "none")
+    def test_Generic(self):
+        # The generic (type-agnostic) power spectrum is not computed by 
+        # computePower: native adapt must fail cleanly rather than crash
+        for adaptor in [ KernelAdaptorGeneric(self.options), KernelAdaptorGlobalGeneric(self.options) ]:
+            self.assertRaises(RuntimeError, adaptor.adapt, self.spectrum)
+
+if __name__ == "__main__":
+    unittest.main()
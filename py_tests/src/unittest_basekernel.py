@@ -0,0 +1,99 @@
+#! /usr/bin/env python
+import soap
+
+import os
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+def symmetrize(K):
+    return K + K.T - np.diag(K.diagonal())
+
+def normalize(K):
+    z = 1./np.sqrt(K.diagonal())
+    return K*np.outer(z,z)
+
+class TestBaseKernel(unittest.TestCase):
+    def setUp(self):
+        # Three structures with 2, 3 and 1 atoms (see unittest_dmap_archive)
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.dset = soap.DMapMatrixSet()
+        self.dset.load(os.path.join(data_root, 'dmapset_v0.arch'))
+        self.n_atoms = sum([ len(self.dset[s]) for s in range(len(self.dset)) ])
+    def setUp_Kernel(self, basekernel, topkernel="average", **kwargs):
+        options = soap.Options()
+        options.set('basekernel_type', basekernel)
+        options.set('base_exponent', 2.)
+        options.set('base_filter', False)
+        options.set('base_seed', 7)
+        options.set('topkernel_type', topkernel)
+        options.set('rematch_gamma', 0.1)
+        options.set('rematch_eps', 1e-10)
+        options.set('rematch_omega', 1.0)
+        for key, value in kwargs.items():
+            options.set(key, value)
+        return soap.Kernel(options)
+    def evaluate(self, basekernel, topkernel="average", **kwargs):
+        kernel = self.setUp_Kernel(basekernel, topkernel, **kwargs)
+        K = symmetrize(kernel.evaluate(self.dset, self.dset, True, "float64"))
+        return K, kernel.getBasekernelInfo()
+
+class TestBaseKernelEmbedded(TestBaseKernel):
+    def test_Maclaurin(self):
+        # Random features: error ~ D^(-1/2)
+        for topkernel in [ "average", "rematch" ]:
+            K_exact, info = self.evaluate("dot", topkernel)
+            K, info = self.evaluate("dot-maclaurin", topkernel, base_dim=8192)
+            self.assertEqual(info["dim"], 8192)
+            self.assertLess(np.max(np.abs(normalize(K) - normalize(K_exact))), 0.05)
+            self.assertLess(np.max(np.abs(K - K_exact)/np.max(np.abs(K_exact))), 0.1)
+    def test_Nystrom(self):
+        # With every atom as landmark, the projection is exact up to the jitter
+        for topkernel in [ "average", "rematch" ]:
+            K_exact, info = self.evaluate("dot", topkernel)
+            K, info = self.evaluate("dot-nystrom", topkernel, base_dim=64)
+            self.assertEqual(info["dim"], self.n_atoms)
+            self.assertTrue(np.allclose(K, K_exact, rtol=1e-5, atol=1e-8))
+    def test_ErrorEstimate(self):
+        # Opt-in: no sampled error estimate by default
+        K, info = self.evaluate("dot-maclaurin", base_dim=8192)
+        self.assertEqual(info["error_rms"], -1.)
+        K, info = self.evaluate("dot-maclaurin", base_dim=8192, base_error_samples=200)
+        self.assertGreaterEqual(info["error_rms"], 0.)
+        self.assertLess(info["error_rms"], 0.1)
+        K, info = self.evaluate("dot-nystrom", base_dim=64, base_error_samples=200)
+        self.assertLess(info["error_rms"], 1e-5)
+    def test_Threads(self):
+        for basekernel in [ "dot-maclaurin", "dot-nystrom" ]:
+            K_1, info = self.evaluate(basekernel, base_dim=256, n_threads=1)
+            K_2, info = self.evaluate(basekernel, base_dim=256, n_threads=2)
+            self.assertTrue(np.allclose(K_1, K_2, rtol=1e-12, atol=0.))
+
+class TestBaseKernelClosedForm(TestBaseKernel):
+    def test_ClosedForm(self):
+        # Opt-in, and identical to the tiled evaluation where it applies; 
+        # other configurations (here the dot kernel with exponent 2) fall back
+        for basekernel, exponent in [ ("dot", 1.), ("dot", 2.), ("dot-maclaurin", 2.), ("dot-nystrom", 2.) ]:
+            for normalize in [ False, True ]:
+                for symmetric in [ True, False ]:
+                    K = {}
+                    for closed_form in [ False, True ]:
+                        kernel = self.setUp_Kernel(basekernel, base_exponent=exponent, 
+                            base_dim=64, normalize=normalize, closed_form=closed_form)
+                        K[closed_form] = kernel.evaluate(self.dset, self.dset, symmetric, "float64")
+                    self.assertTrue(np.allclose(K[True], K[False], rtol=1e-10, atol=1e-12))
+        K_default = self.setUp_Kernel("dot", base_exponent=1.).evaluate(
+            self.dset, self.dset, True, "float64")
+        K_tiled = self.setUp_Kernel("dot", base_exponent=1., closed_form=False).evaluate(
+            self.dset, self.dset, True, "float64")
+        self.assertTrue(np.array_equal(K_default, K_tiled))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+import soap
+import soap.tools
+import soap.external
+
+import os
+import numpy as np
+import logging
+import unittest
+
+from soap.external import select_centres
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+class TestCentres(unittest.TestCase):
+    def setUp(self):
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        xyzfile = os.path.join(data_root, 'config_simple_CH.xyz')
+        # Atoms C, H, C, H
+        self.config = soap.tools.io.read(xyzfile)[0]
+        self.calculators = [
+            soap.external.GylmCalculator(
+                rcut=4.0, rcut_width=0.5, nmax=5, lmax=3,
+                sigma=0.5, part_sigma=0.5, types=["C", "H"]),
+            soap.external.SoapGtoCalculator(
+                rcut=4.0, nmax=5, lmax=3, sigma=0.5, types=["C", "H"]) ]
+    def assertRowsMatch(self, X, centre_idx, X_all):
+        self.assertEqual(X.shape[0], len(centre_idx))
+        self.assertTrue(np.allclose(X, X_all[centre_idx], rtol=1e-12, atol=1e-14))
+        return
+
+class TestCentresSelect(TestCentres):
+    def test_Order(self):
+        types_map = self.calculators[0].types_map
+        idx = select_centres(self.config, types_map)
+        # Grouped by atomic number: H (Z=1) before C (Z=6)
+        self.assertEqual(list(idx), [ 1, 3, 0, 2 ])
+        idx = select_centres(self.config, types_map, centre_types=["H"])
+        self.assertEqual(list(idx), [ 1, 3 ])
+        idx = select_centres(self.config, types_map, centre_types=[6])
+        self.assertEqual(list(idx), [ 0, 2 ])
+        idx = select_centres(self.config, types_map,
+            centre_types=["C", "H"], centre_mask=[ False, True, True, False ])
+        self.assertEqual(list(idx), [ 1, 2 ])
+    def test_Errors(self):
+        types_map = self.calculators[0].types_map
+        self.assertRaises(ValueError, select_centres, self.config, types_map, centre_types=["X"])
+        self.assertRaises(ValueError, select_centres, self.config, types_map, centre_mask=[ True ])
+
+class TestCentresEvaluate(TestCentres):
+    def test_All(self):
+        # Without a selection, evaluate returns one row per atom, in atom order
+        for calc in self.calculators:
+            X = calc.evaluate(self.config)
+            X_ref = calc.evaluate(self.config, positions=self.config.get_positions())
+            self.assertEqual(X.shape[0], len(self.config))
+            self.assertTrue(np.allclose(X, X_ref, rtol=0., atol=0.))
+    def test_Types(self):
+        for calc in self.calculators:
+            X_all = calc.evaluate(self.config)
+            X, centre_idx = calc.evaluate_centres(self.config, centre_types=["H"])
+            self.assertEqual(list(centre_idx), [ 1, 3 ])
+            self.assertRowsMatch(X, centre_idx, X_all)
+    def test_Mask(self):
+        for calc in self.calculators:
+            X_all = calc.evaluate(self.config)
+            X, centre_idx = calc.evaluate_centres(self.config,
+                centre_mask=[ True, True, False, True ])
+            self.assertEqual(list(centre_idx), [ 1, 3, 0 ])
+            self.assertRowsMatch(X, centre_idx, X_all)
+    def test_NoSelection(self):
+        # evaluate_centres always returns (X, centre_idx)
+        for calc in self.calculators:
+            X_all = calc.evaluate(self.config)
+            X, centre_idx = calc.evaluate_centres(self.config)
+            self.assertEqual(len(centre_idx), len(self.config))
+            self.assertRowsMatch(X, centre_idx, X_all)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+import soap
+
+import os
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+# Channels assigned to the structures of the fixture (2, 3 and 1 rows),
+# such that no two structures share a channel
+CHANNELS = [ ("C", "C"), ("H", "H"), ("O", "O") ]
+
+class TestChannelIndex(unittest.TestCase):
+    def setUp(self):
+        # Three structures with 2, 3 and 1 atoms (see unittest_dmap_archive)
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.dset = soap.DMapMatrixSet()
+        self.dset.load(os.path.join(data_root, 'dmapset_v0.arch'))
+        rng = np.random.RandomState(11)
+        for s in range(len(self.dset)):
+            for r in range(len(self.dset[s])):
+                dmap = self.dset[s][r]
+                dmap.clearChannels()
+                dmap.appendChannel(soap.encoder.encode(*CHANNELS[s]),
+                    rng.uniform(0.1, 1., size=(8,)), "float64")
+    def setUp_Kernel(self, index, topkernel="average"):
+        options = soap.Options()
+        options.set('basekernel_type', 'dot')
+        options.set('base_exponent', 2.)
+        options.set('base_filter', False)
+        options.set('base_index', index)
+        options.set('topkernel_type', topkernel)
+        options.set('rematch_gamma', 0.1)
+        options.set('rematch_eps', 1e-10)
+        options.set('rematch_omega', 1.0)
+        options.set('tile_size', 2)
+        return soap.Kernel(options)
+    def evaluate(self, index, topkernel="average", symmetric=False):
+        return self.setUp_Kernel(index, topkernel).evaluate(
+            self.dset, self.dset, symmetric, "float64")
+    def addShared(self):
+        # The single row of structure 2 now shares a channel with structure 0
+        self.dset[2][0].appendChannel(soap.encoder.encode(*CHANNELS[0]),
+            np.ones((8,)), "float64")
+        self.dset[2][0].sort()
+
+class TestChannelIndexKernel(TestChannelIndex):
+    def test_Disjoint(self):
+        for topkernel in [ "average", "rematch" ]:
+            for symmetric in [ True, False ]:
+                K_ref = self.evaluate(False, topkernel, symmetric)
+                K = self.evaluate(True, topkernel, symmetric)
+                self.assertTrue(np.allclose(K, K_ref, rtol=1e-12, atol=1e-14))
+                self.assertTrue(np.all(np.diag(K) > 0.))
+                self.assertTrue(np.all(K - np.diag(np.diag(K)) == 0.))
+    def test_Modified(self):
+        # The index is rebuilt for every evaluation, hence follows rows
+        # modified in place since the last one
+        kernel = self.setUp_Kernel(True)
+        K = kernel.evaluate(self.dset, self.dset, False, "float64")
+        self.assertEqual(K[0,2], 0.)
+        self.addShared()
+        K = kernel.evaluate(self.dset, self.dset, False, "float64")
+        K_ref = self.evaluate(False)
+        self.assertGreater(K[0,2], 0.)
+        self.assertTrue(np.allclose(K, K_ref, rtol=1e-12, atol=1e-14))
+    def test_StaleIndex(self):
+        # An index built by the caller before an in-place change is not
+        # used by a kernel that does not maintain it
+        self.dset.buildChannelIndex()
+        self.addShared()
+        K = self.evaluate(False)
+        self.assertGreater(K[0,2], 0.)
+        self.assertGreater(K[2,0], 0.)
+
+class TestChannelIndexSet(TestChannelIndex):
+    def test_Overlaps(self):
+        for s in range(len(self.dset)):
+            self.assertEqual(self.dset.getOverlaps(self.dset[s]), [ s ])
+        index = self.dset.getChannelIndex()
+        self.assertEqual(sorted(index.keys()), sorted([ "%s:%s" % c for c in CHANNELS ]))
+        self.assertEqual(index["H:H"], [ (1, 0), (1, 1), (1, 2) ])
+    def test_Invalidate(self):
+        # Operations on the set itself drop the index
+        self.dset.buildChannelIndex()
+        self.assertTrue(self.dset.indexed)
+        self.dset.clearChannelIndex()
+        self.assertFalse(self.dset.indexed)
+        self.dset.buildChannelIndex()
+        self.addShared()
+        self.dset.slice([ 0 ])
+        self.assertFalse(self.dset.indexed)
+        self.assertEqual(self.dset.getOverlaps(self.dset[0]), [ 0, 2 ])
+        self.assertTrue(self.dset.indexed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+import soap
+import soap.tools
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.cache import DescriptorCache
+from soap.soapy.wrap import PowerSpectrum
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+class TestDescriptorCache(unittest.TestCase):
+    def setUp(self):
+        self.setUp_Options()
+        self.setUp_Config()
+        self.tmpdir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def setUp_Options(self):
+        self.options = {
+            "spectrum.2d": False,
+            "spectrum.gradients": False,
+            "spectrum.global": False,
+            "spectrum.2l1_norm": False,
+            "radialbasis.type" : "gaussian",
+            "radialbasis.mode" : "adaptive",
+            "radialbasis.N" : 5,
+            "radialbasis.sigma": 0.5,
+            "radialbasis.integration_steps": 15,
+            "radialcutoff.Rc": 4.,
+            "radialcutoff.Rc_width": 0.5,
+            "radialcutoff.type": "heaviside",
+            "radialcutoff.center_weight": 1.0,
+            "angularbasis.type": "spherical-harmonic",
+            "angularbasis.L": 3,
+            "exclude_centers": [],
+            "exclude_targets": [],
+            "exclude_center_ids": [],
+            "exclude_target_ids": []
+        }
+        return
+    def setUp_Config(self):
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        xyzfile = os.path.join(data_root, 'config_simple_CH.xyz')
+        self.config = soap.tools.io.read(xyzfile)[0]
+        return
+    def createSpectrum(self, cache=None):
+        return PowerSpectrum(config=self.config, options=self.options,
+            label="config_simple_CH", cache=cache)
+    def assertSameDMapMatrix(self, dmap, dmap_ref):
+        K = dmap.dot(dmap_ref, "float64")
+        K_ref = dmap_ref.dot(dmap_ref, "float64")
+        self.assertEqual(K.shape, K_ref.shape)
+        self.assertTrue(np.allclose(K, K_ref, rtol=1e-12, atol=0.))
+        return
+
+class TestDescriptorCacheSpectrum(TestDescriptorCache):
+    def test_MissAndHit(self):
+        dmap_ref = self.createSpectrum().exportDMapMatrix()
+        cache = DescriptorCache()
+        # Miss: the deferred spectrum is computed and its descriptor stored
+        spectrum = self.createSpectrum(cache=cache)
+        self.assertTrue(spectrum.deferred)
+        self.assertSameDMapMatrix(spectrum.exportDMapMatrix(), dmap_ref)
+        self.assertFalse(spectrum.deferred)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(len(cache), 1)
+        # Hit: the descriptor is served without computing the spectrum
+        spectrum = self.createSpectrum(cache=cache)
+        self.assertSameDMapMatrix(spectrum.exportDMapMatrix(), dmap_ref)
+        self.assertTrue(spectrum.deferred)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(len(cache), 1)
+    def test_WriteThrough(self):
+        dmap_ref = self.createSpectrum().exportDMapMatrix()
+        cache = DescriptorCache(path=self.tmpdir)
+        self.createSpectrum(cache=cache).exportDMapMatrix()
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        # A fresh cache on the same directory is served from disk
+        cache = DescriptorCache(path=self.tmpdir)
+        self.assertEqual(len(cache), 0)
+        spectrum = self.createSpectrum(cache=cache)
+        self.assertSameDMapMatrix(spectrum.exportDMapMatrix(), dmap_ref)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 0)
+        self.assertEqual(len(cache), 1)
+    def test_DeferredFields(self):
+        # Reading a computed field completes the deferred computation
+        spectrum_ref = self.createSpectrum()
+        spectrum = self.createSpectrum(cache=DescriptorCache())
+        self.assertTrue(spectrum.deferred)
+        self.assertTrue(spectrum.spectrum is not None)
+        self.assertFalse(spectrum.deferred)
+        self.assertTrue(spectrum.has_pnkl)
+        self.assertEqual(spectrum.structure.n_particles, spectrum_ref.structure.n_particles)
+        self.assertTrue(np.allclose(
+            spectrum.exportDistanceMatrix(), spectrum_ref.exportDistanceMatrix(),
+            rtol=1e-12, atol=1e-14))
+    def test_ClassCache(self):
+        cache = DescriptorCache()
+        PowerSpectrum.cache = cache
+        try:
+            spectrum = PowerSpectrum(config=self.config, options=self.options)
+            self.assertTrue(spectrum.deferred)
+            self.assertTrue(len(list(spectrum.spectrum)) > 0)
+            self.assertFalse(spectrum.deferred)
+        finally:
+            PowerSpectrum.cache = None
+
+if __name__ == "__main__":
+    unittest.main()
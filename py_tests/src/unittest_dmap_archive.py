@@ -0,0 +1,143 @@
+#! /usr/bin/env python
+import soap
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s', 
+    datefmt='%I:%M:%S', 
+    level=logging.ERROR)
+
+# The fixture dmapset_v0.arch was written by DMapMatrixSet.save with the 
+# version-0 DMap layout (vector of (code, ublas vector) channels). It holds 
+# three structures with 2, 3 and 1 rows; row r of structure s carries the 
+# type-pair channels (a,b), a<=b of TYPES, with (a+b+r+s) % 3 != 0, each 
+# of length 8 with the entries returned by expected_channel.
+TYPES = [ "C", "H", "O" ]
+N_ROWS = [ 2, 3, 1 ]
+
+def expected_channel(s, r, a, b):
+    return np.array([ 0.5*(s+1) - 0.1*r + 0.01*(3*a+b) + 0.001*i for i in range(8) ])
+
+class TestDMapArchive(unittest.TestCase):
+    def setUp(self):
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.archfile_v0 = os.path.join(data_root, 'dmapset_v0.arch')
+        self.tmpdir = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def loadVersion0(self):
+        dset = soap.DMapMatrixSet()
+        dset.load(self.archfile_v0)
+        return dset
+    def assertFixture(self, dset):
+        self.assertEqual(len(dset), len(N_ROWS))
+        for s in range(len(N_ROWS)):
+            self.assertEqual(len(dset[s]), N_ROWS[s])
+            for r in range(N_ROWS[s]):
+                dmap = dset[s][r]
+                channels = dmap.listChannels()
+                expected = [ (a,b) for a in range(3) for b in range(a,3) if (a+b+r+s) % 3 != 0 ]
+                self.assertEqual(len(channels), len(expected))
+                for a, b in expected:
+                    c = channels.index("%s:%s" % (TYPES[a], TYPES[b]))
+                    self.assertTrue(np.allclose(dmap.val(c, "float64"), 
+                        expected_channel(s, r, a, b), rtol=0., atol=1e-14))
+        return
+    def assertSameKernel(self, dset1, dset2):
+        for s in range(len(dset1)):
+            K1 = dset1[s].dot(dset1[s], "float64")
+            K2 = dset2[s].dot(dset1[s], "float64")
+            self.assertTrue(np.allclose(K1, K2, rtol=1e-12, atol=0.))
+        return
+
+class TestDMapArchiveVersion0(TestDMapArchive):
+    def test_Load(self):
+        dset = self.loadVersion0()
+        self.assertFalse(dset.mapped)
+        self.assertFixture(dset)
+    def test_RoundTrip(self):
+        # Version-0 archive re-saved with the current layout
+        dset = self.loadVersion0()
+        archfile = os.path.join(self.tmpdir, 'dmapset_v1.arch')
+        dset.save(archfile)
+        dset_v1 = soap.DMapMatrixSet()
+        dset_v1.load(archfile)
+        self.assertFixture(dset_v1)
+        self.assertSameKernel(dset, dset_v1)
+
+    def test_MixedLayouts(self):
+        # Sets read from both layouts coexist and agree row by row
+        dset = self.loadVersion0()
+        archfile = os.path.join(self.tmpdir, 'dmapset_v1.arch')
+        dset.save(archfile)
+        dset_v1 = soap.DMapMatrixSet()
+        dset_v1.load(archfile)
+        dset_v0 = self.loadVersion0()
+        self.assertFixture(dset_v0)
+        self.assertFixture(dset_v1)
+        for s in range(len(N_ROWS)):
+            for t in range(len(N_ROWS)):
+                K_v0 = dset_v0[s].dot(dset_v0[t], "float64")
+                K_mixed = dset_v0[s].dot(dset_v1[t], "float64")
+                self.assertTrue(np.allclose(K_mixed, K_v0, rtol=1e-12, atol=0.))
+            for r in range(N_ROWS[s]):
+                self.assertEqual(dset_v0[s][r].listChannels(), dset_v1[s][r].listChannels())
+                self.assertAlmostEqual(dset_v0[s][r].dot(dset_v1[s][r]),
+                    dset_v0[s][r].dot(dset_v0[s][r]), places=12)
+
+class TestDMapArchiveMapped(TestDMapArchive):
+    def test_RoundTrip(self):
+        dset = self.loadVersion0()
+        archfile = os.path.join(self.tmpdir, 'dmapset_mapped.arch')
+        dset.saveMapped(archfile)
+        dset_mapped = soap.DMapMatrixSet()
+        dset_mapped.loadMapped(archfile)
+        self.assertTrue(dset_mapped.mapped)
+        self.assertFixture(dset_mapped)
+        self.assertSameKernel(dset, dset_mapped)
+    def test_LoadDetectsFormat(self):
+        # load recognizes the flat format by its magic and maps it
+        dset = self.loadVersion0()
+        archfile = os.path.join(self.tmpdir, 'dmapset_mapped.arch')
+        dset.saveMapped(archfile)
+        dset_mapped = soap.DMapMatrixSet(archfile)
+        self.assertTrue(dset_mapped.mapped)
+        self.assertFixture(dset_mapped)
+    def test_ResaveMapped(self):
+        # A mapped set saved again in either format keeps its contents
+        dset = self.loadVersion0()
+        archfile = os.path.join(self.tmpdir, 'dmapset_mapped.arch')
+        dset.saveMapped(archfile)
+        dset_mapped = soap.DMapMatrixSet()
+        dset_mapped.loadMapped(archfile)
+        archfile_2 = os.path.join(self.tmpdir, 'dmapset_mapped_2.arch')
+        dset_mapped.saveMapped(archfile_2)
+        archfile_3 = os.path.join(self.tmpdir, 'dmapset_v1.arch')
+        dset_mapped.save(archfile_3)
+        for archfile_out in [ archfile_2, archfile_3 ]:
+            dset_out = soap.DMapMatrixSet()
+            dset_out.load(archfile_out)
+            self.assertFixture(dset_out)
+    def test_SaveKeepsMapping(self):
+        # Saving reads the mapped channels in place, rows stay mapped
+        dset = self.loadVersion0()
+        archfile = os.path.join(self.tmpdir, 'dmapset_mapped.arch')
+        dset.saveMapped(archfile)
+        dset_mapped = soap.DMapMatrixSet()
+        dset_mapped.loadMapped(archfile)
+        dset_mapped.save(os.path.join(self.tmpdir, 'dmapset_v1.arch'))
+        for s in range(len(dset_mapped)):
+            for r in range(len(dset_mapped[s])):
+                self.assertTrue(dset_mapped[s][r].mapped)
+        self.assertFixture(dset_mapped)
+
+if __name__ == "__main__":
+    unittest.main()
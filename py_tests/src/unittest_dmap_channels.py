@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+import soap
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+class TestDMapChannels(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        self.channels = [ ("C", "C", rng.normal(size=(8,))), ("C", "H", rng.normal(size=(3,))),
+            ("H", "H", rng.normal(size=(8,))), ("C", "O", rng.normal(size=(5,))) ]
+    def setUp_DMap(self, channels):
+        dmap = soap.DMap()
+        for a, b, v in channels:
+            dmap.appendChannel(soap.encoder.encode(a, b), v, "float64")
+        return dmap
+    def assertChannels(self, dmap, channels):
+        self.assertEqual(dmap.listChannels(), [ "%s:%s" % (a, b) for a, b, v in channels ])
+        for c, (a, b, v) in enumerate(channels):
+            self.assertTrue(np.array_equal(dmap.val(c, "float64"), v))
+        return
+
+class TestDMapChannelsAppend(TestDMapChannels):
+    def test_Append(self):
+        # Channels of different lengths, in the order of appending
+        dmap = self.setUp_DMap(self.channels)
+        self.assertChannels(dmap, self.channels)
+    def test_Clear(self):
+        dmap = self.setUp_DMap(self.channels)
+        dmap.clearChannels()
+        self.assertEqual(dmap.listChannels(), [])
+        self.assertEqual(dmap.dot(self.setUp_DMap(self.channels)), 0.)
+        dmap.appendChannel(soap.encoder.encode("H", "H"), self.channels[2][2], "float64")
+        self.assertChannels(dmap, self.channels[2:3])
+    def test_Sort(self):
+        dmap = self.setUp_DMap(self.channels)
+        dmap.sort()
+        codes = [ soap.encoder.encode(a, b) for a, b, v in self.channels ]
+        order = sorted(range(len(codes)), key=lambda c: codes[c])
+        self.assertChannels(dmap, [ self.channels[c] for c in order ])
+
+class TestDMapChannelsDot(TestDMapChannels):
+    def test_Dot(self):
+        # Only shared channels contribute, independently of the order of appending
+        other = [ (a, b, v[::-1]) for a, b, v in self.channels[1:] ]
+        dmap1 = self.setUp_DMap(self.channels)
+        dmap2 = self.setUp_DMap(other[::-1])
+        dmap1.sort()
+        dmap2.sort()
+        k_ref = sum([ np.dot(v, w) for (a, b, v), (c, d, w) in zip(self.channels[1:], other) ])
+        self.assertAlmostEqual(dmap1.dot(dmap2), k_ref, places=12)
+        self.assertAlmostEqual(dmap2.dot(dmap1), k_ref, places=12)
+        k_self = sum([ np.dot(v, v) for a, b, v in self.channels ])
+        self.assertAlmostEqual(dmap1.dot(dmap1), k_self, places=12)
+    def test_Disjoint(self):
+        dmap1 = self.setUp_DMap(self.channels[0:2])
+        dmap2 = self.setUp_DMap(self.channels[2:4])
+        dmap1.sort()
+        dmap2.sort()
+        self.assertEqual(dmap1.dot(dmap2), 0.)
+    def test_Add(self):
+        dmap1 = self.setUp_DMap(self.channels)
+        dmap2 = self.setUp_DMap(self.channels)
+        dmap1.add(dmap2, 2.)
+        self.assertChannels(dmap1, [ (a, b, 3.*v) for a, b, v in self.channels ])
+
+if __name__ == "__main__":
+    unittest.main()
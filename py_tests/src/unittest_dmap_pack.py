@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+import soap
+
+import os
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+class TestDMapPack(unittest.TestCase):
+    def setUp(self):
+        # Three structures with 2, 3 and 1 atoms (see unittest_dmap_archive)
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.archfile = os.path.join(data_root, 'dmapset_v0.arch')
+        self.dset = self.loadSet()
+    def loadSet(self):
+        dset = soap.DMapMatrixSet()
+        dset.load(self.archfile)
+        return dset
+    def setUp_Kernel(self, pack):
+        options = soap.Options()
+        options.set('basekernel_type', 'dot')
+        options.set('base_exponent', 2.)
+        options.set('base_filter', False)
+        options.set('base_pack', pack)
+        options.set('topkernel_type', 'average')
+        return soap.Kernel(options)
+
+class TestDMapPackDot(TestDMapPack):
+    def test_Dot(self):
+        dset_packed = self.loadSet()
+        dset_packed.pack()
+        for i in range(len(self.dset)):
+            self.assertTrue(dset_packed[i].packed)
+            self.assertFalse(self.dset[i].packed)
+            for j in range(len(self.dset)):
+                K = self.dset[i].dot(self.dset[j], "float64")
+                K_packed = dset_packed[i].dot(dset_packed[j], "float64")
+                self.assertEqual(K_packed.shape, K.shape)
+                self.assertTrue(np.allclose(K_packed, K, rtol=1e-12, atol=1e-14))
+    def test_Unpack(self):
+        dmap = self.dset[0]
+        K = dmap.dot(dmap, "float64")
+        dmap.pack()
+        self.assertTrue(dmap.packed)
+        dmap.unpack()
+        self.assertFalse(dmap.packed)
+        self.assertTrue(np.allclose(dmap.dot(dmap, "float64"), K, rtol=1e-12, atol=1e-14))
+
+class TestDMapPackKernel(TestDMapPack):
+    def test_Kernel(self):
+        K = self.setUp_Kernel(False).evaluate(self.dset, self.dset, True, "float64")
+        K_packed = self.setUp_Kernel(True).evaluate(self.dset, self.dset, True, "float64")
+        self.assertTrue(np.allclose(K_packed, K, rtol=1e-12, atol=1e-14))
+    def test_Release(self):
+        # Blocks packed for an evaluation are dropped once it completes
+        self.setUp_Kernel(True).evaluate(self.dset, self.dset, True, "float64")
+        for i in range(len(self.dset)):
+            self.assertFalse(self.dset[i].packed)
+    def test_KeepCallerPacked(self):
+        # ... while sets packed by the caller stay packed
+        self.dset.pack()
+        self.setUp_Kernel(True).evaluate(self.dset, self.dset, True, "float64")
+        for i in range(len(self.dset)):
+            self.assertTrue(self.dset[i].packed)
+
+if __name__ == "__main__":
+    unittest.main()
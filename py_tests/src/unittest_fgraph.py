@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.npfga
+
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+class TestFGraph(unittest.TestCase):
+    def setUp(self):
+        # Positive, non-zero roots such that every operator is defined
+        self.features_with_props = [
+            [ "x", "+", "-0", 1.0, "m" ],
+            [ "y", "+", "-0", 2.0, "s" ],
+            [ "z", "+", "-0", 0.5, "kg" ] ]
+        rng = np.random.RandomState(5)
+        # Row count not a multiple of the block size
+        self.X = rng.uniform(0.5, 2.0, size=(203, len(self.features_with_props)))
+    def setUp_Graph(self, **kwargs):
+        fgraph_options = soap.Options()
+        fgraph_options.set("unit_min_exp", 0.5)
+        fgraph_options.set("unit_max_exp", 3.0)
+        fgraph_options.set("correlation_measure", "moment")
+        fgraph_options.set("apply_block_size", 16)
+        for key, value in kwargs.items():
+            fgraph_options.set(key, value)
+        fgraph = soap.FGraph(fgraph_options)
+        for f in self.features_with_props:
+            fgraph.addRootNode(str(f[0]), str(f[1]), str(f[2]), f[3], str(f[4]))
+        fgraph.addLayer("el|sr2", "+-:*")
+        fgraph.addLayer("", "*:")
+        fgraph.generate()
+        # Keep the options alive with the graph
+        return fgraph, fgraph_options
+
+class TestFGraphApply(TestFGraph):
+    def test_Columnwise(self):
+        for n_threads in [ 1, 2, 0 ]:
+            fgraph, fgraph_options = self.setUp_Graph(apply_threads=n_threads)
+            self.assertTrue(len(fgraph) > len(self.features_with_props))
+            X_out = fgraph.apply(self.X, "float64")
+            X_ref = fgraph.applyRowwise(self.X, "float64")
+            self.assertEqual(X_out.shape, (self.X.shape[0], len(fgraph)))
+            self.assertTrue(np.allclose(X_out, X_ref, rtol=1e-12, atol=0.))
+    def test_Threads(self):
+        # Blocks are independent: the output does not depend on the thread count
+        fgraph, fgraph_options = self.setUp_Graph(apply_threads=1)
+        X_1 = fgraph.apply(self.X, "float64")
+        fgraph, fgraph_options = self.setUp_Graph(apply_threads=4)
+        X_4 = fgraph.apply(self.X, "float64")
+        self.assertTrue(np.array_equal(X_1, X_4))
+    def test_Rowwise(self):
+        # Fallback path
+        fgraph, fgraph_options = self.setUp_Graph(apply_columnwise=False, apply_threads=2)
+        X_out = fgraph.apply(self.X, "float64")
+        X_ref = fgraph.applyRowwise(self.X, "float64")
+        self.assertTrue(np.array_equal(X_out, X_ref))
+
+if __name__ == "__main__":
+    unittest.main()
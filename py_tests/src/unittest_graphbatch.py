@@ -0,0 +1,132 @@
+#! /usr/bin/env python
+import soap
+import soap.tools
+import soap.soapy.graph
+
+import os
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.graph import Graph, GraphBatch, mp_compute_graph, mp_compute_graphs
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+DIM = 5
+
+class TestGraphBatch(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(23)
+        self.features, self.positions, self.connectivities, self.meta = [], [], [], []
+        for idx, n in enumerate([ 2, 4, 1, 3, 3 ]):
+            self.features.append(rng.uniform(size=(n, DIM)))
+            self.positions.append(rng.normal(size=(n, 3)))
+            # Graph 2 without connectivity, as from a structure that is not partitioned
+            if idx == 2: C = np.array([], dtype=bool)
+            else: C = rng.uniform(size=(n, n)) > 0.5
+            self.connectivities.append(C)
+            self.meta.append({ "idx": idx, "label": "g%d" % idx,
+                "vertex_info": [ "C" ]*n, "graph_info": { "label": "g%d" % idx } })
+    def assertSameGraph(self, g, i):
+        self.assertEqual(g.idx, self.meta[i]["idx"])
+        self.assertEqual(g.label, self.meta[i]["label"])
+        self.assertEqual(g.vertex_info, self.meta[i]["vertex_info"])
+        self.assertEqual(g.graph_info, self.meta[i]["graph_info"])
+        self.assertTrue(np.array_equal(g.P, self.features[i]))
+        self.assertTrue(np.array_equal(g.R, self.positions[i]))
+        self.assertEqual(g.C.dtype, np.dtype(bool))
+        self.assertTrue(np.array_equal(g.C, self.connectivities[i]))
+        return
+    def fromArrays(self, i0, i1):
+        return GraphBatch.fromArrays(self.features[i0:i1], self.positions[i0:i1],
+            self.connectivities[i0:i1], self.meta[i0:i1])
+
+class TestGraphBatchArrays(TestGraphBatch):
+    def test_FromArrays(self):
+        batch = self.fromArrays(0, 5)
+        self.assertEqual(len(batch), 5)
+        for i, g in enumerate(batch): self.assertSameGraph(g, i)
+        self.assertSameGraph(batch[-1], 4)
+        self.assertRaises(IndexError, batch.__getitem__, 5)
+        self.assertRaises(IndexError, batch.__getitem__, -6)
+    def test_Views(self):
+        # Feature and position matrices are views into the batch arrays
+        batch = self.fromArrays(0, 5)
+        g = batch[1]
+        self.assertTrue(np.may_share_memory(g.P, batch.P))
+        self.assertTrue(np.may_share_memory(g.R, batch.R))
+    def test_Concatenate(self):
+        for splits in [ [ 0, 5 ], [ 0, 2, 5 ], [ 0, 1, 2, 3, 5 ], [ 0, 0, 3, 3, 5 ] ]:
+            batches = [ self.fromArrays(i0, i1) for i0, i1 in zip(splits[:-1], splits[1:]) ]
+            batch = GraphBatch.concatenate(batches)
+            self.assertEqual(len(batch), 5)
+            self.assertTrue(np.array_equal(batch.offsets, self.fromArrays(0, 5).offsets))
+            for i, g in enumerate(batch): self.assertSameGraph(g, i)
+    def test_Empty(self):
+        batch = GraphBatch.concatenate([])
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(list(batch), [])
+        batch = GraphBatch.concatenate([ self.fromArrays(0, 0), self.fromArrays(2, 4) ])
+        self.assertEqual(len(batch), 2)
+        self.assertSameGraph(batch[0], 2)
+        self.assertSameGraph(batch[1], 3)
+
+class TestGraphBatchCompute(unittest.TestCase):
+    def setUp(self):
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.xyzfile = os.path.join(data_root, 'config_simple_CH.xyz')
+        self.options = {
+            "spectrum.global": False,
+            "spectrum.gradients": False,
+            "spectrum.2l1_norm": False,
+            "radialbasis.type" : "gaussian",
+            "radialbasis.mode" : "adaptive",
+            "radialbasis.N" : 5,
+            "radialbasis.sigma": 0.5,
+            "radialbasis.integration_steps": 15,
+            "radialcutoff.Rc": 3.5,
+            "radialcutoff.Rc_width": 0.5,
+            "radialcutoff.type": "heaviside",
+            "radialcutoff.center_weight": 1.0,
+            "angularbasis.type": "spherical-harmonic",
+            "angularbasis.L": 3,
+            "kernel.adaptor": "specific-unique",
+            "exclude_centers": [],
+            "exclude_targets": [],
+            "type_list": [ "C", "H" ] }
+    def loadConfigs(self, n):
+        # Perturbed copies of the same structure (conversion reorders atoms,
+        # hence every evaluation starts from freshly read configs)
+        rng = np.random.RandomState(29)
+        configs = []
+        for idx in range(n):
+            config = soap.tools.io.read(self.xyzfile)[0]
+            config.set_positions(config.get_positions() + rng.normal(scale=0.1, size=(len(config), 3)))
+            config.info['idx'] = idx
+            config.info['label'] = "c%d" % idx
+            configs.append(config)
+        return configs
+    def test_Batches(self):
+        # Batched evaluation, serial or in a pool, reproduces the per-structure path
+        n = 5
+        kwargs = { "fragment_based": False, "descriptor_type": "soap",
+            "descriptor_options": self.options }
+        graphs_ref = [ mp_compute_graph(config, log=None, **kwargs) for config in self.loadConfigs(n) ]
+        for n_procs, batch_size in [ (1, 1), (1, 2), (1, 8), (2, 2) ]:
+            batch = mp_compute_graphs(self.loadConfigs(n), n_procs, batch_size=batch_size, **kwargs)
+            self.assertEqual(len(batch), n)
+            for g, g_ref in zip(batch, graphs_ref):
+                self.assertEqual(g.idx, g_ref.idx)
+                self.assertEqual(g.label, g_ref.label)
+                self.assertEqual(list(g.vertex_info), list(g_ref.vertex_info))
+                self.assertTrue(np.allclose(g.P, g_ref.P, rtol=1e-12, atol=1e-14))
+                self.assertTrue(np.allclose(g.R, g_ref.R, rtol=1e-12, atol=1e-14))
+                self.assertTrue(np.array_equal(g.C, np.asarray(g_ref.C, dtype=bool)))
+
+if __name__ == "__main__":
+    unittest.main()
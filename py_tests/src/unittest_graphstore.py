@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.graph
+import soap.soapy.util
+
+import os
+import shutil
+import pickle
+import tempfile
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.graph import Graph, SharedGraphStore, mp_compute_kernel_matrix_shared
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+DIM = 5
+
+def kernel_graph_pair(pair, kernel):
+    return kernel.compute(pair[0], pair[1])
+
+class TestGraphStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, 'graphs')
+        rng = np.random.RandomState(13)
+        self.graphs = []
+        for idx, n in enumerate([ 2, 4, 3, 1, 3, 2, 4 ]):
+            P = rng.uniform(0.1, 1., size=(n, DIM))
+            C = rng.uniform(size=(n, n))
+            self.graphs.append(Graph(
+                idx=idx,
+                label="g%d" % idx,
+                feature_mat=P,
+                feature_mat_avg=np.average(P, axis=0),
+                position_mat=rng.normal(size=(n, 3)),
+                connectivity_mat=C+C.T,
+                vertex_info=[ "C" if i % 2 == 0 else "H" for i in range(n) ],
+                graph_info={ "label": "g%d" % idx }))
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def setUp_Kernel(self):
+        options = { "xi": 2., "delta": 1. }
+        basekernel = soap.soapy.graph.BaseKernelDot(options)
+        return soap.soapy.graph.TopKernelAverage(options, basekernel)
+    def computeSerial(self, kernel, normalize=False):
+        n = len(self.graphs)
+        K = np.zeros((n, n))
+        for i in range(n):
+            for j in range(i, n):
+                K[i,j] = kernel.compute(self.graphs[i], self.graphs[j], normalize=normalize)
+                K[j,i] = K[i,j]
+        return K
+
+class TestGraphStoreData(TestGraphStore):
+    def test_RoundTrip(self):
+        store = SharedGraphStore.create(self.graphs, self.prefix, dtype='float64')
+        self.assertEqual(len(store), len(self.graphs))
+        for g, g_ref in zip(store, self.graphs):
+            self.assertEqual(g.idx, g_ref.idx)
+            self.assertEqual(g.label, g_ref.label)
+            self.assertEqual(list(g.vertex_info), g_ref.vertex_info)
+            self.assertEqual(g.graph_info["label"], g_ref.graph_info["label"])
+            self.assertTrue(np.array_equal(g.P, g_ref.P))
+            self.assertTrue(np.array_equal(g.P_avg, g_ref.P_avg))
+            self.assertTrue(np.array_equal(g.R, g_ref.R))
+            self.assertTrue(np.array_equal(g.C, g_ref.C))
+        self.assertTrue(np.array_equal(store[-1].P, self.graphs[-1].P))
+        self.assertRaises(IndexError, store.__getitem__, len(self.graphs))
+    def test_Dtype(self):
+        # Source precision by default, float32 on request only
+        store = SharedGraphStore.create(self.graphs, self.prefix)
+        g = SharedGraphStore(self.prefix)[1]
+        self.assertEqual(g.P.dtype, np.dtype('float64'))
+        self.assertTrue(np.array_equal(g.P, self.graphs[1].P))
+        store = SharedGraphStore.create(self.graphs, self.prefix, dtype='float32')
+        g = SharedGraphStore(self.prefix)[1]
+        self.assertEqual(g.P.dtype, np.dtype('float32'))
+        self.assertTrue(np.allclose(g.P, self.graphs[1].P, rtol=1e-6, atol=0.))
+    def test_Pickle(self):
+        # Only the prefix and metadata cross process boundaries
+        store = SharedGraphStore.create(self.graphs, self.prefix, dtype='float64')
+        store[0]
+        self.assertTrue(store.arrays is not None)
+        store_copy = pickle.loads(pickle.dumps(store))
+        self.assertTrue(store_copy.arrays is None)
+        self.assertTrue(np.array_equal(store_copy[2].P, self.graphs[2].P))
+
+class TestGraphStoreKernel(TestGraphStore):
+    def test_KernelMatrixShared(self):
+        store = SharedGraphStore.create(self.graphs, self.prefix, dtype='float64')
+        kernel = self.setUp_Kernel()
+        for normalize in [ False, True ]:
+            K_serial = self.computeSerial(kernel, normalize=normalize)
+            for source in [ store, self.prefix ]:
+                out_file = os.path.join(self.tmpdir, 'kernel.npy')
+                for f in [ out_file, out_file+'.manifest' ]:
+                    if os.path.exists(f): os.remove(f)
+                self.assertTrue(mp_compute_kernel_matrix_shared(source, kernel, out_file,
+                    n_procs=2, block_size=3, normalize=normalize))
+                K = np.load(out_file)
+                self.assertTrue(np.allclose(K, K_serial, rtol=1e-12, atol=1e-14))
+    def test_PoolUpperTriangle(self):
+        # The store as g_list of the tiled pool: workers map the arrays themselves
+        store = SharedGraphStore.create(self.graphs, self.prefix, dtype='float64')
+        kernel = self.setUp_Kernel()
+        K = soap.soapy.util.mp_pool_compute_upper_triangle(kernel_graph_pair, store,
+            n_procs=2, tile_size=3, kernel=kernel)
+        K_serial = self.computeSerial(kernel)
+        self.assertTrue(np.allclose(K, np.triu(K_serial), rtol=1e-12, atol=1e-14))
+
+if __name__ == "__main__":
+    unittest.main()
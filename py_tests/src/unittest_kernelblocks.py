@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.util
+
+import os
+import json
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.util import mp_compute_kernel_blocks, mp_pool_compute_upper_triangle
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+def kernel_dot_pair(pair, scale=1.):
+    return scale*pair[0].dot(pair[1])
+
+class TestKernelBlocks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(3)
+        self.X = rng.normal(size=(10, 4))
+        self.g_list = [ x for x in self.X ]
+        self.K_ref = self.X.dot(self.X.T)
+        self.block_size = 3 # 4 block rows, 10 tiles in the upper triangle
+        self.bounds = [ (b0, min(b0+self.block_size, 10)) for b0 in range(0, 10, self.block_size) ]
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def targets(self):
+        return [ os.path.join(self.tmpdir, 'kernel.hdf5'), os.path.join(self.tmpdir, 'kernel.npy') ]
+    def compute(self, out_file, **kwargs):
+        return mp_compute_kernel_blocks(kernel_dot_pair, self.g_list, out_file, n_procs=2,
+            block_size=self.block_size, chunksize=1, **kwargs)
+    def readTarget(self, out_file):
+        if out_file.endswith('.hdf5'):
+            h5 = h5py.File(out_file, 'r')
+            K = h5['kernel'][()]
+            h5.close()
+            return K
+        return np.array(np.load(out_file))
+    def readManifest(self, out_file):
+        with open(out_file+'.manifest') as f:
+            lines = f.readlines()
+        return lines[0], [ tuple(json.loads(l)) for l in lines[1:] ]
+
+class TestKernelBlocksResume(TestKernelBlocks):
+    def test_Complete(self):
+        for out_file in self.targets():
+            self.assertTrue(self.compute(out_file))
+            header, done = self.readManifest(out_file)
+            self.assertEqual(len(done), 10)
+            self.assertTrue(np.allclose(self.readTarget(out_file), self.K_ref, rtol=1e-12, atol=1e-14))
+    def test_Interrupted(self):
+        for out_file in self.targets():
+            # Stops after the first tile
+            self.assertFalse(self.compute(out_file, t_wall=0.))
+            header, done = self.readManifest(out_file)
+            self.assertEqual(len(done), 1)
+            self.assertTrue(self.compute(out_file))
+            header, done = self.readManifest(out_file)
+            self.assertEqual(len(set(done)), 10)
+            self.assertEqual(len(done), 10)
+            self.assertTrue(np.allclose(self.readTarget(out_file), self.K_ref, rtol=1e-12, atol=1e-14))
+    def test_PartialManifest(self):
+        for out_file in self.targets():
+            self.assertTrue(self.compute(out_file))
+            # Keep three tiles, plus the truncated line of an interrupted write
+            header, done = self.readManifest(out_file)
+            done = done[0:3]
+            with open(out_file+'.manifest', 'w') as f:
+                f.write(header)
+                for tile in done: f.write(json.dumps(list(tile))+'\n')
+                f.write('[3, ')
+            # Tiles recomputed on resume carry the opposite sign
+            self.assertTrue(self.compute(out_file, scale=-1.))
+            header, done_all = self.readManifest(out_file)
+            self.assertEqual(sorted(done_all), sorted(set(done_all)))
+            self.assertEqual(len(done_all), 10)
+            K_expected = -self.K_ref
+            for bi, bj in done:
+                r0, r1 = self.bounds[bi]
+                c0, c1 = self.bounds[bj]
+                K_expected[r0:r1,c0:c1] = self.K_ref[r0:r1,c0:c1]
+                K_expected[c0:c1,r0:r1] = self.K_ref[c0:c1,r0:r1]
+            self.assertTrue(np.allclose(self.readTarget(out_file), K_expected, rtol=1e-12, atol=1e-14))
+    def test_Checkpoints(self):
+        # Tiles are recorded once flushed, in batches of flush_every
+        for out_file in self.targets():
+            self.assertFalse(self.compute(out_file, t_wall=0., flush_every=4))
+            header, done = self.readManifest(out_file)
+            self.assertEqual(len(done), 1)
+            self.assertTrue(self.compute(out_file, flush_every=4))
+            header, done = self.readManifest(out_file)
+            self.assertEqual(sorted(done), sorted(set(done)))
+            self.assertEqual(len(done), 10)
+            self.assertTrue(np.allclose(self.readTarget(out_file), self.K_ref, rtol=1e-12, atol=1e-14))
+    def test_MissingTarget(self):
+        # A manifest without its target is discarded
+        out_file = self.targets()[1]
+        self.assertFalse(self.compute(out_file, t_wall=0.))
+        os.remove(out_file)
+        self.assertTrue(self.compute(out_file))
+        self.assertTrue(np.allclose(self.readTarget(out_file), self.K_ref, rtol=1e-12, atol=1e-14))
+
+class TestKernelBlocksMirror(TestKernelBlocks):
+    def test_NoMirror(self):
+        # Upper triangle only, including within the diagonal tiles
+        for out_file in self.targets():
+            self.assertTrue(self.compute(out_file, mirror=False))
+            K = self.readTarget(out_file)
+            self.assertTrue(np.allclose(K, np.triu(self.K_ref), rtol=1e-12, atol=1e-14))
+            self.assertTrue(np.all(np.tril(K, -1) == 0.))
+    def test_Full(self):
+        for out_file in self.targets():
+            self.assertTrue(self.compute(out_file, symmetric=False, mirror=False))
+            header, done = self.readManifest(out_file)
+            self.assertEqual(len(done), 16)
+            self.assertTrue(np.allclose(self.readTarget(out_file), self.K_ref, rtol=1e-12, atol=1e-14))
+
+class TestKernelBlocksPool(TestKernelBlocks):
+    def test_UpperTriangle(self):
+        # Compared to a serial evaluation, with tiles smaller than the matrix
+        K_serial = np.zeros((10, 10))
+        for i in range(10):
+            for j in range(i, 10):
+                K_serial[i,j] = kernel_dot_pair([ self.g_list[i], self.g_list[j] ], scale=0.5)
+        for tile_size in [ 3, 64 ]:
+            K = mp_pool_compute_upper_triangle(kernel_dot_pair, self.g_list, n_procs=2,
+                tile_size=tile_size, scale=0.5)
+            self.assertEqual(K.shape, (10, 10))
+            self.assertTrue(np.allclose(K, K_serial, rtol=1e-12, atol=1e-14))
+            self.assertTrue(np.all(np.tril(K, -1) == 0.))
+    def test_Dtype(self):
+        K = mp_pool_compute_upper_triangle(kernel_dot_pair, self.g_list, n_procs=2,
+            dtype='float32', tile_size=4)
+        self.assertEqual(K.dtype, np.dtype('float32'))
+        self.assertTrue(np.allclose(K, np.triu(self.K_ref), rtol=1e-5, atol=1e-5))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.util
+
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.util import kernel_extend_hdf5
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+def symmetrize(K):
+    return K + K.T - np.diag(K.diagonal())
+
+def normalize(K):
+    z = 1./np.sqrt(K.diagonal())
+    return K*np.outer(z,z)
+
+class TestKernelExtend(unittest.TestCase):
+    def setUp(self):
+        # Three structures with 2, 3 and 1 atoms (see unittest_dmap_archive)
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.dset = soap.DMapMatrixSet()
+        self.dset.load(os.path.join(data_root, 'dmapset_v0.arch'))
+        self.tmpdir = tempfile.mkdtemp()
+        # Splits into old and new structures
+        self.splits = [ ([ 0, 1 ], [ 2 ]), ([ 0 ], [ 1, 2 ]), ([], [ 0, 1, 2 ]) ]
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def setUp_Options(self, normalize=False, topkernel="rematch"):
+        options = soap.Options()
+        options.set('basekernel_type', 'dot')
+        options.set('base_exponent', 2.)
+        options.set('base_filter', False)
+        options.set('topkernel_type', topkernel)
+        options.set('rematch_gamma', 0.1)
+        options.set('rematch_eps', 1e-10)
+        options.set('rematch_omega', 1.0)
+        options.set('normalize', normalize)
+        return options
+    def setUp_Kernel(self, normalize=False):
+        return soap.Kernel(self.setUp_Options(normalize))
+
+class TestKernelExtendCxx(TestKernelExtend):
+    def test_Extend(self):
+        for norm in [ False, True ]:
+            K_ref = self.setUp_Kernel(norm).evaluate(self.dset, self.dset, True, "float64")
+            for old, new in self.splits:
+                kernel = self.setUp_Kernel(norm)
+                d_old = self.dset[old]
+                K_old = kernel.evaluate(d_old, d_old, True, "float64")
+                K = kernel.extend(K_old, d_old, self.dset[new], "float64")
+                self.assertEqual(K.shape, K_ref.shape)
+                self.assertTrue(np.allclose(np.triu(K), K_ref, rtol=1e-10, atol=1e-12))
+    def test_Blocks(self):
+        K_ref = symmetrize(self.setUp_Kernel().evaluate(self.dset, self.dset, True, "float64"))
+        K_cross, K_new = self.setUp_Kernel().extendBlocks(self.dset[[ 0 ]], self.dset[[ 1, 2 ]], "float64")
+        self.assertEqual(K_cross.shape, (1, 2))
+        self.assertEqual(K_new.shape, (2, 2))
+        self.assertTrue(np.allclose(K_cross, K_ref[0:1,1:3], rtol=1e-10, atol=1e-12))
+        self.assertTrue(np.allclose(K_new, np.triu(K_ref[1:3,1:3]), rtol=1e-10, atol=1e-12))
+    def test_Inconsistent(self):
+        kernel = self.setUp_Kernel()
+        self.assertRaises(Exception, kernel.extend, np.zeros((1, 1)),
+            self.dset[[ 0, 1 ]], self.dset[[ 2 ]], "float64")
+
+class TestKernelExtendHdf5(TestKernelExtend):
+    def test_Incremental(self):
+        K_ref = symmetrize(self.setUp_Kernel().evaluate(self.dset, self.dset, True, "float64"))
+        for norm in [ False, True ]:
+            h5_file = os.path.join(self.tmpdir, 'kernel_%d.hdf5' % norm)
+            kernel = self.setUp_Kernel()
+            # Structure by structure, starting from an empty file
+            for i in range(len(self.dset)):
+                kernel_extend_hdf5(kernel, h5_file, self.dset[range(i)], self.dset[[ i ]],
+                    normalize=norm)
+            h5 = h5py.File(h5_file, 'r')
+            K = h5['kernel'][()]
+            s = h5['self'][()]
+            h5.close()
+            self.assertTrue(np.allclose(s, K_ref.diagonal(), rtol=1e-10, atol=1e-12))
+            K_expected = normalize(K_ref) if norm else K_ref
+            self.assertTrue(np.allclose(K, K_expected, rtol=1e-10, atol=1e-12))
+            # The stored matrix must match the number of old structures ...
+            self.assertRaises(ValueError, kernel_extend_hdf5, kernel, h5_file,
+                self.dset[[ 0 ]], self.dset[[ 2 ]], normalize=norm)
+            # ... and its normalization
+            self.assertRaises(ValueError, kernel_extend_hdf5, kernel, h5_file,
+                self.dset[[ 0, 1, 2 ]], self.dset[[ 2 ]], normalize=not norm)
+
+class TestKernelExtendSuper(TestKernelExtend):
+    def test_Extend(self):
+        for norm in [ False, True ]:
+            kernel = soap.SuperKernel(self.setUp_Options(norm), self.setUp_Options(False, "average"))
+            d_all = soap.DMapMatrixSuperSet(self.dset, [ [ 0 ], [ 0, 1 ], [ 2 ], [ 1, 2 ] ])
+            K_top_ref, K_super_ref = kernel.evaluate(d_all, d_all, True)
+            d_old = soap.DMapMatrixSuperSet(self.dset[[ 0, 1 ]], [ [ 0 ], [ 0, 1 ] ])
+            K_top_old, K_super_old = kernel.evaluate(d_old, d_old, True)
+            # Slices of the new ensembles refer to the new structures only
+            d_new = soap.DMapMatrixSuperSet(self.dset[[ 2 ]], [ [ 0 ] ])
+            K_top, K_super = kernel.extend(K_top_old, K_super_old, d_old, d_new)
+            self.assertTrue(np.allclose(K_top, K_top_ref[0:3,0:3], rtol=1e-10, atol=1e-12))
+            self.assertTrue(np.allclose(K_super, K_super_ref[0:3,0:3], rtol=1e-10, atol=1e-12))
+
+if __name__ == "__main__":
+    unittest.main()
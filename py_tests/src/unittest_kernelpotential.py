@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+import soap
+import soap.tools
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.kernel import KernelPotential, KernelAdaptorSpecificUnique
+from soap.soapy.kernel import select_fps, select_cur
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+class KernelAdaptorSyntheticGradients(KernelAdaptorSpecificUnique):
+    # The type-resolved adaptors provide no neighbour gradients: these fixed
+    # pseudo-random blocks per (centre, neighbour) pair only serve to check
+    # how KernelPotential assembles forces
+    def adaptGradients(self, atomic, nb_pid, X):
+        rng = np.random.RandomState(100*atomic.getCenter().id + nb_pid)
+        dX = rng.normal(size=(3, X.shape[0]))
+        return dX[0], dX[1], dX[2]
+
+class TestKernelPotential(unittest.TestCase):
+    def setUp(self):
+        self.setUp_Options()
+        self.setUp_Structure()
+        self.setUp_Kernel()
+    def setUp_Options(self):
+        options = soap.Options()
+        options.excludeCenters([])
+        options.excludeTargets([])
+        options.excludeCenterIds([])
+        options.excludeTargetIds([])
+        options.set('radialbasis.type', 'gaussian')
+        options.set('radialbasis.mode', 'adaptive')
+        options.set('radialbasis.N', 5)
+        options.set('radialbasis.sigma', 0.5)
+        options.set('radialbasis.integration_steps', 15)
+        options.set('radialcutoff.Rc', 4.)
+        options.set('radialcutoff.Rc_width', 0.5)
+        options.set('radialcutoff.type', 'heaviside')
+        options.set('radialcutoff.center_weight', 0.5)
+        options.set('angularbasis.type', 'spherical-harmonic')
+        options.set('angularbasis.L', 3)
+        options.set('densitygrid.N', 20)
+        options.set('densitygrid.dx', 0.15)
+        options.set('spectrum.gradients', True)
+        options.set('spectrum.2l1_norm', False)
+        options.set('kernel.adaptor', 'generic')
+        options.set('kernel.type', 'dot')
+        options.set('kernel.delta', 1.)
+        options.set('kernel.xi', 2.)
+        # STORE
+        self.options = options
+        self.types = ['C', 'H']
+        return
+    def setUp_Structure(self):
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        xyzfile = os.path.join(data_root, 'config_simple_CH.xyz')
+        config = soap.tools.ase_load_single(xyzfile)
+        self.structure = soap.tools.setup_structure_ase(config.config_file, config.atoms)
+        self.positions_0 = [ np.array(part.pos) for part in self.structure ]
+        return
+    def setUp_Kernel(self):
+        kernelpot = KernelPotential(self.options)
+        kernelpot.adaptor = KernelAdaptorSyntheticGradients(self.options, self.types)
+        kernelpot.acquire(self.structure, 0.7)
+        # Second reference set: displaced structure, different weight
+        self.displace(1, np.array([0.1, -0.05, 0.2]))
+        kernelpot.acquire(self.structure, -0.3)
+        self.displace(1, np.zeros((3,)))
+        self.displace(4, np.array([-0.1, 0.1, 0.05]))
+        self.kernelpot = kernelpot
+        return
+    def displace(self, pid, dr):
+        particle = self.structure.getParticle(pid)
+        particle.pos = self.positions_0[pid-1] + dr
+        return
+    def computeEnergyForcesReference(self):
+        # Per-environment loop of the former computeEnergy/computeForces
+        kernelpot = self.kernelpot
+        spectrum = kernelpot.computeSpectrum(self.structure, gradients=True)
+        energy = 0.0
+        projection_matrix = []
+        forces = np.zeros((self.structure.n_particles, 3))
+        for atomic in spectrum:
+            X_unnorm, X_norm = kernelpot.adaptor.adaptScalar(atomic)
+            ic = kernelpot.kernelfct.compute(kernelpot.IX, X_norm)
+            energy += kernelpot.alpha.dot(ic)
+            projection_matrix.append(ic)
+            alpha_dIC = kernelpot.alpha.dot(
+                kernelpot.kernelfct.computeDerivativeOuter(kernelpot.IX, X_norm))
+            for nb_pid in atomic.getNeighbourPids():
+                dX_dx, dX_dy, dX_dz = kernelpot.adaptor.adaptGradients(atomic, nb_pid, X_unnorm)
+                forces[nb_pid-1] -= np.array([
+                    alpha_dIC.dot(dX_dx), alpha_dIC.dot(dX_dy), alpha_dIC.dot(dX_dz) ])
+        return energy, forces, np.array(projection_matrix)
+
+class TestKernelPotentialEnergyForces(TestKernelPotential):
+    def test_Energy(self):
+        energy_ref, forces_ref, prj_mat_ref = self.computeEnergyForcesReference()
+        energy, prj_mat = self.kernelpot.computeEnergy(self.structure, return_prj_mat=True)
+        self.assertAlmostEqual(energy, energy_ref, places=10)
+        self.assertTrue(np.allclose(np.array(prj_mat), prj_mat_ref, rtol=1e-10, atol=1e-12))
+        self.assertAlmostEqual(self.kernelpot.computeEnergy(self.structure), energy_ref, places=10)
+    def test_Forces(self):
+        energy_ref, forces_ref, prj_mat_ref = self.computeEnergyForcesReference()
+        energy, forces = self.kernelpot.computeEnergyForces(self.structure, forces=True)
+        self.assertAlmostEqual(energy, energy_ref, places=10)
+        self.assertEqual(forces.shape, (self.structure.n_particles, 3))
+        self.assertTrue(np.allclose(forces, forces_ref, rtol=1e-10, atol=1e-12))
+        forces_list = self.kernelpot.computeForces(self.structure)
+        self.assertTrue(np.allclose(np.array(forces_list), forces_ref, rtol=1e-10, atol=1e-12))
+    def test_EnergyOnly(self):
+        energy, forces = self.kernelpot.computeEnergyForces(self.structure, forces=False)
+        self.assertTrue(forces is None)
+
+class TestKernelPotentialSparse(TestKernelPotential):
+    def test_Selection(self):
+        rng = np.random.RandomState(2)
+        IX = rng.normal(size=(20, 6))
+        IX[10:13] = IX[3] # Duplicate rows
+        for select in [ select_fps, select_cur ]:
+            for n_select in [ 1, 5, 20, 25 ]:
+                idcs = select(IX, n_select)
+                self.assertEqual(len(idcs), min(n_select, IX.shape[0]))
+                self.assertEqual(len(set(list(idcs))), len(idcs))
+                self.assertTrue(np.all((idcs >= 0) & (idcs < IX.shape[0])))
+        self.assertEqual(select_fps(IX, 3, idx_start=4)[0], 4)
+    def test_Full(self):
+        # With every reference as inducing environment, the sparse model
+        # reproduces the full one up to the regularization
+        kernelpot = self.kernelpot
+        energy_ref, forces_ref = kernelpot.computeEnergyForces(self.structure, forces=True)
+        scale = max(1., abs(energy_ref))
+        n_refs = len(kernelpot.store)
+        for method in [ "fps", "cur" ]:
+            sparse = kernelpot.sparsify(n_refs, method=method, sigma=1e-6)
+            self.assertEqual(sorted(list(sparse["idcs"])), range(n_refs))
+            IZ, beta = kernelpot.getReferences()
+            self.assertEqual(IZ.shape, kernelpot.IX.shape)
+            energy, forces = kernelpot.computeEnergyForces(self.structure, forces=True)
+            self.assertTrue(abs(energy - energy_ref) < 1e-6*scale)
+            self.assertTrue(np.allclose(forces, forces_ref, rtol=1e-5, atol=1e-6*scale))
+    def test_Discard(self):
+        kernelpot = self.kernelpot
+        n_refs = len(kernelpot.store)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(tmpdir, 'kernelpot')
+            kernelpot.save(prefix)
+            for change in [
+                    lambda: kernelpot.acquire(self.structure, 0.1),
+                    lambda: kernelpot.removeReferences([ 0 ]),
+                    lambda: kernelpot.selectReferences(np.arange(len(kernelpot.store)) > 0),
+                    lambda: kernelpot.load(prefix) ]:
+                kernelpot.sparsify(2, method="fps")
+                self.assertTrue(kernelpot.sparse is not None)
+                self.assertEqual(kernelpot.getReferences()[0].shape[0], 2)
+                change()
+                self.assertTrue(kernelpot.sparse is None)
+                IX, alpha = kernelpot.getReferences()
+                self.assertTrue(np.array_equal(IX, kernelpot.IX))
+                self.assertTrue(np.array_equal(alpha, kernelpot.alpha))
+            self.assertEqual(len(kernelpot.store), n_refs)
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    unittest.main()
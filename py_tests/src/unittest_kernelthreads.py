@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+import soap
+
+import os
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+class TestKernelThreads(unittest.TestCase):
+    def setUp(self):
+        # Three structures with 2, 3 and 1 atoms (see unittest_dmap_archive)
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.dset = soap.DMapMatrixSet()
+        self.dset.load(os.path.join(data_root, 'dmapset_v0.arch'))
+    def setUp_Kernel(self, basekernel, topkernel, **kwargs):
+        options = soap.Options()
+        options.set('basekernel_type', basekernel)
+        options.set('base_exponent', 2.)
+        options.set('base_filter', False)
+        options.set('base_dim', 64)
+        options.set('base_seed', 7)
+        options.set('topkernel_type', topkernel)
+        options.set('rematch_gamma', 0.1)
+        options.set('rematch_eps', 1e-10)
+        options.set('rematch_omega', 1.0)
+        for key, value in kwargs.items():
+            options.set(key, value)
+        return soap.Kernel(options)
+    def evaluate(self, symmetric, basekernel="dot", topkernel="average", **kwargs):
+        kernel = self.setUp_Kernel(basekernel, topkernel, **kwargs)
+        return kernel.evaluate(self.dset, self.dset, symmetric, "float64")
+
+class TestKernelThreadsTiles(TestKernelThreads):
+    def test_Tiles(self):
+        # Every combination of threads and tiles reproduces the serial matrix
+        for symmetric in [ True, False ]:
+            for basekernel in [ "dot", "dot-nystrom" ]:
+                for topkernel in [ "average", "rematch" ]:
+                    K_ref = self.evaluate(symmetric, basekernel, topkernel, n_threads=1)
+                    if symmetric:
+                        self.assertTrue(np.all(np.tril(K_ref, -1) == 0.))
+                    for n_threads in [ 1, 2, 4 ]:
+                        for tile_size in [ 1, 2, 16 ]:
+                            K = self.evaluate(symmetric, basekernel, topkernel,
+                                n_threads=n_threads, tile_size=tile_size)
+                            self.assertEqual(K.shape, K_ref.shape)
+                            self.assertTrue(np.allclose(K, K_ref, rtol=1e-12, atol=1e-14))
+    def test_Normalize(self):
+        for symmetric in [ True, False ]:
+            K_ref = self.evaluate(symmetric, normalize=True, n_threads=1)
+            K = self.evaluate(symmetric, normalize=True, n_threads=2, tile_size=1)
+            self.assertTrue(np.allclose(K, K_ref, rtol=1e-12, atol=1e-14))
+    def test_Symmetric(self):
+        # The upper triangle of the symmetric call matches the full matrix
+        K_full = self.evaluate(False, n_threads=2, tile_size=2)
+        K_sym = self.evaluate(True, n_threads=2, tile_size=2)
+        self.assertTrue(np.allclose(np.triu(K_full), K_sym, rtol=1e-12, atol=1e-14))
+
+if __name__ == "__main__":
+    unittest.main()
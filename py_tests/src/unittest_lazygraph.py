@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.graph
+
+import os
+import shutil
+import pickle
+import tempfile
+import h5py
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.graph import Graph, LazyGraph, H5GraphSource, load_graphs
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+DIM = 5
+
+class TestLazyGraph(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.h5_file = os.path.join(self.tmpdir, 'graphs.hdf5')
+        rng = np.random.RandomState(17)
+        h5 = h5py.File(self.h5_file, 'w')
+        h5_graphs = h5.create_group('graphs')
+        for idx, n in enumerate([ 2, 4, 3, 1, 3 ]):
+            P = rng.uniform(0.1, 1., size=(n, DIM))
+            C = rng.uniform(size=(n, n))
+            Graph(
+                idx=idx,
+                label="g%d" % idx,
+                feature_mat=P,
+                feature_mat_avg=np.average(P, axis=0),
+                position_mat=rng.normal(size=(n, 3)),
+                connectivity_mat=C+C.T,
+                vertex_info=[ "C" if i % 2 == 0 else "H" for i in range(n) ],
+                graph_info={ "label": "g%d" % idx }).save_to_h5(h5_graphs, dtype='float64')
+        h5.close()
+        self.graphs = load_graphs(self.h5_file)
+    def tearDown(self):
+        soap.soapy.graph.close_h5_cached()
+        shutil.rmtree(self.tmpdir)
+    def setUp_Kernel(self):
+        options = { "xi": 2., "delta": 1. }
+        basekernel = soap.soapy.graph.BaseKernelDot(options)
+        return soap.soapy.graph.TopKernelAverage(options, basekernel)
+    def assertSameGraph(self, g, g_ref):
+        self.assertEqual(g.idx, g_ref.idx)
+        self.assertEqual(g.label, g_ref.label)
+        self.assertEqual(g.vertex_info, g_ref.vertex_info)
+        self.assertEqual(g.graph_info, g_ref.graph_info)
+        for field in LazyGraph.fields:
+            self.assertTrue(np.array_equal(getattr(g, field), getattr(g_ref, field)))
+        return
+
+class TestLazyGraphFields(TestLazyGraph):
+    def test_Lazy(self):
+        # Fields are read on first access only
+        h5 = h5py.File(self.h5_file, 'r')
+        g = LazyGraph(h5['graphs']['000001'])
+        self.assertEqual(g.label, self.graphs[1].label)
+        for field in LazyGraph.fields: self.assertFalse(g.isLoaded(field))
+        P_avg = g.P_avg
+        self.assertTrue(g.isLoaded('P_avg'))
+        self.assertFalse(g.isLoaded('P'))
+        self.assertTrue(np.array_equal(P_avg, self.graphs[1].P_avg))
+        self.assertSameGraph(g, self.graphs[1])
+        g.release()
+        for field in LazyGraph.fields: self.assertFalse(g.isLoaded(field))
+        # Assigned fields are not read back from the file
+        g.P = np.zeros((2, 2))
+        self.assertTrue(np.array_equal(g.P, np.zeros((2, 2))))
+        h5.close()
+    def test_Pickle(self):
+        # Pickles as a fully loaded Graph, without the HDF5 handle
+        h5 = h5py.File(self.h5_file, 'r')
+        g = LazyGraph(h5['graphs']['000002'])
+        g.P_avg
+        g_copy = pickle.loads(pickle.dumps(g))
+        h5.close()
+        self.assertTrue(type(g_copy) is Graph)
+        self.assertFalse(hasattr(g_copy, 'h5f'))
+        self.assertSameGraph(g_copy, self.graphs[2])
+
+class TestLazyGraphSource(TestLazyGraph):
+    def test_Source(self):
+        source = load_graphs(self.h5_file, lazy=True)
+        self.assertTrue(isinstance(source, H5GraphSource))
+        self.assertEqual(len(source), len(self.graphs))
+        for g, g_ref in zip(source, self.graphs): self.assertSameGraph(g, g_ref)
+        self.assertSameGraph(source[-1], self.graphs[-1])
+        self.assertRaises(IndexError, source.__getitem__, len(self.graphs))
+        self.assertEqual(len(H5GraphSource(self.h5_file, n=2)), 2)
+        source.close()
+    def test_Cache(self):
+        # The n_cache most recently used proxies are kept
+        source = H5GraphSource(self.h5_file, n_cache=2)
+        g0 = source[0]
+        g0.P
+        self.assertTrue(source[0] is g0)
+        source[1]
+        self.assertTrue(source[0] is g0)
+        source[2]
+        source[3]
+        self.assertFalse(source[0] is g0)
+        self.assertFalse(source[0].isLoaded('P'))
+        self.assertEqual(len(source.cache), 2)
+        source.close()
+        self.assertEqual(len(source.cache), 0)
+    def test_Pickle(self):
+        # Workers receive the file name and an empty cache
+        source = H5GraphSource(self.h5_file, n_cache=4)
+        source[0]
+        source_copy = pickle.loads(pickle.dumps(source))
+        self.assertEqual(len(source_copy.cache), 0)
+        self.assertEqual(source_copy.cache.max_items, 4)
+        self.assertSameGraph(source_copy[0], self.graphs[0])
+        source.close()
+
+class TestLazyGraphKernel(TestLazyGraph):
+    def test_BlockHdf5(self):
+        # Same block as from eagerly loaded graphs, and no handle left open
+        kernel = self.setUp_Kernel()
+        block = [ np.array([ 0, 1 ]), np.array([ 1, 2, 3 ]) ]
+        K_ref = soap.soapy.graph.mp_compute_kernel_block(
+            [ [ self.graphs[i] for i in block[0] ], [ self.graphs[j] for j in block[1] ] ],
+            kernel, None, 'float64')
+        K = soap.soapy.graph.mp_compute_kernel_block_hdf5(block, kernel, None, 'float64',
+            self.h5_file)
+        self.assertTrue(np.allclose(K, K_ref, rtol=1e-12, atol=1e-14))
+        self.assertEqual(len(soap.soapy.graph._H5_HANDLES), 0)
+    def test_ReadBlock(self):
+        h5 = h5py.File(self.h5_file, 'r')
+        block = [ np.array([ 0, 1 ]), np.array([ 3, 4 ]) ]
+        g_rows, g_cols = soap.soapy.graph.read_graph_block(h5['graphs'], block, None)
+        for g, i in zip(g_rows + g_cols, [ 0, 1, 3, 4 ]):
+            self.assertTrue(isinstance(g, LazyGraph))
+            self.assertSameGraph(g, self.graphs[i])
+        h5.close()
+        g_rows, g_cols = soap.soapy.graph.read_graph_block(self.graphs, block, None)
+        self.assertTrue(g_cols[1] is self.graphs[4])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.kernel
+
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.wrap import PowerSpectrum, LazyPowerSpectrum, H5SpectrumSource
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+DIM = 6
+KEYS = [ "C:C", "C:H", "H:H" ]
+
+class TestLazySpectrum(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.h5_file = os.path.join(self.tmpdir, 'spectra.hdf5')
+        rng = np.random.RandomState(19)
+        # Synthetic descriptors, saved one group per spectrum
+        settings = dict(PowerSpectrum.settings)
+        settings.update({ "store_sd": True, "store_sdmap": True, "store_cmap": True })
+        h5 = h5py.File(self.h5_file, 'w')
+        for s, n_atoms in enumerate([ 2, 3, 1, 4 ]):
+            spectrum = PowerSpectrum(label="s%d" % s)
+            spectrum.settings = settings
+            spectrum.sd = rng.uniform(size=(n_atoms, DIM))
+            spectrum.sdmap = soap.soapy.kernel.DescriptorMapMatrix()
+            spectrum.cmap = []
+            for a in range(n_atoms):
+                keys = KEYS[0:1+a%len(KEYS)]
+                dmap = soap.soapy.kernel.DescriptorMap()
+                for k in keys: dmap[k] = rng.uniform(size=(DIM,))
+                spectrum.sdmap.append(dmap)
+                spectrum.cmap.append({ k: rng.normal(size=(3, 4)) + 1j*rng.normal(size=(3, 4))
+                    for k in keys })
+            spectrum.save(h5.create_group("%02d" % s))
+        h5.close()
+        self.h5 = h5py.File(self.h5_file, 'r')
+        self.spectra = [ PowerSpectrum().load(self.h5[key]) for key in sorted(self.h5.keys()) ]
+    def tearDown(self):
+        self.h5.close()
+        shutil.rmtree(self.tmpdir)
+    def assertSameMaps(self, maps, maps_ref):
+        self.assertEqual(len(maps), len(maps_ref))
+        for atom, atom_ref in zip(maps, maps_ref):
+            self.assertEqual(sorted(list(atom)), sorted(list(atom_ref)))
+            for k in atom_ref:
+                self.assertTrue(np.array_equal(atom[k], atom_ref[k]))
+        return
+    def assertSameSpectrum(self, spectrum, spectrum_ref):
+        self.assertEqual(spectrum.label, spectrum_ref.label)
+        self.assertTrue(np.array_equal(spectrum.sd, spectrum_ref.sd))
+        self.assertSameMaps(spectrum.sdmap, spectrum_ref.sdmap)
+        self.assertSameMaps(spectrum.cmap, spectrum_ref.cmap)
+        return
+
+class TestLazySpectrumFields(TestLazySpectrum):
+    def test_Lazy(self):
+        spectrum = LazyPowerSpectrum(self.h5["01"])
+        self.assertEqual(spectrum.label, self.spectra[1].label)
+        for field in PowerSpectrum.h5_fields: self.assertFalse(spectrum.isLoaded(field))
+        self.assertTrue(np.array_equal(spectrum.sd, self.spectra[1].sd))
+        self.assertTrue(spectrum.isLoaded("sd"))
+        self.assertFalse(spectrum.isLoaded("sdmap"))
+        self.assertSameSpectrum(spectrum, self.spectra[1])
+        spectrum.release()
+        self.assertFalse(spectrum.isLoaded("sd"))
+    def test_NotStored(self):
+        # Fields without a store_* setting read as None, without file access
+        spectrum = LazyPowerSpectrum(self.h5["00"])
+        self.assertFalse(spectrum.has_spectrum)
+        self.assertTrue(spectrum.gsd is None)
+        self.assertTrue(spectrum.gcmap is None)
+        self.assertTrue(spectrum.spectrum is None)
+
+class TestLazySpectrumSource(TestLazySpectrum):
+    def test_Source(self):
+        source = H5SpectrumSource(self.h5_file)
+        self.assertEqual(len(source), len(self.spectra))
+        for spectrum, spectrum_ref in zip(source, self.spectra):
+            self.assertTrue(isinstance(spectrum, LazyPowerSpectrum))
+            self.assertSameSpectrum(spectrum, spectrum_ref)
+        source.close()
+    def test_Cache(self):
+        # The n_cache most recently used proxies are kept
+        source = H5SpectrumSource(self.h5_file, n_cache=2)
+        s0 = source[0]
+        s0.sd
+        source[1]
+        self.assertTrue(source[0] is s0)
+        source[2]
+        source[3]
+        s0_new = source[0]
+        self.assertFalse(s0_new is s0)
+        self.assertFalse(s0_new.isLoaded("sd"))
+        self.assertSameSpectrum(s0_new, self.spectra[0])
+        self.assertEqual(len(source.cache), 2)
+        source.close()
+        self.assertEqual(len(source.cache), 0)
+
+if __name__ == "__main__":
+    unittest.main()
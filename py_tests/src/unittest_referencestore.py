@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.kernel
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.kernel import ReferenceStore
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+DIM = 5
+
+class TestReferenceStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(7)
+        # Batches of varying size that cross several capacity doublings
+        self.batches = [ (rng.normal(size=(n, DIM)), rng.normal(size=(n,)),
+            [ ("batch", b, i) for i in range(n) ])
+            for b, n in enumerate([ 1, 2, 3, 7, 1, 12, 5 ]) ]
+        self.IX = np.concatenate([ b[0] for b in self.batches ])
+        self.alpha = np.concatenate([ b[1] for b in self.batches ])
+        self.labels = sum([ b[2] for b in self.batches ], [])
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def setUp_Store(self, path=None):
+        store = ReferenceStore(capacity=2, path=path)
+        capacities = []
+        for IX, alpha, labels in self.batches:
+            store.append(IX, alpha, labels)
+            capacities.append(store.capacity)
+        # 1, 3, 6, 13, 14, 26, 31 rows
+        self.assertEqual(capacities, [ 2, 4, 8, 16, 16, 32, 32 ])
+        return store
+    def assertStore(self, store, IX, alpha, labels):
+        self.assertEqual(len(store), IX.shape[0])
+        self.assertEqual(store.IX.shape, IX.shape)
+        self.assertTrue(np.array_equal(store.IX, IX))
+        self.assertTrue(np.array_equal(store.alpha, alpha))
+        self.assertEqual(store.labels, labels)
+        return
+
+class TestReferenceStoreAppend(TestReferenceStore):
+    def test_Append(self):
+        store = ReferenceStore()
+        self.assertEqual(len(store), 0)
+        self.assertTrue(store.IX is None)
+        self.assertTrue(store.alpha is None)
+        store = self.setUp_Store()
+        self.assertStore(store, self.IX, self.alpha, self.labels)
+    def test_AppendDefaultLabels(self):
+        store = ReferenceStore(capacity=1)
+        store.append(self.IX[0], 0.5)
+        store.append(self.IX[1:4], self.alpha[1:4])
+        self.assertEqual(store.labels, [ None, None, None, None ])
+        self.assertTrue(np.array_equal(store.IX, self.IX[0:4]))
+        self.assertEqual(store.alpha[0], 0.5)
+    def test_Mapped(self):
+        path = os.path.join(self.tmpdir, 'refs')
+        buffer_file = path+'.IX.buffer.npy'
+        store = self.setUp_Store(path=path)
+        self.assertStore(store, self.IX, self.alpha, self.labels)
+        self.assertTrue(isinstance(store._IX, np.memmap))
+        # The old buffer is removed after each reallocation
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), [ os.path.basename(buffer_file) ])
+        IX_buffer = np.load(buffer_file, mmap_mode='r')
+        self.assertEqual(IX_buffer.shape, (32, DIM))
+        self.assertTrue(np.array_equal(IX_buffer[0:len(store)], self.IX))
+
+class TestReferenceStoreSelect(TestReferenceStore):
+    def test_SelectMask(self):
+        for path in [ None, os.path.join(self.tmpdir, 'refs') ]:
+            store = self.setUp_Store(path=path)
+            mask = self.alpha > 0.
+            store.select(mask)
+            self.assertStore(store, self.IX[mask], self.alpha[mask],
+                [ l for l, m in zip(self.labels, mask) if m ])
+    def test_SelectIndices(self):
+        for path in [ None, os.path.join(self.tmpdir, 'refs') ]:
+            store = self.setUp_Store(path=path)
+            idcs = np.array([ 0, 4, 5, 17, 30 ])
+            store.select(idcs)
+            self.assertStore(store, self.IX[idcs], self.alpha[idcs],
+                [ self.labels[i] for i in idcs ])
+            # Growing again after a selection
+            store.append(self.IX[0:3], self.alpha[0:3], self.labels[0:3])
+            self.assertStore(store,
+                np.concatenate([ self.IX[idcs], self.IX[0:3] ]),
+                np.concatenate([ self.alpha[idcs], self.alpha[0:3] ]),
+                [ self.labels[i] for i in idcs ] + self.labels[0:3])
+    def test_Remove(self):
+        store = self.setUp_Store()
+        idcs = [ 1, 2, 13, 30 ]
+        keep = [ i for i in range(len(self.labels)) if i not in idcs ]
+        store.remove(idcs)
+        self.assertStore(store, self.IX[keep], self.alpha[keep], [ self.labels[i] for i in keep ])
+        mask = np.zeros((len(store),), dtype=bool)
+        mask[0] = True
+        store.remove(mask)
+        keep = keep[1:]
+        self.assertStore(store, self.IX[keep], self.alpha[keep], [ self.labels[i] for i in keep ])
+
+class TestReferenceStoreSaveLoad(TestReferenceStore):
+    def test_RoundTrip(self):
+        for path in [ None, os.path.join(self.tmpdir, 'refs') ]:
+            prefix = os.path.join(self.tmpdir, 'saved')
+            self.setUp_Store(path=path).save(prefix)
+            store = ReferenceStore(capacity=4, path=path).load(prefix)
+            self.assertStore(store, self.IX, self.alpha, self.labels)
+            # Loading replaces the current references
+            store.append(self.IX[0:2], self.alpha[0:2], self.labels[0:2])
+            store.load(prefix)
+            self.assertStore(store, self.IX, self.alpha, self.labels)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+import soap
+import soap.linalg
+
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+def logsumexp(X, axis):
+    m = np.max(X, axis=axis)
+    return m + np.log(np.sum(np.exp(X - np.expand_dims(m, axis)), axis=axis))
+
+def rematch_log_reference(K, gamma, eps=1e-14, max_iter=200000):
+    # Log-domain Sinkhorn in numpy, uniform marginals 1/nx, 1/ny
+    nx, ny = K.shape
+    C = -(1.-K)/gamma
+    f = np.zeros((nx,))
+    g = np.zeros((ny,))
+    for it in range(max_iter):
+        f = -np.log(nx) - logsumexp(C + g[np.newaxis,:], axis=1)
+        g = -np.log(ny) - logsumexp(C + f[:,np.newaxis], axis=0)
+        P = np.exp(C + f[:,np.newaxis] + g[np.newaxis,:])
+        if np.sum((P.sum(axis=1) - 1./nx)**2) < eps: break
+    return np.sum(P*K)
+
+class TestRematch(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        self.K_rect = rng.uniform(0., 1., size=(5,7))
+        self.K_square = rng.uniform(0., 1., size=(5,5))
+    def setUp_Kernel(self, gamma, **kwargs):
+        options = soap.Options()
+        options.set('basekernel_type', 'dot')
+        options.set('base_exponent', 3.)
+        options.set('base_filter', False)
+        options.set('topkernel_type', 'rematch')
+        options.set('rematch_gamma', gamma)
+        options.set('rematch_eps', 1e-14)
+        options.set('rematch_omega', 1.0)
+        options.set('rematch_max_iter', 200000)
+        for key, value in kwargs.items():
+            options.set(key, value)
+        return soap.Kernel(options)
+    def evaluate(self, K, gamma, **kwargs):
+        kernel = self.setUp_Kernel(gamma, **kwargs)
+        k = kernel.evaluateTop(np.ascontiguousarray(K), 'float64')
+        return k, kernel.getTopkernelInfo(0)
+
+class TestRematchDense(TestRematch):
+    def test_Regmatch(self):
+        # Against the dense reference solver in soap.linalg
+        for K in [ self.K_rect, self.K_square ]:
+            for gamma in [ 0.5, 0.1, 0.05 ]:
+                k, info = self.evaluate(K, gamma)
+                k_ref = soap.linalg.regmatch(np.ascontiguousarray(K), gamma, 1e-8)
+                self.assertEqual(info["unconverged"], 0)
+                self.assertAlmostEqual(k, k_ref, places=6)
+    def test_WarmStart(self):
+        k_cold, info = self.evaluate(self.K_rect, 0.1, rematch_warm_start=False)
+        k_warm, info = self.evaluate(self.K_rect, 0.1, rematch_warm_start=True)
+        self.assertAlmostEqual(k_cold, k_warm, places=10)
+
+class TestRematchLogDomain(TestRematch):
+    def test_SmallGamma(self):
+        # exp(-(1-K)/gamma) underflows for most entries at these gammas
+        cases = [ (self.K_rect, 1e-2), (self.K_rect, 2e-3), (self.K_rect, 1e-3), 
+            (self.K_square, 1e-2) ]
+        for K, gamma in cases:
+            k, info = self.evaluate(K, gamma)
+            k_ref = rematch_log_reference(K, gamma)
+            self.assertTrue(np.isfinite(k))
+            self.assertEqual(info["unconverged"], 0)
+            self.assertAlmostEqual(k, k_ref, places=6)
+
+class TestRematchSparse(TestRematch):
+    def test_Exact(self):
+        # Retaining every entry reproduces the dense solver
+        cases = [ (self.K_rect, 0.1), (self.K_rect, 1e-3), (self.K_square, 0.1) ]
+        for K, gamma in cases:
+            k_dense, info = self.evaluate(K, gamma)
+            k_sparse, info = self.evaluate(K, gamma, rematch_sparse_topk=K.shape[1])
+            self.assertEqual(info["sparse_solves"], 1)
+            self.assertAlmostEqual(info["sparse_fill"], 1.)
+            self.assertAlmostEqual(k_sparse, k_dense, places=8)
+    def test_Truncated(self):
+        # The deviation from the dense solution stays within the error estimate
+        # (too small a topk may leave no feasible plan on the retained entries)
+        cases = [ (self.K_rect, 0.1), (self.K_rect, 1e-2), (self.K_square, 0.1), (self.K_square, 1e-2) ]
+        for K, gamma in cases:
+            k_dense, info = self.evaluate(K, gamma)
+            k_sparse, info = self.evaluate(K, gamma,
+                rematch_sparse_topk=3, rematch_sparse_check=True)
+            self.assertEqual(info["unconverged"], 0)
+            self.assertLess(info["sparse_fill"], 1.)
+            self.assertLessEqual(abs(k_sparse - k_dense), info["sparse_error_max"] + 1e-8)
+    def test_Threshold(self):
+        # For K in [0,1] and gamma=0.1, exp(-(1-K)/gamma) never drops below 
+        # 1e-12 of the row maximum: nothing is discarded
+        k_dense, info = self.evaluate(self.K_rect, 0.1)
+        k_sparse, info = self.evaluate(self.K_rect, 0.1, rematch_sparse_eps=1e-12)
+        self.assertAlmostEqual(info["sparse_fill"], 1.)
+        self.assertAlmostEqual(k_sparse, k_dense, places=8)
+        self.assertFalse("sparse_error_max" in info)
+
+if __name__ == "__main__":
+    unittest.main()
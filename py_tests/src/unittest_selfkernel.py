@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.graph
+
+import os
+import numpy as np
+import logging
+import unittest
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+def symmetrize(K):
+    return K + K.T - np.diag(K.diagonal())
+
+def normalize(K):
+    z = 1./np.sqrt(K.diagonal())
+    return K*np.outer(z,z)
+
+class Graph(object):
+    def __init__(self, P):
+        self.P = P
+
+class TestSelfKernel(unittest.TestCase):
+    def setUp(self):
+        # Three structures with 2, 3 and 1 atoms (see unittest_dmap_archive)
+        data_root = os.path.join(os.environ['SOAP_ROOT'], 'py_tests/data')
+        self.dset = soap.DMapMatrixSet()
+        self.dset.load(os.path.join(data_root, 'dmapset_v0.arch'))
+    def setUp_Kernel(self, normalize, **kwargs):
+        options = soap.Options()
+        options.set('basekernel_type', 'dot')
+        options.set('base_exponent', 2.)
+        options.set('base_filter', False)
+        options.set('topkernel_type', 'rematch')
+        options.set('rematch_gamma', 0.1)
+        options.set('rematch_eps', 1e-10)
+        options.set('rematch_omega', 1.0)
+        options.set('normalize', normalize)
+        for key, value in kwargs.items():
+            options.set(key, value)
+        return soap.Kernel(options)
+
+class TestSelfKernelCxx(TestSelfKernel):
+    def test_Symmetric(self):
+        K_ref = normalize(symmetrize(self.setUp_Kernel(False).evaluate(
+            self.dset, self.dset, True, "float64")))
+        kernel = self.setUp_Kernel(True)
+        K = symmetrize(kernel.evaluate(self.dset, self.dset, True, "float64"))
+        self.assertTrue(np.allclose(K.diagonal(), 1., rtol=0., atol=1e-12))
+        self.assertTrue(np.allclose(K, K_ref, rtol=1e-10, atol=1e-12))
+        self.assertEqual(kernel.n_self, len(self.dset))
+    def test_Rectangular(self):
+        # Self-kernels served from the cache on the second evaluation
+        K_ref = normalize(symmetrize(self.setUp_Kernel(False).evaluate(
+            self.dset, self.dset, True, "float64")))
+        kernel = self.setUp_Kernel(True)
+        for it in range(2):
+            K = kernel.evaluate(self.dset, self.dset, False, "float64")
+            self.assertTrue(np.allclose(K, K_ref, rtol=1e-8, atol=1e-8))
+        self.assertEqual(kernel.n_self, len(self.dset))
+        kernel.clearSelf()
+        self.assertEqual(kernel.n_self, 0)
+    def test_Bounded(self):
+        K_ref = normalize(symmetrize(self.setUp_Kernel(False).evaluate(
+            self.dset, self.dset, True, "float64")))
+        kernel = self.setUp_Kernel(True, self_cache_size=2)
+        for it in range(2):
+            K = kernel.evaluate(self.dset, self.dset, False, "float64")
+            self.assertTrue(np.allclose(K, K_ref, rtol=1e-8, atol=1e-8))
+            self.assertEqual(kernel.n_self, 2)
+    def test_TwoTopkernels(self):
+        # evaluate only produces the first top kernel: its diagonal must not 
+        # end up in the cache in place of the self-kernels of all top kernels
+        K_ref = [ normalize(symmetrize(self.setUp_Kernel(False, topkernel_type=topkernel).evaluate(
+            self.dset, self.dset, True, "float64"))) for topkernel in [ "rematch", "average" ] ]
+        kernel = self.setUp_Kernel(True)
+        options = soap.Options()
+        options.set('topkernel_type', 'average')
+        kernel.addTopkernel(options)
+        K = symmetrize(kernel.evaluate(self.dset, self.dset, True, "float64"))
+        self.assertTrue(np.allclose(K, K_ref[0], rtol=1e-10, atol=1e-12))
+        self.assertEqual(kernel.n_self, 0)
+        for symmetric in [ False, True ]:
+            kernel.evaluateAll(self.dset, self.dset, symmetric)
+            self.assertEqual(kernel.n_output, 2)
+            for k in range(2):
+                K = kernel.getOutput(k, "float64")
+                if symmetric: K = symmetrize(K)
+                self.assertTrue(np.allclose(K, K_ref[k], rtol=1e-8, atol=1e-8))
+            self.assertEqual(kernel.n_self, len(self.dset))
+        # ... and blocks of extend normalized by the first top kernel
+        K_old = np.triu(K_ref[0][0:2,0:2])
+        K = kernel.extend(K_old, self.dset[[ 0, 1 ]], self.dset[[ 2 ]], "float64")
+        self.assertTrue(np.allclose(symmetrize(K), K_ref[0], rtol=1e-8, atol=1e-8))
+
+class TestSelfKernelGraph(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.graphs = [ Graph(rng.uniform(0., 1., size=(n,4))) for n in [ 2, 3, 4, 3 ] ]
+    def setUp_TopKernel(self, **kwargs):
+        options = { "xi": 2., "delta": 1., "gamma": 0.1 }
+        options.update(kwargs)
+        basekernel = soap.soapy.graph.BaseKernelDot(options)
+        return soap.soapy.graph.TopKernelRematch(options, basekernel)
+    def test_Normalized(self):
+        topkernel = self.setUp_TopKernel()
+        n = len(self.graphs)
+        K = np.array([ [ topkernel.compute(g1, g2) for g2 in self.graphs ] for g1 in self.graphs ])
+        K_norm = np.array([ [ topkernel.compute(g1, g2, normalize=True)
+            for g2 in self.graphs ] for g1 in self.graphs ])
+        self.assertTrue(np.allclose(K_norm.diagonal(), 1., rtol=0., atol=1e-10))
+        self.assertTrue(np.allclose(K_norm, normalize(K), rtol=1e-10, atol=1e-12))
+        self.assertEqual(len(topkernel.self_kernels), n)
+    def test_Bounded(self):
+        topkernel = self.setUp_TopKernel(cache_size=2)
+        K = np.array([ [ topkernel.compute(g1, g2) for g2 in self.graphs ] for g1 in self.graphs ])
+        K_norm = np.array([ [ topkernel.compute(g1, g2, normalize=True)
+            for g2 in self.graphs ] for g1 in self.graphs ])
+        self.assertTrue(np.allclose(K_norm, normalize(K), rtol=1e-10, atol=1e-12))
+        self.assertEqual(len(topkernel.self_kernels), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+import soap
+import soap.soapy.kernel
+
+import os
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import logging
+import unittest
+
+from soap.soapy.wrap import PowerSpectrum, PowerSpectrumStore
+
+# LOGGING/OUTPUT
+soap.silence()
+logging.basicConfig(
+    format='[%(asctime)s] %(message)s',
+    datefmt='%I:%M:%S',
+    level=logging.ERROR)
+
+DIM = 6
+KEYS = [ "C:C", "C:H", "H:H" ]
+
+class TestSpectrumStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.h5_file = os.path.join(self.tmpdir, 'spectra.hdf5')
+        self.rng = np.random.RandomState(11)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def createSpectrum(self, label, n_atoms, maps=False):
+        # Synthetic descriptors: the store only handles the arrays
+        spectrum = PowerSpectrum(label=label)
+        spectrum.sd = self.rng.uniform(size=(n_atoms, DIM))
+        if maps:
+            spectrum.sdmap = soap.soapy.kernel.DescriptorMapMatrix()
+            spectrum.cmap = []
+            for a in range(n_atoms):
+                keys = KEYS[0:1+a%len(KEYS)]
+                dmap = soap.soapy.kernel.DescriptorMap()
+                for k in keys: dmap[k] = self.rng.uniform(size=(DIM,))
+                spectrum.sdmap.append(dmap)
+                spectrum.cmap.append({ k: self.rng.normal(size=(3, 4))
+                    + 1j*self.rng.normal(size=(3, 4)) for k in keys })
+        return spectrum
+    def assertSameMaps(self, maps, maps_ref, dtype):
+        self.assertEqual(len(maps), len(maps_ref))
+        for atom, atom_ref in zip(maps, maps_ref):
+            self.assertEqual(sorted(list(atom)), sorted(list(atom_ref)))
+            for k in atom_ref:
+                self.assertEqual(atom[k].dtype, np.dtype(dtype))
+                self.assertEqual(atom[k].shape, atom_ref[k].shape)
+                self.assertTrue(np.array_equal(atom[k], atom_ref[k].astype(dtype)))
+        return
+    def assertSameSpectrum(self, spectrum, spectrum_ref, dtype, complex_dtype):
+        self.assertEqual(spectrum.label, spectrum_ref.label)
+        self.assertEqual(spectrum.sd.dtype, np.dtype(dtype))
+        self.assertTrue(np.array_equal(spectrum.sd, spectrum_ref.sd.astype(dtype)))
+        if spectrum_ref.sdmap is None:
+            # Stored before the field first appeared
+            self.assertEqual(len(spectrum.sdmap), 0)
+            self.assertEqual(len(spectrum.cmap), 0)
+        else:
+            self.assertSameMaps(spectrum.sdmap, spectrum_ref.sdmap, dtype)
+            self.assertSameMaps(spectrum.cmap, spectrum_ref.cmap, complex_dtype)
+        self.assertTrue(spectrum.gsd is None)
+        self.assertTrue(spectrum.gsdmap is None)
+        return
+
+class TestSpectrumStoreRoundTrip(TestSpectrumStore):
+    def test_AppendBatches(self):
+        for dtype, complex_dtype in [ ("float32", "complex64"), ("float64", "complex128") ]:
+            if os.path.exists(self.h5_file): os.remove(self.h5_file)
+            # Several batches of sd only
+            spectra = [ self.createSpectrum("s%d" % i, 1+i%3) for i in range(5) ]
+            store = PowerSpectrumStore(self.h5_file, mode='w', dtype=dtype, batch_size=2)
+            store.extend(spectra)
+            self.assertEqual(len(store), 5)
+            store.close()
+            # Reopened: sdmap and cmap first appear in the appended batches
+            spectra_add = [ self.createSpectrum("t%d" % i, 2+i%2, maps=True) for i in range(3) ]
+            spectra_add.append(self.createSpectrum("t3", 2))
+            with PowerSpectrumStore(self.h5_file, mode='a', batch_size=2) as store:
+                self.assertEqual(store.dtype, dtype)
+                store.extend(spectra_add)
+            spectra = spectra + spectra_add
+            with PowerSpectrumStore(self.h5_file, mode='r') as store:
+                self.assertEqual(len(store), len(spectra))
+                for i in range(len(spectra)):
+                    self.assertSameSpectrum(store.load(i), spectra[i], dtype, complex_dtype)
+    def test_Dtype(self):
+        # The dtype is fixed by the first writer of a file
+        store = PowerSpectrumStore(self.h5_file, mode='w', dtype="float32")
+        store.append(self.createSpectrum("s0", 2, maps=True))
+        store.close()
+        with PowerSpectrumStore(self.h5_file, mode='a', dtype="float64") as store:
+            self.assertEqual(store.dtype, "float32")
+            self.assertEqual(store.complex_dtype, "complex64")
+            store.append(self.createSpectrum("s1", 3, maps=True))
+        h5 = h5py.File(self.h5_file, 'r')
+        self.assertEqual(h5["sd/rows"].dtype, np.dtype("float32"))
+        self.assertEqual(h5["sd/rows"].shape, (5, DIM))
+        self.assertEqual(h5["sdmap/values"].dtype, np.dtype("float32"))
+        self.assertEqual(h5["cmap/values"].dtype, np.dtype("complex64"))
+        h5.close()
+
+if __name__ == "__main__":
+    unittest.main()
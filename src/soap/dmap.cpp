@@ -1,4 +1,9 @@
 #include <algorithm>
+#include <cstring>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 #include <boost/archive/binary_oarchive.hpp>
 #include <boost/archive/binary_iarchive.hpp>
 #include <sstream>
@@ -12,11 +17,14 @@
 
 namespace soap {
 
-DMap::DMap() : size1(-1), size2(-1) {
+DMap::DMap() : offsets(1, 0), mapped(false), mapped_size(0), mapped_codes(NULL),
+        mapped_offsets(NULL), mapped_values(NULL), size1(-1), size2(-1) {
     ;
 }
 
-DMap::DMap(std::string filter_type) : filter(filter_type), size1(-1), size2(-1) {
+DMap::DMap(std::string filter_type) : offsets(1, 0), mapped(false), mapped_size(0), 
+        mapped_codes(NULL), mapped_offsets(NULL), mapped_values(NULL), 
+        filter(filter_type), size1(-1), size2(-1) {
     ;
 }
 
@@ -25,26 +33,76 @@ DMap::~DMap() {
         delete *it;
     }
     pid_gradmap.clear();
-    for (auto it=dmap.begin(); it!=dmap.end(); ++it) {
-        delete (*it).second;
-    }
-    dmap.clear();
+}
+
+DMap::dtype_t *DMap::appendChannel(code_t code, int length) {
+    this->unmap();
+    codes.push_back(code);
+    offsets.push_back(offsets.back()+length);
+    values.resize(offsets.back(), 0.0);
+    return &values[offsets[offsets.size()-2]];
+}
+
+void DMap::appendChannelNumpy(code_t code, bpy::object &np_v, std::string np_dtype) {
+    soap::linalg::numpy_converter npc(np_dtype.c_str());
+    vec_t v;
+    npc.numpy_to_ublas<dtype_t>(np_v, v);
+    dtype_t *w = this->appendChannel(code, v.size());
+    std::copy(v.begin(), v.end(), w);
+}
+
+void DMap::clearChannels() {
+    mapped = false;
+    codes.clear();
+    offsets.assign(1, 0);
+    values.clear();
 }
 
 bpy::object DMap::val(int chidx, std::string np_dtype) {
     soap::linalg::numpy_converter npc(np_dtype.c_str());
-    return npc.ublas_to_numpy<dtype_t>(*dmap[chidx].second);
+    vec_t v(this->length(chidx));
+    std::copy(this->channel(chidx), this->channel(chidx)+v.size(), v.begin());
+    return npc.ublas_to_numpy<dtype_t>(v);
+}
+
+void DMap::map(const code_t *codes_arg, const uint64_t *offsets_arg, 
+        dtype_t *values_arg, int n) {
+    codes.clear();
+    offsets.assign(1, 0);
+    values.clear();
+    mapped = true;
+    mapped_size = n;
+    mapped_codes = codes_arg;
+    mapped_offsets = offsets_arg;
+    mapped_values = values_arg;
+}
+
+void DMap::unmap() {
+    if (!mapped) return;
+    std::vector<code_t> new_codes(mapped_codes, mapped_codes+mapped_size);
+    std::vector<int> new_offsets(1, 0);
+    std::vector<dtype_t> new_values;
+    for (int c=0; c<mapped_size; ++c) {
+        new_values.insert(new_values.end(), this->channel(c), this->channel(c)+this->length(c));
+        new_offsets.push_back(new_values.size());
+    }
+    mapped = false;
+    codes.swap(new_codes);
+    offsets.swap(new_offsets);
+    values.swap(new_values);
 }
 
 void DMap::slice(std::vector<int> &idcs) {
-    for (auto it=begin(); it!=end(); ++it) {
-        vec_t *new_v = new vec_t(idcs.size(), 0.); 
+    this->unmap();
+    std::vector<dtype_t> new_values(codes.size()*idcs.size(), 0.);
+    for (int c=0; c<codes.size(); ++c) {
+        dtype_t *v = this->channel(c);
         for (int ii=0; ii<idcs.size(); ++ii) {
-            (*new_v)[ii] = (*(it->second))[idcs[ii]];
+            new_values[c*idcs.size()+ii] = v[idcs[ii]];
         }
-        delete (*it).second;
-        (*it).second = new_v;
     }
+    for (int c=0; c<=codes.size(); ++c) offsets[c] = c*idcs.size();
+    values.swap(new_values);
 }
 
 bpy::object DMap::dotOuterNumpy(DMap *other, std::string np_dtype) {
@@ -55,13 +113,11 @@ bpy::object DMap::dotOuterNumpy(DMap *other, std::string np_dtype) {
 }
 
 void DMap::dotOuter(DMap *other, matrix_t &output) {
-    int i = 0;
-    int j = 0;
-    for (auto it=begin(); it!=end(); ++it, ++i) {
-        j = 0;
-        for (auto jt=other->begin(); jt!=other->end(); ++jt, ++j) {
+    for (int i=0; i<this->size(); ++i) {
+        for (int j=0; j<other->size(); ++j) {
             dtype_t r12 = 0.0;
-            soap::linalg::linalg_dot(*(it->second), *(jt->second), r12);
+            soap::linalg::linalg_dot(this->channel(i), other->channel(j), 
+                this->length(i), r12);
             output(i,j) = r12;
         }
     }
@@ -71,32 +127,17 @@ double DMap::dot(DMap *other) {
     if (other->size() < this->size()) return other->dot(this);
     dtype_t res = 0.0;
     dtype_t r12 = 0.0;
-    // NOTE This is clear but inefficient, see improved version below.
-    //for (auto it=dmap.begin(); it!=dmap.end(); ++it) {
-    //    auto jt = other->dmap.find(it->first);
-    //    if (jt != other->end()) {
-    //        // Manual version, use linalg_dot for speed
-    //        //auto &c1 = *(it->second);
-    //        //auto &c2 = *(jt->second);
-    //        //res += c1.dot(c2);
-    //        //res += ub::inner_prod(c1, c2);
-    //        //for (int i=0; i<c1.size(); ++i) {
-    //        //    res += c1(i)*c2(i);
-    //        //}
-    //        soap::linalg::linalg_dot(*(it->second), *(jt->second), r12);
-    //        res += r12;
-    //    }
-    //}
-    auto it=this->begin();
-    auto jt=other->begin();
-    while (it != this->end()) {
-        while (jt != other->end() && jt->first < it->first) ++jt;
-        if (jt == other->end()) break;
-        if (it->first == jt->first) {
-            soap::linalg::linalg_dot(*(it->second), *(jt->second), r12);
+    // Merge over the sorted channel codes
+    int j = 0;
+    int nj = other->size();
+    for (int i=0; i<this->size(); ++i) {
+        while (j < nj && other->code(j) < this->code(i)) ++j;
+        if (j == nj) break;
+        if (this->code(i) == other->code(j)) {
+            soap::linalg::linalg_dot(this->channel(i), other->channel(j), 
+                this->length(i), r12);
             res += r12;
         }
-        ++it;
     }
     return double(res);
 }
@@ -111,27 +152,43 @@ void DMap::add(DMap *other, double scale) {
 }
 
 void DMap::addIgnoreGradients(DMap *other, double scale) {
-    dmap_t add_entries; 
-    auto it = this->begin();
-    auto jt = other->begin();
-    while (jt != other->end()) {
-        if (it == this->end() || jt->first < it->first) {
-            vec_t *add_vec = new vec_t(jt->second->size());
-            *add_vec = *(jt->second)*scale;
-            add_entries.push_back(channel_t(jt->first, add_vec));
-            ++jt;
-        } else if (jt->first == it->first) {
-            *(it->second) += *(jt->second)*scale;
-            ++it;
-            ++jt;
-        } else if (jt->first > it->first) {
-            ++it;
-        }
+    this->unmap();
+    if (!other->mapped && codes == other->codes && offsets == other->offsets) {
+        // Identical layout: single pass over the value buffer
+        for (int k=0; k<values.size(); ++k) values[k] += scale*other->values[k];
+        return;
     }
-    for (auto it=add_entries.begin(); it!=add_entries.end(); ++it) {
-        dmap.push_back(*it);
+    // Merge into a new buffer holding the union of both channel sets
+    std::vector<code_t> new_codes;
+    std::vector<int> new_offsets(1, 0);
+    std::vector<dtype_t> new_values;
+    new_values.reserve(values.size());
+    int i = 0;
+    int j = 0;
+    while (i < this->size() || j < other->size()) {
+        if (j == other->size() || (i < this->size() && codes[i] < other->code(j))) {
+            new_codes.push_back(codes[i]);
+            new_values.insert(new_values.end(), this->channel(i), this->channel(i)+this->length(i));
+            ++i;
+        } else if (i == this->size() || other->code(j) < codes[i]) {
+            new_codes.push_back(other->code(j));
+            dtype_t *w = other->channel(j);
+            for (int k=0; k<other->length(j); ++k) new_values.push_back(scale*w[k]);
+            ++j;
+        } else {
+            assert(this->length(i) == other->length(j) && "Channel dimensions inconsistent");
+            new_codes.push_back(codes[i]);
+            dtype_t *v = this->channel(i);
+            dtype_t *w = other->channel(j);
+            for (int k=0; k<this->length(i); ++k) new_values.push_back(v[k] + scale*w[k]);
+            ++i;
+            ++j;
+        }
+        new_offsets.push_back(new_values.size());
     }
-    this->sort();
+    codes.swap(new_codes);
+    offsets.swap(new_offsets);
+    values.swap(new_values);
 }
 
 void DMap::addGradients(DMap *other, double scale) {
@@ -159,11 +216,29 @@ void DMap::addGradients(DMap *other, double scale) {
 }
 
 void DMap::sort() {
-    std::sort(dmap.begin(), dmap.end(), 
-        [](DMap::channel_t c1, DMap::channel_t c2) {
-            return c1.first <= c2.first;
+    this->unmap();
+    std::vector<int> order(codes.size());
+    for (int c=0; c<order.size(); ++c) order[c] = c;
+    std::stable_sort(order.begin(), order.end(), 
+        [this](int c1, int c2) {
+            return codes[c1] < codes[c2];
         }
     );
+    bool sorted = true;
+    for (int c=0; c<order.size(); ++c) if (order[c] != c) { sorted = false; break; }
+    if (sorted) return;
+    std::vector<code_t> new_codes;
+    std::vector<int> new_offsets(1, 0);
+    std::vector<dtype_t> new_values;
+    new_values.reserve(values.size());
+    for (int c : order) {
+        new_codes.push_back(codes[c]);
+        new_values.insert(new_values.end(), this->channel(c), this->channel(c)+this->length(c));
+        new_offsets.push_back(new_values.size());
+    }
+    codes.swap(new_codes);
+    offsets.swap(new_offsets);
+    values.swap(new_values);
 }
 
 void DMap::sortGradients() {
@@ -176,8 +251,8 @@ void DMap::sortGradients() {
 
 boost::python::list DMap::listChannels() {
     boost::python::list channel_keys;
-    for (auto it=begin(); it!=end(); ++it) {
-        std::string c12 = ENCODER.decode(it->first);
+    for (int c=0; c<this->size(); ++c) {
+        std::string c12 = ENCODER.decode(this->code(c));
         channel_keys.append(c12);
     }
     return channel_keys;
@@ -189,9 +264,9 @@ double DMap::dotFilter(DMap *other) {
 }
 
 void DMap::multiply(double c) {
-    for (auto it=begin(); it!=end(); ++it) {
-        auto &v = *(it->second);
-        v *= c;
+    this->unmap();
+    for (auto it=values.begin(); it!=values.end(); ++it) {
+        *it *= c;
     }
     for (auto it=pid_gradmap.begin(); it!=pid_gradmap.end(); ++it) {
         (*it)->multiply(c);
@@ -233,6 +308,7 @@ void DMap::adapt(AtomicSpectrum *atomic) {
 
 void DMap::adapt(AtomicSpectrum::map_xnkl_t &map_xnkl) {
     size1 = 0;
+    this->clearChannels();
     for (auto it=map_xnkl.begin(); it!=map_xnkl.end(); ++it) {
         TypeEncoder::code_t e1 = ENCODER.encode(it->first.first);
         TypeEncoder::code_t e2 = ENCODER.encode(it->first.second);
@@ -240,16 +316,14 @@ void DMap::adapt(AtomicSpectrum::map_xnkl_t &map_xnkl) {
         if (e1 > e2) continue; 
         auto coeff = it->second->getCoefficients();
         int length = coeff.size1()*coeff.size2();
-        auto v = new vec_t(length);
+        TypeEncoder::code_t e = ENCODER.encode(it->first.first, it->first.second);
+        dtype_t *v = this->appendChannel(e, length);
         int c = 0;
         for (int i=0; i<coeff.size1(); ++i) {
             for (int j=0; j<coeff.size2(); ++j, ++c) {
-                (*v)(c) = coeff(i,j).real();
+                v[c] = coeff(i,j).real();
             }
         }
-        TypeEncoder::code_t e = ENCODER.encode(it->first.first, it->first.second);
-        channel_t p(e, v);
-        dmap.push_back(p);
         size1 += 1;
         if (size2 < 0) size2 = length;
     }
@@ -284,15 +358,17 @@ void DMap::adaptPidGradients(
 }
 
 void DMap::convolve(int N, int L) {
-    dmap_t out;
+    this->unmap();
+    DMap out;
     size1 = 0;
-    for (auto it=begin(); it!=end(); ++it) {
-        for (auto jt=it; jt!=end(); ++jt) {
-            vec_t &vi = *(it->second);
-            vec_t &vj = *(jt->second);
+    for (int ci=0; ci<this->size(); ++ci) {
+        for (int cj=ci; cj<this->size(); ++cj) {
+            dtype_t *vi = this->channel(ci);
+            dtype_t *vj = this->channel(cj);
             int length = N*N*(L+1);
-            vec_t *vv = new vec_t(length, 0.0);
-            assert(vi.size() == N*(L+1)*(L+1) && "Vector dimension inconsistent with input.");
+            assert(this->length(ci) == N*(L+1)*(L+1) && "Vector dimension inconsistent with input.");
+            TypeEncoder::code_t e = ENCODER.encode(codes[ci], codes[cj]);
+            dtype_t *vv = out.appendChannel(e, length);
             for (int n=0; n<N; ++n) {
                 for (int k=0; k<N; ++k) {
                     for (int l=0; l<L+1; ++l) {
@@ -301,24 +377,19 @@ void DMap::convolve(int N, int L) {
                         for (int m=-l; m<=l; ++m) {
                             int nlm = n*(L+1)*(L+1) + l*l+l+m;
                             int klm = k*(L+1)*(L+1) + l*l+l+m;
-                            vvnkl += vi(nlm)*vj(klm); 
+                            vvnkl += vi[nlm]*vj[klm]; 
                         }
-                        (*vv)(nkl) = vvnkl;
+                        vv[nkl] = vvnkl;
                     }
                 }
             }
-            TypeEncoder::code_t e = ENCODER.encode(it->first, jt->first);
-            channel_t p(e,vv);
-            out.push_back(p);
             size1 += 1;
             size2 = length;
         }
     }
-    for (auto it=dmap.begin(); it!=dmap.end(); ++it) {
-        delete (*it).second;
-    }
-    dmap.clear();
-    dmap = out;
+    codes.swap(out.codes);
+    offsets.swap(out.offsets);
+    values.swap(out.values);
     this->sort();
     double norm = std::sqrt(this->dot(this));
     this->multiply(1./norm);
@@ -327,12 +398,14 @@ void DMap::convolve(int N, int L) {
 void DMap::adaptCoherent(AtomicSpectrum *atomic) {
     auto spec = atomic->getQnlmMap();
     size1 = 0;
+    this->clearChannels();
     for (auto it=spec.begin(); it!=spec.end(); ++it) {
         auto coeff = it->second->getCoefficients();
         int N = coeff.size1();
         int L = int(std::sqrt(coeff.size2())-0.5);
         int length = N*(L+1)*(L+1);
-        auto v = new vec_t(length);
+        TypeEncoder::code_t e = ENCODER.encode(it->first);
+        dtype_t *v = this->appendChannel(e, length);
         double reco = 1./std::sqrt(2.);
         std::complex<double> imco = std::complex<double>(0.,1.)/std::sqrt(2.);
         for (int n=0; n<N; ++n) {
@@ -340,20 +413,17 @@ void DMap::adaptCoherent(AtomicSpectrum *atomic) {
             for (int l=0; l<L+1; ++l) {
                 int lm0 = l*l+l;
                 dtype_t rnl0 = std::real(coeff(n, lm0));
-                (*v)(n0+lm0) = rnl0;
+                v[n0+lm0] = rnl0;
                 for (int m=1; m<=l; ++m) {
                     auto qnlm  = coeff(n, lm0+m);
                     auto qnl_m = coeff(n, lm0-m);
                     dtype_t rnl_m = std::real(imco*(qnl_m - std::pow(-1, m)*qnlm));
                     dtype_t rnlm  = std::real(reco*(qnl_m + std::pow(-1, m)*qnlm));
-                    (*v)(n0+lm0-m) = rnl_m;
-                    (*v)(n0+lm0+m) = rnlm;
+                    v[n0+lm0-m] = rnl_m;
+                    v[n0+lm0+m] = rnlm;
                 }
             }
         }
-        TypeEncoder::code_t e = ENCODER.encode(it->first);
-        channel_t p(e, v);
-        dmap.push_back(p);
         size1 += 1;
         size2 = length;
     }
@@ -364,11 +434,9 @@ void DMap::adaptCoherent(AtomicSpectrum *atomic) {
 DMap *DMap::dotGradLeft(DMap *other, double coeff, double power, DMap *res) {
     DMap tmp = DMap();
     // Scalar dot product
-    vec_t *kv = new vec_t(1);
     dtype_t k = this->dot(other);
-    (*kv)(0) = coeff*std::pow(this->dot(other), power);
     TypeEncoder::code_t e = 0;
-    tmp.dmap.push_back(channel_t(e, kv));
+    *(tmp.appendChannel(e, 1)) = coeff*std::pow(this->dot(other), power);
     // Gradients
     for (auto it=beginGradients(); it!=endGradients(); ++it) {
         DMap *gx = (*it)->x();
@@ -400,9 +468,13 @@ void DMap::registerPython() {
         .add_property("filter", &DMap::getFilter)
         .add_property("size1", &DMap::getSize1)
         .add_property("size2", &DMap::getSize2)
+        .add_property("mapped", &DMap::isMapped)
 	    .add_property("gradients", range<return_value_policy<reference_existing_object> >(
             &DMap::beginGradients, &DMap::endGradients))
         .def("listChannels", &DMap::listChannels)
+        .def("appendChannel", &DMap::appendChannelNumpy)
+        .def("clearChannels", &DMap::clearChannels)
+        .def("sort", &DMap::sort)
         .def("normalize", &DMap::normalize)
         .def("dot", &DMap::dot)
         .def("dotGradLeft", &DMap::dotGradLeft, return_value_policy<reference_existing_object>())
@@ -470,18 +542,9 @@ GradMap::GradMap(int particle_id, std::string filter_type, double gx, double gy,
     DMap *dx = this->get(0);
     DMap *dy = this->get(1);
     DMap *dz = this->get(2);
-    DMap::vec_t *vgx = new DMap::vec_t(1);
-    DMap::vec_t *vgy = new DMap::vec_t(1);
-    DMap::vec_t *vgz = new DMap::vec_t(1);
-    (*vgx)(0) = gx;
-    (*vgy)(0) = gy;
-    (*vgz)(0) = gz;
-    DMap::channel_t px(0, vgx);
-    DMap::channel_t py(0, vgy);
-    DMap::channel_t pz(0, vgz);
-    dx->dmap.push_back(px);
-    dy->dmap.push_back(py);
-    dz->dmap.push_back(pz);
+    *(dx->appendChannel(0, 1)) = gx;
+    *(dy->appendChannel(0, 1)) = gy;
+    *(dz->appendChannel(0, 1)) = gz;
 }
 
 void GradMap::adapt(AtomicSpectrum::map_xnkl_t &map_xnkl) {
@@ -497,24 +560,18 @@ void GradMap::adapt(AtomicSpectrum::map_xnkl_t &map_xnkl) {
         auto coeff_y = it->second->getCoefficientsGradY();
         auto coeff_z = it->second->getCoefficientsGradZ();
         int length = coeff_x.size1()*coeff_x.size2();
-        auto vx = new DMap::vec_t(length);
-        auto vy = new DMap::vec_t(length);
-        auto vz = new DMap::vec_t(length);
+        TypeEncoder::code_t e = ENCODER.encode(it->first.first, it->first.second);
+        DMap::dtype_t *vx = dx->appendChannel(e, length);
+        DMap::dtype_t *vy = dy->appendChannel(e, length);
+        DMap::dtype_t *vz = dz->appendChannel(e, length);
         int c = 0;
         for (int i=0; i<coeff_x.size1(); ++i) {
             for (int j=0; j<coeff_x.size2(); ++j, ++c) {
-                (*vx)(c) = coeff_x(i,j).real();
-                (*vy)(c) = coeff_y(i,j).real();
-                (*vz)(c) = coeff_z(i,j).real();
+                vx[c] = coeff_x(i,j).real();
+                vy[c] = coeff_y(i,j).real();
+                vz[c] = coeff_z(i,j).real();
             }
         }
-        TypeEncoder::code_t e = ENCODER.encode(it->first.first, it->first.second);
-        DMap::channel_t px(e, vx);
-        DMap::channel_t py(e, vy);
-        DMap::channel_t pz(e, vz);
-        dx->dmap.push_back(px);
-        dy->dmap.push_back(py);
-        dz->dmap.push_back(pz);
     }
     dx->sort();
     dy->sort();
@@ -534,15 +591,15 @@ void GradMap::registerPython() {
         .def("getZ", &GradMap::z, return_value_policy<reference_existing_object>());
 }
 
-DMapMatrix::DMapMatrix() : is_view(false) {
+DMapMatrix::DMapMatrix() : is_view(false), packed(false) {
     ;
 }
 
-DMapMatrix::DMapMatrix(std::string archfile) : is_view(false) {
+DMapMatrix::DMapMatrix(std::string archfile) : is_view(false), packed(false) {
     this->load(archfile);
 }
 
-DMapMatrix::DMapMatrix(bool set_as_view) : is_view(set_as_view) {
+DMapMatrix::DMapMatrix(bool set_as_view) : is_view(set_as_view), packed(false) {
     ;
 }
 
@@ -551,6 +608,7 @@ DMapMatrix::~DMapMatrix() {
 }
 
 void DMapMatrix::clear() {
+    this->clearPacked();
     if (!is_view) {
         for (auto it=dmm.begin(); it!=dmm.end(); ++it) delete (*it);
     }
@@ -579,12 +637,25 @@ DMapMatrix *DMapMatrix::getView(std::string filter) {
 }
 
 void DMapMatrix::append(DMap *dmap_arg) {
+    this->clearPacked();
     DMap *new_dmap = new DMap(dmap_arg->filter);
-    new_dmap->dmap = dmap_arg->dmap;
+    for (int c=0; c<dmap_arg->size(); ++c) {
+        DMap::dtype_t *v = dmap_arg->channel(c);
+        std::copy(v, v+dmap_arg->length(c), 
+            new_dmap->appendChannel(dmap_arg->code(c), dmap_arg->length(c)));
+    }
+    new_dmap->size1 = dmap_arg->size1;
+    new_dmap->size2 = dmap_arg->size2;
     dmm.push_back(new_dmap);
 }
 
+void DMapMatrix::adopt(DMap *dmap_arg) {
+    this->clearPacked();
+    dmm.push_back(dmap_arg);
+}
+
 void DMapMatrix::append(Spectrum *spectrum) {
+    this->clearPacked();
     for (auto it=spectrum->beginAtomic(); it!=spectrum->endAtomic(); ++it) {
         DMap *new_dmap = new DMap();
         new_dmap->adapt(*it);
@@ -593,6 +664,7 @@ void DMapMatrix::append(Spectrum *spectrum) {
 }
 
 void DMapMatrix::appendCoherent(Spectrum *spectrum) {
+    this->clearPacked();
     for (auto it=spectrum->beginAtomic(); it!=spectrum->endAtomic(); ++it) {
         DMap *new_dmap = new DMap();
         new_dmap->adaptCoherent(*it);
@@ -611,12 +683,40 @@ void DMapMatrix::sum() {
 }
 
 void DMapMatrix::normalize() {
+    this->clearPacked();
     for (auto it=begin(); it!=end(); ++it) {
         (*it)->normalize();
     }
 }
 
+static void fnv1a(uint64_t &h, const void *data, std::size_t n_bytes) {
+    const unsigned char *bytes = static_cast<const unsigned char*>(data);
+    for (std::size_t b=0; b<n_bytes; ++b) {
+        h ^= bytes[b];
+        h *= 1099511628211ULL;
+    }
+}
+
+uint64_t DMapMatrix::hash() {
+    uint64_t h = 14695981039346656037ULL;
+    for (auto it=begin(); it!=end(); ++it) {
+        DMap *dmap = *it;
+        fnv1a(h, dmap->filter.data(), dmap->filter.size());
+        int n_channels = dmap->size();
+        fnv1a(h, &n_channels, sizeof(int));
+        for (int c=0; c<n_channels; ++c) {
+            DMap::code_t code = dmap->code(c);
+            int length = dmap->length(c);
+            fnv1a(h, &code, sizeof(DMap::code_t));
+            fnv1a(h, &length, sizeof(int));
+            fnv1a(h, dmap->channel(c), length*sizeof(DMap::dtype_t));
+        }
+    }
+    return h;
+}
+
 void DMapMatrix::convolve(int N, int L) {
+    this->clearPacked();
     for (auto it=begin(); it!=end(); ++it) {
         (*it)->convolve(N, L);
     }
@@ -631,14 +731,86 @@ void DMapMatrix::slicePython(bpy::list &py_idcs) {
 }
 
 void DMapMatrix::slice(std::vector<int> &idcs) {
+    this->clearPacked();
     for (auto it=begin(); it!=end(); ++it) {
         (*it)->slice(idcs);
     }
 }
 
+void DMapMatrix::pack() {
+    this->clearPacked();
+    std::map<TypeEncoder::code_t, std::vector<std::pair<int, int>>> channels;
+    int i = 0;
+    for (auto it=begin(); it!=end(); ++it, ++i) {
+        for (int c=0; c<(*it)->size(); ++c) {
+            channels[(*it)->code(c)].push_back(std::pair<int, int>(i, c));
+        }
+    }
+    for (auto ct=channels.begin(); ct!=channels.end(); ++ct) {
+        int dim = dmm[ct->second[0].first]->length(ct->second[0].second);
+        DMapBlock *block = new DMapBlock();
+        block->code = ct->first;
+        block->X.resize(ct->second.size(), dim, false);
+        for (int r=0; r<ct->second.size(); ++r) {
+            DMap *row = dmm[ct->second[r].first];
+            int c = ct->second[r].second;
+            if (row->length(c) != dim) {
+                delete block;
+                this->clearPacked();
+                throw soap::base::SanityCheckFailed("Inconsistent channel dimensions");
+            }
+            block->rows.push_back(ct->second[r].first);
+            DMap::dtype_t *v = row->channel(c);
+            for (int k=0; k<dim; ++k) block->X(r,k) = v[k];
+        }
+        blocks.push_back(block);
+    }
+    packed = true;
+}
+
+void DMapMatrix::clearPacked() {
+    for (auto it=blocks.begin(); it!=blocks.end(); ++it) delete *it;
+    blocks.clear();
+    packed = false;
+}
+
+void DMapMatrix::dotPacked(DMapMatrix *other, matrix_t &output) {
+    assert(packed && other->packed && "Dot product requires packed matrices");
+    for (int i=0; i<output.size1(); ++i)
+        for (int j=0; j<output.size2(); ++j)
+            output(i,j) = 0.0;
+    matrix_t C;
+    auto it = blocks.begin();
+    auto jt = other->blocks.begin();
+    while (it != blocks.end() && jt != other->blocks.end()) {
+        if ((*it)->code < (*jt)->code) ++it;
+        else if ((*jt)->code < (*it)->code) ++jt;
+        else {
+            DMapBlock *a = *it;
+            DMapBlock *b = *jt;
+            if (a->rows.size() == this->rows() && b->rows.size() == other->rows()) {
+                // Channel present in all rows: accumulate directly
+                soap::linalg::linalg_matrix_dot(a->X, b->X, output, 1.0, 1.0, false, true);
+            } else {
+                C.resize(a->rows.size(), b->rows.size(), false);
+                soap::linalg::linalg_matrix_dot(a->X, b->X, C, 1.0, 0.0, false, true);
+                for (int r=0; r<a->rows.size(); ++r)
+                    for (int s=0; s<b->rows.size(); ++s)
+                        output(a->rows[r], b->rows[s]) += C(r,s);
+            }
+            ++it;
+            ++jt;
+        }
+    }
+}
+
 void DMapMatrix::dot(DMapMatrix *other, matrix_t &output) {
     assert(output.size1() == this->rows() && output.size2() == other->rows() &&
         "Output matrix dimensions incompatible with input"); 
+    if (packed && other->packed) {
+        this->dotPacked(other, output);
+        return;
+    }
     int i = 0;
     for (auto it=begin(); it!=end(); ++it, ++i) {
         int j = 0;
@@ -651,6 +823,17 @@ void DMapMatrix::dot(DMapMatrix *other, matrix_t &output) {
 void DMapMatrix::dotFilter(DMapMatrix *other, matrix_t &output) {
     assert(output.size1() == this->rows() && output.size2() == other->rows() &&
         "Output matrix dimensions incompatible with input"); 
+    if (packed && other->packed) {
+        this->dotPacked(other, output);
+        int i = 0;
+        for (auto it=begin(); it!=end(); ++it, ++i) {
+            int j = 0;
+            for (auto jt=other->begin(); jt!=other->end(); ++jt, ++j) {
+                if ((*it)->filter != (*jt)->filter) output(i,j) = 0.0;
+            }
+        }
+        return;
+    }
     int i = 0;
     for (auto it=begin(); it!=end(); ++it, ++i) {
         int j = 0;
@@ -664,7 +847,15 @@ void dmm_inner_product(DMapMatrix &AX, DMapMatrix &BX, double power,
         bool filter, DMapMatrix::matrix_t &output) {
     assert(output.size1() == AX.rows() && output.size2() == BX.rows() &&
         "Output matrix dimensions incompatible with input"); 
-    if (filter) {
+    if (AX.isPacked() && BX.isPacked()) {
+        if (filter) AX.dotFilter(&BX, output);
+        else AX.dot(&BX, output);
+        if (power != 1.) {
+            for (int i=0; i<output.size1(); ++i)
+                for (int j=0; j<output.size2(); ++j)
+                    output(i,j) = std::pow(output(i,j), power);
+        }
+    } else if (filter) {
         int i = 0;
         for (auto it=AX.begin(); it!=AX.end(); ++it, ++i) {
             int j = 0;
@@ -705,6 +896,7 @@ void DMapMatrix::save(std::string archfile) {
 }
 
 void DMapMatrix::load(std::string archfile) {
+    this->clearPacked();
 	std::ifstream ifs(archfile.c_str());
 	boost::archive::binary_iarchive arch(ifs);
 	arch >> (*this);
@@ -719,6 +911,7 @@ std::string DMapMatrix::dumps() {
 }
 
 void DMapMatrix::loads(std::string pstr) {
+    this->clearPacked();
     std::stringstream ss;
     ss << pstr;
     boost::archive::binary_iarchive arch(ss);
@@ -749,21 +942,25 @@ void DMapMatrix::registerPython() {
         .def("convolve", &DMapMatrix::convolve)
         .def("dot", &DMapMatrix::dotNumpy)
         .def("dotFilter", &DMapMatrix::dotFilterNumpy)
+        .def("pack", &DMapMatrix::pack)
+        .def("unpack", &DMapMatrix::clearPacked)
+        .add_property("packed", &DMapMatrix::isPacked)
+        .def("hash", &DMapMatrix::hash)
         .def("dumps", &DMapMatrix::dumps)
         .def("loads", &DMapMatrix::loads)
         .def("load", &DMapMatrix::load)
         .def("save", &DMapMatrix::save);
 }
 
-DMapMatrixSet::DMapMatrixSet() : is_view(false) {
+DMapMatrixSet::DMapMatrixSet() : is_view(false), indexed(false) {
     ;
 }
 
-DMapMatrixSet::DMapMatrixSet(bool set_as_view) : is_view(set_as_view) {
+DMapMatrixSet::DMapMatrixSet(bool set_as_view) : is_view(set_as_view), indexed(false) {
     ;
 }
 
-DMapMatrixSet::DMapMatrixSet(std::string archfile) : is_view(false) {
+DMapMatrixSet::DMapMatrixSet(std::string archfile) : is_view(false), indexed(false) {
     this->load(archfile);
 }
 
@@ -774,15 +971,18 @@ DMapMatrixSet::~DMapMatrixSet() {
     dset.clear();
     for (auto it=views.begin(); it!=views.end(); ++it) delete *it;
     views.clear();
+    archives.clear();
 }
 
 void DMapMatrixSet::clear() {
+    this->clearChannelIndex();
     if (!is_view) {
         for (auto it=begin(); it!=end(); ++it) delete *it;
     }
     dset.clear();
     for (auto it=views.begin(); it!=views.end(); ++it) delete *it;
     views.clear();
+    archives.clear();
 }
 
 DMapMatrixSet *DMapMatrixSet::getView(boost::python::list idcs) {
@@ -793,19 +993,29 @@ DMapMatrixSet *DMapMatrixSet::getView(boost::python::list idcs) {
             "Index " + lexical_cast<std::string>(idx, ""));
         view->append(dset[idx]); 
     }
+    view->archives = archives;
     return view;
 }
 
 void DMapMatrixSet::append(DMapMatrix *dmap) {
+    this->clearChannelIndex();
     dset.push_back(dmap);
 }
 
+void DMapMatrixSet::pack() {
+    for (auto it=begin(); it!=end(); ++it) {
+        if (!(*it)->isPacked()) (*it)->pack();
+    }
+}
+
 void DMapMatrixSet::extend(DMapMatrixSet *other) {
     if (this->is_view) throw soap::base::SanityCheckFailed(
         "Extending matrix view not permitted.");
+    this->clearChannelIndex();
     for (auto it=other->begin(); it!=other->end(); ++it) {
         dset.push_back(*it);
     }
+    archives.insert(archives.end(), other->archives.begin(), other->archives.end());
     other->is_view = true;
 }
 
@@ -817,12 +1027,175 @@ void DMapMatrixSet::save(std::string archfile) {
 }
 
 void DMapMatrixSet::load(std::string archfile) {
+    char magic[8] = { 0 };
+    std::ifstream probe(archfile.c_str(), std::ios::binary);
+    probe.read(magic, 8);
+    if (probe.gcount() == 8 && DMapArchiveHeader::checkMagic(magic)) {
+        probe.close();
+        this->loadMapped(archfile);
+        return;
+    }
+    probe.close();
+    this->clearChannelIndex();
 	std::ifstream ifs(archfile.c_str());
 	boost::archive::binary_iarchive arch(ifs);
 	arch >> (*this);
 	return;
 }
 
+static const char DMAP_ARCHIVE_MAGIC[8] = { 'S', 'O', 'A', 'P', 'D', 'M', 'S', '\0' };
+
+bool DMapArchiveHeader::checkMagic(const char *data) {
+    return std::memcmp(data, DMAP_ARCHIVE_MAGIC, 8) == 0;
+}
+
+void DMapArchiveHeader::setMagic() {
+    std::memcpy(magic, DMAP_ARCHIVE_MAGIC, 8);
+}
+
+static uint64_t archive_align(uint64_t offset) {
+    return (offset + 63)/64*64;
+}
+
+template<typename T>
+static void archive_write(std::ofstream &ofs, uint64_t offset, const std::vector<T> &data) {
+    ofs.seekp(offset);
+    if (data.size() > 0) ofs.write((const char*) &data[0], data.size()*sizeof(T));
+}
+
+void DMapMatrixSet::saveMapped(std::string archfile) {
+    DMapArchiveHeader h;
+    std::memset(&h, 0, sizeof(h));
+    h.setMagic();
+    h.version = DMapArchiveHeader::VERSION;
+    h.value_bytes = sizeof(DMap::dtype_t);
+    h.code_bytes = sizeof(DMap::code_t);
+    // Tables
+    std::vector<uint64_t> matrix_rows(1, 0);
+    std::vector<uint64_t> row_channels(1, 0);
+    std::vector<uint64_t> row_filters(1, 0);
+    std::vector<int32_t> row_sizes;
+    std::vector<char> filters;
+    std::vector<DMap::code_t> codes;
+    std::vector<uint64_t> channel_offsets(1, 0);
+    for (auto it=begin(); it!=end(); ++it) {
+        for (auto jt=(*it)->begin(); jt!=(*it)->end(); ++jt) {
+            DMap *row = *jt;
+            if (row->beginGradients() != row->endGradients()) throw soap::base::NotImplemented(
+                "Gradients in mapped archive");
+            for (int c=0; c<row->size(); ++c) {
+                codes.push_back(row->code(c));
+                channel_offsets.push_back(channel_offsets.back()+row->length(c));
+            }
+            row_channels.push_back(codes.size());
+            filters.insert(filters.end(), row->filter.begin(), row->filter.end());
+            row_filters.push_back(filters.size());
+            row_sizes.push_back(row->size1);
+            row_sizes.push_back(row->size2);
+        }
+        matrix_rows.push_back(row_channels.size()-1);
+    }
+    h.n_matrices = this->size();
+    h.n_rows = row_channels.size()-1;
+    h.n_channels = codes.size();
+    h.n_values = channel_offsets.back();
+    h.n_filter_bytes = filters.size();
+    h.off_matrix_rows = archive_align(sizeof(h));
+    h.off_row_channels = archive_align(h.off_matrix_rows + matrix_rows.size()*sizeof(uint64_t));
+    h.off_row_filters = archive_align(h.off_row_channels + row_channels.size()*sizeof(uint64_t));
+    h.off_row_sizes = archive_align(h.off_row_filters + row_filters.size()*sizeof(uint64_t));
+    h.off_filters = archive_align(h.off_row_sizes + row_sizes.size()*sizeof(int32_t));
+    h.off_codes = archive_align(h.off_filters + filters.size());
+    h.off_channel_offsets = archive_align(h.off_codes + codes.size()*sizeof(DMap::code_t));
+    h.off_values = archive_align(h.off_channel_offsets + channel_offsets.size()*sizeof(uint64_t));
+    // Write
+    std::ofstream ofs(archfile.c_str(), std::ios::binary | std::ios::trunc);
+    if (!ofs) throw soap::base::IOError("Bad file handle: " + archfile);
+    ofs.write((const char*) &h, sizeof(h));
+    archive_write(ofs, h.off_matrix_rows, matrix_rows);
+    archive_write(ofs, h.off_row_channels, row_channels);
+    archive_write(ofs, h.off_row_filters, row_filters);
+    archive_write(ofs, h.off_row_sizes, row_sizes);
+    archive_write(ofs, h.off_filters, filters);
+    archive_write(ofs, h.off_codes, codes);
+    archive_write(ofs, h.off_channel_offsets, channel_offsets);
+    // Values are streamed row by row
+    ofs.seekp(h.off_values);
+    for (auto it=begin(); it!=end(); ++it) {
+        for (auto jt=(*it)->begin(); jt!=(*it)->end(); ++jt) {
+            for (int c=0; c<(*jt)->size(); ++c) {
+                ofs.write((const char*) (*jt)->channel(c), (*jt)->length(c)*sizeof(DMap::dtype_t));
+            }
+        }
+    }
+    if (!ofs) throw soap::base::IOError("Failed writing " + archfile);
+    ofs.close();
+}
+
+void DMapMatrixSet::loadMapped(std::string archfile) {
+    this->clear();
+    std::shared_ptr<MappedArchive> archive(new MappedArchive(archfile));
+    DMapArchiveHeader *h = archive->header();
+    uint64_t *matrix_rows = archive->section<uint64_t>(h->off_matrix_rows);
+    uint64_t *row_channels = archive->section<uint64_t>(h->off_row_channels);
+    uint64_t *row_filters = archive->section<uint64_t>(h->off_row_filters);
+    int32_t *row_sizes = archive->section<int32_t>(h->off_row_sizes);
+    char *filters = archive->section<char>(h->off_filters);
+    DMap::code_t *codes = archive->section<DMap::code_t>(h->off_codes);
+    uint64_t *channel_offsets = archive->section<uint64_t>(h->off_channel_offsets);
+    DMap::dtype_t *values = archive->section<DMap::dtype_t>(h->off_values);
+    // Only the (small) row tables are read here, channel values 
+    // are paged in once accessed
+    for (uint64_t m=0; m<h->n_matrices; ++m) {
+        DMapMatrix *dmm = new DMapMatrix();
+        for (uint64_t r=matrix_rows[m]; r<matrix_rows[m+1]; ++r) {
+            DMap *row = new DMap(std::string(
+                filters+row_filters[r], filters+row_filters[r+1]));
+            uint64_t c0 = row_channels[r];
+            row->map(codes+c0, channel_offsets+c0, values, row_channels[r+1]-c0);
+            row->size1 = row_sizes[2*r];
+            row->size2 = row_sizes[2*r+1];
+            dmm->adopt(row);
+        }
+        dset.push_back(dmm);
+    }
+    archives.push_back(archive);
+}
+
+MappedArchive::MappedArchive(std::string archfile_arg) 
+        : archfile(archfile_arg), data(NULL), length(0) {
+    int fd = open(archfile.c_str(), O_RDONLY);
+    if (fd < 0) throw soap::base::IOError("Bad file handle: " + archfile);
+    struct stat st;
+    if (fstat(fd, &st) != 0 || st.st_size < sizeof(DMapArchiveHeader)) {
+        close(fd);
+        throw soap::base::IOError("Not a mapped archive: " + archfile);
+    }
+    length = st.st_size;
+    // Private mapping: pages are shared with the page cache until written to
+    void *ptr = mmap(NULL, length, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (ptr == MAP_FAILED) throw soap::base::IOError("Failed to map " + archfile);
+    data = (char*) ptr;
+    DMapArchiveHeader *h = this->header();
+    std::string error = "";
+    if (!DMapArchiveHeader::checkMagic(h->magic)) error = "Not a mapped archive: ";
+    else if (h->version != DMapArchiveHeader::VERSION) error = "Unsupported archive version: ";
+    else if (h->value_bytes != sizeof(DMap::dtype_t) || h->code_bytes != sizeof(DMap::code_t)) 
+        error = "Incompatible value or code type: ";
+    else if (h->off_values + h->n_values*h->value_bytes > length) error = "Truncated archive: ";
+    if (error != "") {
+        munmap(data, length);
+        data = NULL;
+        throw soap::base::IOError(error + archfile);
+    }
+}
+
+MappedArchive::~MappedArchive() {
+    if (data != NULL) munmap(data, length);
+    data = NULL;
+}
+
 void DMapMatrixSet::slicePython(bpy::list &py_idcs) {
     std::vector<int> idcs;
     for (int i=0; i<bpy::len(py_idcs); ++i) {
@@ -832,11 +1205,84 @@ void DMapMatrixSet::slicePython(bpy::list &py_idcs) {
 }
 
 void DMapMatrixSet::slice(std::vector<int> &idcs) {
+    this->clearChannelIndex();
     for (auto it=begin(); it!=end(); ++it) {
         (*it)->slice(idcs);
     }
 }
 
+void DMapMatrixSet::buildChannelIndex() {
+    this->clearChannelIndex();
+    int i = 0;
+    for (auto it=begin(); it!=end(); ++it, ++i) {
+        std::vector<TypeEncoder::code_t> channels;
+        int a = 0;
+        for (auto jt=(*it)->begin(); jt!=(*it)->end(); ++jt, ++a) {
+            for (int c=0; c<(*jt)->size(); ++c) {
+                TypeEncoder::code_t code = (*jt)->code(c);
+                channel_index[code].push_back(entry_t(i, a));
+                channels.push_back(code);
+            }
+        }
+        std::sort(channels.begin(), channels.end());
+        channels.erase(std::unique(channels.begin(), channels.end()), channels.end());
+        structure_channels.push_back(channels);
+    }
+    indexed = true;
+}
+
+void DMapMatrixSet::clearChannelIndex() {
+    channel_index.clear();
+    structure_channels.clear();
+    indexed = false;
+}
+
+bool DMapMatrixSet::overlaps(int i, DMapMatrixSet *other, int j) {
+    // Conservative if either set is not indexed
+    if (!indexed || !other->indexed) return true;
+    auto &ci = structure_channels[i];
+    auto &cj = other->structure_channels[j];
+    auto it = ci.begin();
+    auto jt = cj.begin();
+    while (it != ci.end() && jt != cj.end()) {
+        if (*it < *jt) ++it;
+        else if (*jt < *it) ++jt;
+        else return true;
+    }
+    return false;
+}
+
+bpy::dict DMapMatrixSet::getChannelIndexPython() {
+    if (!indexed) this->buildChannelIndex();
+    bpy::dict index;
+    for (auto it=channel_index.begin(); it!=channel_index.end(); ++it) {
+        bpy::list entries;
+        for (auto jt=it->second.begin(); jt!=it->second.end(); ++jt) {
+            entries.append(bpy::make_tuple(jt->first, jt->second));
+        }
+        index[ENCODER.decode(it->first)] = entries;
+    }
+    return index;
+}
+
+bpy::list DMapMatrixSet::getOverlapsPython(DMapMatrix *dmm) {
+    // Structures that share at least one channel with dmm
+    if (!indexed) this->buildChannelIndex();
+    std::vector<bool> hit(this->size(), false);
+    for (auto it=dmm->begin(); it!=dmm->end(); ++it) {
+        for (int c=0; c<(*it)->size(); ++c) {
+            auto ct = channel_index.find((*it)->code(c));
+            if (ct == channel_index.end()) continue;
+            for (auto et=ct->second.begin(); et!=ct->second.end(); ++et) {
+                hit[et->first] = true;
+            }
+        }
+    }
+    bpy::list idcs;
+    for (int i=0; i<hit.size(); ++i) if (hit[i]) idcs.append(i);
+    return idcs;
+}
+
 void DMapMatrixSet::registerPython() {
     using namespace boost::python;
     class_<DMapMatrixSet, DMapMatrixSet*>("DMapMatrixSet", init<>())
@@ -845,11 +1291,20 @@ void DMapMatrixSet::registerPython() {
         .def("__getitem__", &DMapMatrixSet::get, return_value_policy<reference_existing_object>())
         .def("__getitem__", &DMapMatrixSet::getView, return_value_policy<reference_existing_object>())
         .add_property("size", &DMapMatrixSet::size)
+        .add_property("mapped", &DMapMatrixSet::isMapped)
         .def("save", &DMapMatrixSet::save)
         .def("load", &DMapMatrixSet::load)
+        .def("saveMapped", &DMapMatrixSet::saveMapped)
+        .def("loadMapped", &DMapMatrixSet::loadMapped)
+        .def("buildChannelIndex", &DMapMatrixSet::buildChannelIndex)
+        .def("clearChannelIndex", &DMapMatrixSet::clearChannelIndex)
+        .add_property("indexed", &DMapMatrixSet::hasChannelIndex)
+        .def("getChannelIndex", &DMapMatrixSet::getChannelIndexPython)
+        .def("getOverlaps", &DMapMatrixSet::getOverlapsPython)
         .def("slice", &DMapMatrixSet::slicePython)
         .def("clear", &DMapMatrixSet::clear)
         .def("append", &DMapMatrixSet::append)
+        .def("pack", &DMapMatrixSet::pack)
         .def("extend", &DMapMatrixSet::extend);
 }
 
@@ -1105,7 +1560,7 @@ TypeEncoder::code_t TypeEncoder::encode(std::string type1, std::string type2) {
     auto it = encoder.find(type1);
     auto jt = encoder.find(type2);
     if (it == end() || jt == end()) throw soap::base::OutOfRange(type1+":"+type2);
-    return encoder[type1]*size() + encoder[type2];
+    return it->second*size() + jt->second;
 }
 
 TypeEncoder::code_t TypeEncoder::encode(code_t code1, code_t code2) {
@@ -2,9 +2,13 @@
 #define _SOAP_DMAP_HPP
 
 #include <assert.h>
+#include <stdint.h>
+#include <memory>
+#include <unordered_map>
 #include <boost/serialization/vector.hpp>
 #include <boost/serialization/map.hpp>
 #include <boost/serialization/list.hpp>
+#include <boost/serialization/version.hpp>
 
 #include "soap/types.hpp"
 #include "soap/globals.hpp"
@@ -22,7 +26,7 @@ class TypeEncoder
 {
   public:
     typedef unsigned short int code_t;
-    typedef std::map<std::string, code_t> encoder_t;
+    typedef std::unordered_map<std::string, code_t> encoder_t;
     typedef std::vector<std::string> order_t;
     TypeEncoder();
     ~TypeEncoder();
@@ -73,21 +77,43 @@ struct DMap
     typedef ub::vector<dtype_t> vec_t;
     typedef ub::matrix<dtype_t> matrix_t;
     //typedef Eigen::VectorXf vec_t;
-    typedef std::pair<TypeEncoder::code_t, vec_t*> channel_t;
+    typedef TypeEncoder::code_t code_t;
+    // Legacy layout with one heap-allocated vector per channel,
+    // only used to read archives written before the arena layout
+    typedef std::pair<code_t, vec_t*> channel_t;
     typedef std::vector<channel_t> dmap_t;
     typedef std::vector<GradMap*> pid_gradmap_t;
     DMap();
     DMap(std::string filter_type);
     ~DMap();
-    dmap_t::iterator begin() { return dmap.begin(); }
-    dmap_t::iterator end() { return dmap.end(); }
     pid_gradmap_t::iterator beginGradients() { return pid_gradmap.begin(); }
     pid_gradmap_t::iterator endGradients() { return pid_gradmap.end(); }
-    int size() { return dmap.size(); }
+    // Channel c has code codes[c] and occupies values[offsets[c]:offsets[c+1]],
+    // unless the channels live in a memory-mapped archive (see map).
+    // The three arrays are not merged into a single buffer: they hold 
+    // different types and grow at different rates (one code and offset, 
+    // but length values per channel), such that appending to a shared 
+    // buffer would shift the values with every channel. Three allocations 
+    // per DMap (rather than one per channel) also keep the version-1 
+    // archive layout and match the arrays of the mapped archives one-to-one.
+    int size() { return mapped ? mapped_size : codes.size(); }
+    code_t code(int c) { return mapped ? mapped_codes[c] : codes[c]; }
+    int length(int c) { return mapped ? 
+        int(mapped_offsets[c+1]-mapped_offsets[c]) : offsets[c+1]-offsets[c]; }
+    dtype_t *channel(int c) { return mapped ? 
+        mapped_values+mapped_offsets[c] : &values[offsets[c]]; }
+    dtype_t *appendChannel(code_t code, int length);
+    void appendChannelNumpy(code_t code, bpy::object &np_v, std::string np_dtype);
+    void clearChannels();
+    // Mapped channels are read-only views into an archive; 
+    // any modification first copies them into owned storage (unmap)
+    void map(const code_t *codes, const uint64_t *offsets, dtype_t *values, int n);
+    void unmap();
+    bool isMapped() { return mapped; }
     int getSize1() { return size1; }
     int getSize2() { return size2; }
     bpy::object val(int chidx, std::string np_dtype);
-    dtype_t val() { return (*(dmap[0].second))(0); }
+    dtype_t val() { return *(this->channel(0)); }
     void sort();
     void sortGradients();
     void multiply(double c);
@@ -112,7 +138,14 @@ struct DMap
         bool comoving_center=true);
     void adaptCoherent(AtomicSpectrum *spectrum);
     std::string getFilter() { return filter; }
-    dmap_t dmap;
+    std::vector<code_t> codes;
+    std::vector<int> offsets;
+    std::vector<dtype_t> values;
+    bool mapped;
+    int mapped_size;
+    const code_t *mapped_codes;
+    const uint64_t *mapped_offsets;
+    dtype_t *mapped_values;
     pid_gradmap_t pid_gradmap;
     std::string filter;
     int size1;
@@ -120,7 +153,36 @@ struct DMap
     static void registerPython();
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
-        arch & dmap;
+        if (version < 1) {
+            dmap_t dmap;
+            arch & dmap;
+            this->clearChannels();
+            for (auto it=dmap.begin(); it!=dmap.end(); ++it) {
+                int n = it->second->size();
+                dtype_t *v = this->appendChannel(it->first, n);
+                for (int i=0; i<n; ++i) v[i] = (*(it->second))(i);
+                delete it->second;
+            }
+        } else if (Archive::is_saving::value && mapped) {
+            // Write the mapped channels in the owned layout, one DMap at a
+            // time, without unmapping (and thus copying) the whole set
+            std::vector<code_t> mapped_codes_out(mapped_codes, mapped_codes+mapped_size);
+            std::vector<int> mapped_offsets_out(1, 0);
+            std::vector<dtype_t> mapped_values_out;
+            for (int c=0; c<mapped_size; ++c) {
+                mapped_values_out.insert(mapped_values_out.end(),
+                    this->channel(c), this->channel(c)+this->length(c));
+                mapped_offsets_out.push_back(mapped_values_out.size());
+            }
+            arch & mapped_codes_out;
+            arch & mapped_offsets_out;
+            arch & mapped_values_out;
+        } else {
+            this->unmap();
+            arch & codes;
+            arch & offsets;
+            arch & values;
+        }
         arch & pid_gradmap;
         arch & filter;
         arch & size1;
@@ -159,6 +221,15 @@ struct GradMap
     }
 };
 
+struct DMapBlock
+{
+    // Dense copy of one channel across the rows of a DMapMatrix
+    typedef ub::matrix<double> matrix_t;
+    TypeEncoder::code_t code;
+    std::vector<int> rows; // Row indices (in the DMapMatrix) that carry this channel
+    matrix_t X;            // Channel vectors of these rows, (rows.size() x channel dim)
+};
+
 class DMapMatrix
 {
   public:
@@ -168,6 +239,7 @@ class DMapMatrix
     typedef ub::vector<dtype_t> vec_t;
     typedef std::vector<DMap*> dmm_t;
     typedef std::map<std::string, DMapMatrix*> views_t;
+    typedef std::vector<DMapBlock*> blocks_t;
     DMapMatrix();
     DMapMatrix(std::string archfile);
     ~DMapMatrix();
@@ -177,11 +249,22 @@ class DMapMatrix
     void convolve(int N, int L);
     void dot(DMapMatrix *other, matrix_t &output);
     void dotFilter(DMapMatrix *other, matrix_t &output);
+    void dotPacked(DMapMatrix *other, matrix_t &output);
+    // Packing copies the channels into dense per-channel blocks, such that
+    // dot products reduce to one GEMM per shared channel. Modifying the
+    // matrix drops the packed blocks; modifying rows in place requires a repack.
+    void pack();
+    void clearPacked();
+    bool isPacked() { return packed; }
+    // Content hash over filters, channel codes and values, e.g., to
+    // cache per-structure quantities independently of object identity
+    uint64_t hash();
     bpy::object dotNumpy(DMapMatrix *other, std::string np_dtype);
     bpy::object dotFilterNumpy(DMapMatrix *other, std::string np_dtype);
     void slicePython(bpy::list &py_idcs);
     void slice(std::vector<int> &idcs);
     void append(DMap *dmap);
+    void adopt(DMap *dmap); // Append without copying, taking ownership
     void append(Spectrum *spectrum);
     void appendCoherent(Spectrum *spectrum);
     void save(std::string archfile);
@@ -206,6 +289,8 @@ class DMapMatrix
     dmm_t dmm;
     views_t views;
     bool is_view;
+    blocks_t blocks; // Transient, not serialized
+    bool packed;
 };
 
 void dmm_inner_product(
@@ -215,11 +300,57 @@ void dmm_inner_product(
     bool filter,
     DMapMatrix::matrix_t &output);
 
+struct DMapArchiveHeader
+{
+    // Flat archive layout: the header is followed by 64-byte aligned
+    // sections, located via the off_* byte offsets below. Row, channel
+    // and value offsets are global, such that matrix m comprises rows
+    // matrix_rows[m]:matrix_rows[m+1], row r comprises channels
+    // row_channels[r]:row_channels[r+1], and channel c occupies values
+    // channel_offsets[c]:channel_offsets[c+1].
+    char magic[8];
+    uint32_t version;
+    uint32_t value_bytes;
+    uint32_t code_bytes;
+    uint32_t reserved;
+    uint64_t n_matrices;
+    uint64_t n_rows;
+    uint64_t n_channels;
+    uint64_t n_values;
+    uint64_t n_filter_bytes;
+    uint64_t off_matrix_rows;     // uint64[n_matrices+1]
+    uint64_t off_row_channels;    // uint64[n_rows+1]
+    uint64_t off_row_filters;     // uint64[n_rows+1], into filters
+    uint64_t off_row_sizes;       // int32[2*n_rows], (size1, size2) per row
+    uint64_t off_filters;         // char[n_filter_bytes]
+    uint64_t off_codes;           // code_t[n_channels]
+    uint64_t off_channel_offsets; // uint64[n_channels+1]
+    uint64_t off_values;          // dtype_t[n_values]
+    static const uint32_t VERSION = 1;
+    static bool checkMagic(const char *data);
+    void setMagic();
+};
+
+struct MappedArchive
+{
+    // Read-only (copy-on-write) memory mapping of a flat archive file
+    MappedArchive(std::string archfile);
+    ~MappedArchive();
+    DMapArchiveHeader *header() { return (DMapArchiveHeader*) data; }
+    template<typename T>
+    T *section(uint64_t offset) { return (T*) (data+offset); }
+    std::string archfile;
+    char *data;
+    size_t length;
+};
+
 class DMapMatrixSet
 {
   public:
     typedef std::vector<DMapMatrix*> dset_t;
     typedef std::vector<dset_t*> views_t;
+    typedef std::pair<int, int> entry_t; // (structure, atom)
+    typedef std::unordered_map<TypeEncoder::code_t, std::vector<entry_t>> channel_index_t;
     DMapMatrixSet();
     DMapMatrixSet(bool set_as_view);
     DMapMatrixSet(std::string archfile);
@@ -234,8 +365,22 @@ class DMapMatrixSet
     DMapMatrixSet *getView(boost::python::list idcs);
     void append(DMapMatrix *dmm);
     void extend(DMapMatrixSet *other);
+    void pack();
     void save(std::string archfile);
     void load(std::string archfile);
+    // Flat archive format that is memory-mapped on load: rows reference 
+    // the mapped pages directly, so only the data that is touched is read
+    void saveMapped(std::string archfile);
+    void loadMapped(std::string archfile);
+    bool isMapped() { return archives.size() > 0; }
+    // Inverted index from channel code to the (structure, atom) entries
+    // carrying that channel. Needs to be rebuilt after modifying the set.
+    void buildChannelIndex();
+    void clearChannelIndex();
+    bool hasChannelIndex() { return indexed; }
+    bool overlaps(int i, DMapMatrixSet *other, int j);
+    bpy::dict getChannelIndexPython();
+    bpy::list getOverlapsPython(DMapMatrix *dmm);
     static void registerPython();
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
@@ -247,6 +392,11 @@ class DMapMatrixSet
     dset_t dset;
     views_t views;
     bool is_view;
+    std::vector<std::shared_ptr<MappedArchive>> archives; // Keep mappings alive for (views of) mapped rows
+    // Transient, not serialized
+    bool indexed;
+    channel_index_t channel_index;
+    std::vector<std::vector<TypeEncoder::code_t>> structure_channels; // Sorted channel codes per structure
 };
 
 struct BlockLaplacian
@@ -305,4 +455,6 @@ class Proto
 
 }
 
+BOOST_CLASS_VERSION(soap::DMap, 1);
+
 #endif /* _SOAP_DMAP_HPP_ */
@@ -22,10 +22,41 @@ from scipy.special import gamma
 from scipy.linalg import sqrtm, inv
 from _soapgto import *
 from .. import tools
+from ..soapy.cache import array_digest
 
 def eval_single(args):
     return args["calc"].evaluate(**args)
 
+def select_centres(system, types_map, centre_types=None, centre_mask=None):
+    """Returns the indices of the atoms in <system> that act as centres,
+    filtered by <centre_types> (element names or atomic numbers) and/or
+    a boolean <centre_mask>, grouped by atomic number (stable within
+    each species) so that the native loop visits same-type centres
+    contiguously."""
+    Z = system.get_atomic_numbers()
+    mask = np.ones((len(Z),), dtype=bool)
+    if centre_mask is not None:
+        centre_mask = np.array(centre_mask, dtype=bool)
+        if centre_mask.shape != mask.shape:
+            raise ValueError("Centre mask does not match number of atoms: %d != %d" % (
+                centre_mask.shape[0], mask.shape[0]))
+        mask = mask & centre_mask
+    if centre_types is not None:
+        z_select = []
+        for t in centre_types:
+            if t in types_map:
+                z_select.append(types_map[t])
+                continue
+            try:
+                z_select.append(int(t))
+            except (TypeError, ValueError):
+                raise ValueError("Unknown centre type '%s', calculator types are: %s" % (
+                    str(t), ", ".join(sorted(types_map.keys()))))
+        mask = mask & np.in1d(Z, z_select)
+    idx = np.where(mask)[0]
+    idx = idx[np.argsort(Z[idx], kind='mergesort')]
+    return idx
+
 class GylmCalculator(object):
     def __init__(
             self,
@@ -44,12 +75,14 @@ class GylmCalculator(object):
             periodic=False,
             normalize=False,
             power=True,
+            cache=None,
             encoder=lambda s: tools.ptable.lookup[s].z,
             decoder=lambda z: tools.ptable.lookup[int(z)].name):
         self.types = types
         self.types_z = np.array(sorted([ encoder(s) for s in self.types ]))
         self.types_elem = np.array([ decoder(z) for z in self.types_z ])
         self.types_set = set(list(self.types_z))
+        self.types_map = { e: z for e, z in zip(self.types_elem, self.types_z) }
         self._Nt = len(self.types_z)
         self._eta = 1/(2*sigma**2)
         self._sigma = sigma
@@ -67,6 +100,19 @@ class GylmCalculator(object):
         self.periodic = periodic
         self.normalize = normalize
         self.power = power
+        self.cache = cache
+    def getHyperparameters(self, centres=None):
+        hyper = { "calc": "gylm", 
+            "types": list(self.types_z), "rmin": self._rmin, "rcut": self._rcut, 
+            "rcut_width": self._rcut_width, "nmax": self._nmax, "lmax": self._lmax, 
+            "sigma": self._sigma, "part_sigma": self.part_sigma, 
+            "wconstant": self.wconstant, "wcentre": self.wcentre, "wscale": self.wscale, 
+            "ldamp": self.ldamp, "periodic": self.periodic, 
+            "normalize": self.normalize, "power": self.power }
+        if centres is not None:
+            hyper["centres"] = array_digest(centres, self.cache.tol \
+                if self.cache is not None else 1e-6)
+        return hyper
     def getDim(self, with_power=None):
         if with_power is None: with_power = self.power
         return self.getChannelDim(with_power)*self.getNumberOfChannels(with_power)
@@ -99,6 +145,20 @@ class GylmCalculator(object):
         X_list = pool.map(eval_single, args)
         pool.close()
         return X_list
+    def evaluate_centres(self, system, 
+            centre_types=None, 
+            centre_mask=None, 
+            verbose=False):
+        """Evaluates descriptors for the atoms of <system> selected by
+        <centre_types> (element names or atomic numbers) and/or a boolean
+        <centre_mask>. Returns (X, centre_idx), where row k of X belongs
+        to atom centre_idx[k]; rows are grouped by species."""
+        centre_idx = select_centres(system, self.types_map, 
+            centre_types=centre_types, centre_mask=centre_mask)
+        X = self.evaluate(system, 
+            positions=system.get_positions()[centre_idx], 
+            verbose=verbose)
+        return X, centre_idx
     def evaluate(self, system, positions=None, 
             verbose=False, 
             calc=None):
@@ -106,6 +166,11 @@ class GylmCalculator(object):
             cell = system.get_cell()
         if positions is None:
             positions = system.get_positions()
+        if self.cache is not None:
+            key = self.cache.key(system, self.getHyperparameters(positions))
+            X = self.cache.get(key)
+            if X is not None:
+                return X
         X = self.evaluateGylm(
             system,
             positions,
@@ -122,6 +187,8 @@ class GylmCalculator(object):
         if self.normalize:
             z = 1./np.sum(X**2, axis=1)**0.5
             X = (X.T*z).T
+        if self.cache is not None:
+            self.cache.put(key, X)
         return X
     def evaluateGylm(self, system, centers, 
             gnl_centres, gnl_alphas, 
@@ -196,11 +263,13 @@ class SoapGtoCalculator(object):
             average=False,
             sparse=False,
             normalize=False,
+            cache=None,
             encoder=lambda s: tools.ptable.lookup[s].z,
             decoder=lambda z: tools.ptable.lookup[int(z)].name):
         self.types = types
         self.types_z = np.array(sorted([ encoder(s) for s in self.types ]))
         self.types_elem = np.array([ decoder(z) for z in self.types_z ])
+        self.types_map = { e: z for e, z in zip(self.types_elem, self.types_z) }
         self._Nt = len(self.types_z)
         self._eta = 1/(2*sigma**2)
         self._sigma = sigma
@@ -210,7 +279,19 @@ class SoapGtoCalculator(object):
         self._lmax = lmax
         self.periodic = periodic
         self._average = average
+        self._sparse = sparse
         self._normalize = normalize
+        self.cache = cache
+    def getHyperparameters(self, centres=None):
+        hyper = { "calc": "soapgto", 
+            "types": list(self.types_z), "rcut": self._rcut, 
+            "nmax": self._nmax, "lmax": self._lmax, "sigma": self._sigma, 
+            "periodic": self.periodic, "normalize": self._normalize,
+            "average": self._average, "sparse": self._sparse }
+        if centres is not None:
+            hyper["centres"] = array_digest(centres, self.cache.tol \
+                if self.cache is not None else 1e-6)
+        return hyper
     def getDim(self):
         return self.getChannelDim()*self.getNumberOfChannels()
     def getChannelDim(self):
@@ -219,11 +300,24 @@ class SoapGtoCalculator(object):
         return self._Nt*(self._Nt+1)/2
     def getNumberofTypes(self):
         return len(self.types_z)
+    def evaluate_centres(self, system, 
+            centre_types=None, 
+            centre_mask=None):
+        """See GylmCalculator.evaluate_centres."""
+        centre_idx = select_centres(system, self.types_map, 
+            centre_types=centre_types, centre_mask=centre_mask)
+        X = self.evaluate(system, positions=system.get_positions()[centre_idx])
+        return X, centre_idx
     def evaluate(self, system, positions=None):
         if self.periodic:
             cell = system.get_cell()
         if positions is None:
             positions = system.get_positions()
+        if self.cache is not None:
+            key = self.cache.key(system, self.getHyperparameters(positions))
+            X = self.cache.get(key)
+            if X is not None:
+                return X
         threshold = 0.001
         cutoff_padding = self._sigma*np.sqrt(-2*np.log(threshold))
         X = self.evaluateGTO(
@@ -240,6 +334,8 @@ class SoapGtoCalculator(object):
         if self._normalize:
             z = 1./np.sum(X**2, axis=1)**0.5
             X = (X.T*z).T
+        if self.cache is not None:
+            self.cache.put(key, X)
         return X
     def evaluateGTO(self, system, centers, 
             alphas, betas, 
@@ -2,6 +2,12 @@
 #include "soap/linalg/numpy.hpp"
 #include "soap/linalg/operations.hpp"
 #include "soap/base/tokenizer.hpp"
+#include <random>
+#include <algorithm>
+#include <exception>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 namespace soap {
 
@@ -14,143 +20,386 @@ double TopKernel::evaluateNumpy(boost::python::object &np_K, std::string np_dtyp
     return this->evaluate(K);
 }
 
-TopKernelRematch::TopKernelRematch() : gamma(0.05), eps(1e-6), omega(1.0) {;}
+Sinkhorn::Sinkhorn() : gamma(0.05), eps(1e-6), omega(1.0), max_iter(100000), tau(1e50),
+    sparse_topk(0), sparse_eps(0.0), sparse_check(false) {;}
 
-void TopKernelRematch::configure(Options &options) {
-    gamma = options.get<double>("rematch_gamma");
-    eps = options.get<double>("rematch_eps");
-    omega = options.get<double>("rematch_omega");
-    GLOG() << "Configuring top kernel (rematch)";
-    GLOG() << " gamma=" << gamma << " eps=" << eps << " omega=" << omega << std::endl;
+void Sinkhorn::configure(double gamma_in, double eps_in, double omega_in, int max_iter_in) {
+    gamma = gamma_in;
+    eps = eps_in;
+    omega = omega_in;
+    max_iter = max_iter_in;
 }
 
-double TopKernelRematch::evaluate(DMapMatrix::matrix_t &K) {
+void Sinkhorn::configureSparse(int topk, double eps_drop, bool check) {
+    sparse_topk = topk;
+    sparse_eps = eps_drop;
+    sparse_check = check;
+}
+
+void Sinkhorn::fillScaledKernel(matrix_t &K, vec_t &f, vec_t &g, matrix_t &Kg) {
+    double lambda = 1./gamma;
+    for (int i=0; i<K.size1(); ++i)
+        for (int j=0; j<K.size2(); ++j)
+            Kg(i,j) = std::exp(-(1-K(i,j))*lambda + f(i) + g(j));
+}
+
+SinkhornInfo Sinkhorn::solve(matrix_t &K, matrix_t &P, vec_t &f_warm) {
     int nx = K.size1();
     int ny = K.size2();
-    DMapMatrix::vec_t u(nx, 1.0);
-    DMapMatrix::vec_t u_in(nx, 1.0);
-    DMapMatrix::vec_t du(nx);
-    DMapMatrix::vec_t v(ny, 1.0);
-    DMapMatrix::vec_t v_in(ny, 1.0);
+    SinkhornInfo info = { 0, 0.0, true };
+    P.resize(nx, ny, false);
+    if (nx == 0 || ny == 0) return info;
     double ax = 1./nx;
     double ay = 1./ny;
     double lambda = 1./gamma;
-    DMapMatrix::matrix_t Kg(nx,ny);
-    for (int i=0; i<nx; ++i)
-        for (int j=0; j<ny; ++j)
-            Kg(i,j) = std::exp(-(1-K(i,j))*lambda);
-    int i_iter = 0;
-    double err = 0.0;
-    // TODO Add convergence flag and send to user
+    // Log-domain potentials: Kg(i,j) = exp(-(1-K(i,j))/gamma + f(i) + g(j)),
+    // initialized such that no row or column of Kg underflows
+    bool warm = (f_warm.size() == nx);
+    vec_t f(nx, 0.0);
+    vec_t g(ny, 0.0);
+    if (warm) f = f_warm;
+    else {
+        for (int i=0; i<nx; ++i) {
+            double m = -(1-K(i,0))*lambda;
+            for (int j=1; j<ny; ++j) m = std::max(m, -(1-K(i,j))*lambda);
+            f(i) = -m;
+        }
+    }
+    for (int j=0; j<ny; ++j) {
+        double m = -(1-K(0,j))*lambda + f(0);
+        for (int i=1; i<nx; ++i) m = std::max(m, -(1-K(i,j))*lambda + f(i));
+        g(j) = -m;
+    }
+    if (warm) {
+        for (int i=0; i<nx; ++i) {
+            double m = -(1-K(i,0))*lambda + g(0);
+            for (int j=1; j<ny; ++j) m = std::max(m, -(1-K(i,j))*lambda + g(j));
+            if (m + f(i) < -600.) f(i) = -m;
+        }
+    }
+    matrix_t &Kg = P; // Scaled kernel is transformed into P in place
+    this->fillScaledKernel(K, f, g, Kg);
+    vec_t u(nx, 1.0);
+    vec_t u_in(nx, 1.0);
+    vec_t v(ny, 1.0);
+    if (warm) {
+        soap::linalg::linalg_matrix_vector_dot(Kg, u, v, true, 1.0, 0.0);
+        for (int j=0; j<ny; ++j) v(j) = ay/v(j);
+    }
+    vec_t v_in(v);
+    info.converged = false;
     while (true) {
         // Update u
         soap::linalg::linalg_matrix_vector_dot(Kg, v, u, false, 1.0, 0.0);
-        err = 0.0;
+        double err = 0.0;
         for (int i=0; i<nx; ++i) err += std::pow(ax-u(i)*u_in(i),2);
         for (int i=0; i<nx; ++i) u(i) = omega*ax/u(i) + (1-omega)*u_in(i);
         // Update v
         soap::linalg::linalg_matrix_vector_dot(Kg, u, v, true, 1.0, 0.0);
-        for (int i=0; i<ny; ++i) v(i) = omega*ay/v(i) + (1-omega)*v_in(i);
-        if (err < eps) break;
+        for (int j=0; j<ny; ++j) v(j) = omega*ay/v(j) + (1-omega)*v_in(j);
+        info.iterations += 1;
+        info.error = err;
+        if (err < eps) {
+            info.converged = true;
+            break;
+        }
+        if (info.iterations >= max_iter || !(err == err)) break;
+        // Absorb large scaling factors into the potentials
+        double umax = 0.0;
+        double umin = tau;
+        for (int i=0; i<nx; ++i) { umax = std::max(umax, u(i)); umin = std::min(umin, u(i)); }
+        for (int j=0; j<ny; ++j) { umax = std::max(umax, v(j)); umin = std::min(umin, v(j)); }
+        if (umax > tau || umin < 1./tau) {
+            for (int i=0; i<nx; ++i) { f(i) += std::log(u(i)); u(i) = 1.0; }
+            for (int j=0; j<ny; ++j) { g(j) += std::log(v(j)); v(j) = 1.0; }
+            this->fillScaledKernel(K, f, g, Kg);
+        }
         // Step
         u_in = u;
         v_in = v;
-        i_iter += 1;
     }
-    double k = 0.0;
-    ub::matrix<double> Pij(nx, ny, 0.0);
-    for (int i=0; i<nx; ++i) {
-        for (int j=0; j<ny; ++j) {
-            Pij(i,j) = u(i)*Kg(i,j)*v(j);
-            k += Pij(i,j)*K(i,j);
-        }
-    }
-    return k;
+    for (int i=0; i<nx; ++i)
+        for (int j=0; j<ny; ++j)
+            P(i,j) = u(i)*Kg(i,j)*v(j);
+    f_warm.resize(nx, false);
+    for (int i=0; i<nx; ++i) f_warm(i) = f(i) + std::log(u(i));
+    return info;
 }
 
-void TopKernelRematch::attributeGetReductionMatrix(
-    DMapMatrix::matrix_t &K, DMapMatrix::matrix_t &P) {
+void Sinkhorn::fillScaledKernel(csr_t &S, vec_t &f, vec_t &g, std::vector<double> &Kg) {
+    for (int i=0; i<int(S.row_ptr.size())-1; ++i)
+        for (int p=S.row_ptr[i]; p<S.row_ptr[i+1]; ++p)
+            Kg[p] = std::exp(S.c[p] + f(i) + g(S.cols[p]));
+}
+
+void Sinkhorn::sparsify(matrix_t &K, csr_t &S) {
     int nx = K.size1();
     int ny = K.size2();
-    DMapMatrix::vec_t u(nx, 1.0);
-    DMapMatrix::vec_t u_in(nx, 1.0);
-    DMapMatrix::vec_t du(nx);
-    DMapMatrix::vec_t v(ny, 1.0);
-    DMapMatrix::vec_t v_in(ny, 1.0);
-    double ax = 1./nx;
-    double ay = 1./ny;
     double lambda = 1./gamma;
-    DMapMatrix::matrix_t Kg(nx,ny);
-    for (int i=0; i<nx; ++i)
-        for (int j=0; j<ny; ++j)
-            Kg(i,j) = std::exp(-(1-K(i,j))*lambda);
-    int i_iter = 0;
-    double err = 0.0;
-    // TODO Add convergence flag and send to user
-    while (true) {
-        // Update u
-        soap::linalg::linalg_matrix_vector_dot(Kg, v, u, false, 1.0, 0.0);
-        err = 0.0;
-        for (int i=0; i<nx; ++i) err += std::pow(ax-u(i)*u_in(i),2);
-        for (int i=0; i<nx; ++i) u(i) = omega*ax/u(i) + (1-omega)*u_in(i);
-        // Update v
-        soap::linalg::linalg_matrix_vector_dot(Kg, u, v, true, 1.0, 0.0);
-        for (int i=0; i<ny; ++i) v(i) = omega*ay/v(i) + (1-omega)*v_in(i);
-        if (err < eps) break;
-        // Step
-        u_in = u;
-        v_in = v;
-        i_iter += 1;
+    // Column maxima are always retained, such that no column is empty
+    std::vector<std::vector<int>> extra(nx);
+    for (int j=0; j<ny; ++j) {
+        int i_max = 0;
+        for (int i=1; i<nx; ++i) if (K(i,j) > K(i_max,j)) i_max = i;
+        extra[i_max].push_back(j);
     }
+    S.row_ptr.assign(1, 0);
+    S.cols.clear();
+    S.c.clear();
+    std::vector<int> row;
     for (int i=0; i<nx; ++i) {
-        double ki = 0.0;
-        for (int j=0; j<ny; ++j) {
-            P(i,j) = u(i)*Kg(i,j)*v(j);
+        row.clear();
+        double kmax = K(i,0);
+        for (int j=1; j<ny; ++j) kmax = std::max(kmax, K(i,j));
+        // exp(-(1-K(i,j))/gamma) >= eps_drop*exp(-(1-kmax)/gamma)
+        double kmin = (sparse_eps > 0.) ? kmax + gamma*std::log(sparse_eps) : -1e300;
+        for (int j=0; j<ny; ++j) if (K(i,j) >= kmin) row.push_back(j);
+        if (sparse_topk > 0 && int(row.size()) > sparse_topk) {
+            std::nth_element(row.begin(), row.begin()+sparse_topk, row.end(), 
+                [&K, i](int a, int b) { return K(i,a) > K(i,b); });
+            row.resize(sparse_topk);
+        }
+        row.insert(row.end(), extra[i].begin(), extra[i].end());
+        std::sort(row.begin(), row.end());
+        row.erase(std::unique(row.begin(), row.end()), row.end());
+        for (int j : row) {
+            S.cols.push_back(j);
+            S.c.push_back(-(1-K(i,j))*lambda);
         }
+        S.row_ptr.push_back(S.cols.size());
     }
 }
 
-void TopKernelRematch::attributeLeft(DMapMatrix::matrix_t &K, 
-        DMapMatrix::matrix_t &K_out, int i_off, int j_off) {
+SinkhornInfo Sinkhorn::solveSparse(matrix_t &K, double &k_out, vec_t &f_warm) {
     int nx = K.size1();
     int ny = K.size2();
-    DMapMatrix::vec_t u(nx, 1.0);
-    DMapMatrix::vec_t u_in(nx, 1.0);
-    DMapMatrix::vec_t du(nx);
-    DMapMatrix::vec_t v(ny, 1.0);
-    DMapMatrix::vec_t v_in(ny, 1.0);
+    SinkhornInfo info = { 0, 0.0, true, 1.0, 0.0 };
+    k_out = 0.0;
+    if (nx == 0 || ny == 0) return info;
     double ax = 1./nx;
     double ay = 1./ny;
     double lambda = 1./gamma;
-    DMapMatrix::matrix_t Kg(nx,ny);
+    csr_t S;
+    this->sparsify(K, S);
+    int nnz = S.cols.size();
+    info.fill = double(nnz)/(double(nx)*ny);
+    // Potentials as in the dense solver, restricted to the retained entries
+    bool warm = (f_warm.size() == nx);
+    vec_t f(nx, 0.0);
+    vec_t g(ny, 0.0);
+    if (warm) f = f_warm;
+    else {
+        for (int i=0; i<nx; ++i) {
+            double m = S.c[S.row_ptr[i]];
+            for (int p=S.row_ptr[i]+1; p<S.row_ptr[i+1]; ++p) m = std::max(m, S.c[p]);
+            f(i) = -m;
+        }
+    }
+    std::vector<double> gmax(ny, -1e300);
     for (int i=0; i<nx; ++i)
-        for (int j=0; j<ny; ++j)
-            Kg(i,j) = std::exp(-(1-K(i,j))*lambda);
-    int i_iter = 0;
-    double err = 0.0;
-    // TODO Add convergence flag and send to user
+        for (int p=S.row_ptr[i]; p<S.row_ptr[i+1]; ++p)
+            gmax[S.cols[p]] = std::max(gmax[S.cols[p]], S.c[p] + f(i));
+    for (int j=0; j<ny; ++j) g(j) = -gmax[j];
+    if (warm) {
+        for (int i=0; i<nx; ++i) {
+            double m = -1e300;
+            for (int p=S.row_ptr[i]; p<S.row_ptr[i+1]; ++p) m = std::max(m, S.c[p] + g(S.cols[p]));
+            if (m + f(i) < -600.) f(i) = -m;
+        }
+    }
+    std::vector<double> Kg(nnz);
+    this->fillScaledKernel(S, f, g, Kg);
+    vec_t u(nx, 1.0);
+    vec_t u_in(nx, 1.0);
+    vec_t v(ny, 1.0);
+    // Sparse matvecs: u = Kg.v (row-wise), v = Kg^T.u (scattered)
+    auto matvec = [&](vec_t &x, vec_t &y) {
+        for (int i=0; i<nx; ++i) {
+            double yi = 0.0;
+            for (int p=S.row_ptr[i]; p<S.row_ptr[i+1]; ++p) yi += Kg[p]*x(S.cols[p]);
+            y(i) = yi;
+        }
+    };
+    auto matvecT = [&](vec_t &x, vec_t &y) {
+        for (int j=0; j<ny; ++j) y(j) = 0.0;
+        for (int i=0; i<nx; ++i)
+            for (int p=S.row_ptr[i]; p<S.row_ptr[i+1]; ++p) y(S.cols[p]) += Kg[p]*x(i);
+    };
+    if (warm) {
+        matvecT(u, v);
+        for (int j=0; j<ny; ++j) v(j) = ay/v(j);
+    }
+    vec_t v_in(v);
+    info.converged = false;
     while (true) {
-        // Update u
-        soap::linalg::linalg_matrix_vector_dot(Kg, v, u, false, 1.0, 0.0);
-        err = 0.0;
+        matvec(v, u);
+        double err = 0.0;
         for (int i=0; i<nx; ++i) err += std::pow(ax-u(i)*u_in(i),2);
         for (int i=0; i<nx; ++i) u(i) = omega*ax/u(i) + (1-omega)*u_in(i);
-        // Update v
-        soap::linalg::linalg_matrix_vector_dot(Kg, u, v, true, 1.0, 0.0);
-        for (int i=0; i<ny; ++i) v(i) = omega*ay/v(i) + (1-omega)*v_in(i);
-        if (err < eps) break;
-        // Step
+        matvecT(u, v);
+        for (int j=0; j<ny; ++j) v(j) = omega*ay/v(j) + (1-omega)*v_in(j);
+        info.iterations += 1;
+        info.error = err;
+        if (err < eps) {
+            info.converged = true;
+            break;
+        }
+        if (info.iterations >= max_iter || !(err == err)) break;
+        double umax = 0.0;
+        double umin = tau;
+        for (int i=0; i<nx; ++i) { umax = std::max(umax, u(i)); umin = std::min(umin, u(i)); }
+        for (int j=0; j<ny; ++j) { umax = std::max(umax, v(j)); umin = std::min(umin, v(j)); }
+        if (umax > tau || umin < 1./tau) {
+            for (int i=0; i<nx; ++i) { f(i) += std::log(u(i)); u(i) = 1.0; }
+            for (int j=0; j<ny; ++j) { g(j) += std::log(v(j)); v(j) = 1.0; }
+            this->fillScaledKernel(S, f, g, Kg);
+        }
         u_in = u;
         v_in = v;
-        i_iter += 1;
     }
+    for (int i=0; i<nx; ++i)
+        for (int p=S.row_ptr[i]; p<S.row_ptr[i+1]; ++p)
+            k_out += u(i)*Kg[p]*v(S.cols[p])*K(i,S.cols[p]);
+    f_warm.resize(nx, false);
+    for (int i=0; i<nx; ++i) f_warm(i) = f(i) + std::log(u(i));
+    if (sparse_check && nnz < nx*ny) {
+        // At the converged potentials, the dropped entries would carry the plan 
+        // mass m_drop and shift k by <P_drop,K>. Restoring the marginals moves 
+        // at most m_drop more mass, changing k by at most m_drop*(K_max-K_min).
+        double m_drop = 0.0;
+        double k_drop = 0.0;
+        double K_max = K(0,0);
+        double K_min = K(0,0);
+        for (int i=0; i<nx; ++i) {
+            int p = S.row_ptr[i];
+            for (int j=0; j<ny; ++j) {
+                K_max = std::max(K_max, K(i,j));
+                K_min = std::min(K_min, K(i,j));
+                if (p < S.row_ptr[i+1] && S.cols[p] == j) { ++p; continue; }
+                double P_ij = u(i)*std::exp(-(1-K(i,j))*lambda + f(i) + g(j))*v(j);
+                m_drop += P_ij;
+                k_drop += P_ij*std::abs(K(i,j));
+            }
+        }
+        info.bound = k_drop + m_drop*(K_max-K_min);
+    }
+    return info;
+}
+
+TopKernelRematch::TopKernelRematch() : gamma(0.05), eps(1e-6), omega(1.0), 
+    max_iter(100000), warm_start(true), sparse_topk(0), sparse_eps(0.0), sparse_tol(1e-3),
+    sparse_check(false),
+    n_solves(0), n_unconverged(0), n_iter_total(0), n_iter_max(0),
+    n_sparse(0), sparse_fill_total(0.0), sparse_bound_max(0.0) {;}
+
+void TopKernelRematch::configure(Options &options) {
+    gamma = options.get<double>("rematch_gamma");
+    eps = options.get<double>("rematch_eps");
+    omega = options.get<double>("rematch_omega");
+    if (options.hasKey("rematch_max_iter"))
+        max_iter = options.get<int>("rematch_max_iter");
+    if (options.hasKey("rematch_warm_start"))
+        warm_start = options.get<bool>("rematch_warm_start");
+    if (options.hasKey("rematch_sparse_topk"))
+        sparse_topk = options.get<int>("rematch_sparse_topk");
+    if (options.hasKey("rematch_sparse_eps"))
+        sparse_eps = options.get<double>("rematch_sparse_eps");
+    if (options.hasKey("rematch_sparse_tol"))
+        sparse_tol = options.get<double>("rematch_sparse_tol");
+    if (options.hasKey("rematch_sparse_check"))
+        sparse_check = options.get<bool>("rematch_sparse_check");
+    sinkhorn.configure(gamma, eps, omega, max_iter);
+    sinkhorn.configureSparse(sparse_topk, sparse_eps, sparse_check);
+    GLOG() << "Configuring top kernel (rematch)";
+    GLOG() << " gamma=" << gamma << " eps=" << eps << " omega=" << omega 
+        << " max_iter=" << max_iter << " warm_start=" << warm_start;
+    if (sinkhorn.isSparse()) GLOG() << " sparse_topk=" << sparse_topk 
+        << " sparse_eps=" << sparse_eps << " sparse_tol=" << sparse_tol;
+    GLOG() << std::endl;
+}
+
+void TopKernelRematch::record(SinkhornInfo &info) {
+    #pragma omp critical (rematch_record)
+    {
+        n_solves += 1;
+        n_iter_total += info.iterations;
+        n_iter_max = std::max(n_iter_max, info.iterations);
+        if (!info.converged) {
+            n_unconverged += 1;
+            GLOG() << "WARNING Rematch not converged after " << info.iterations 
+                << " iterations (err=" << info.error << ")" << std::endl;
+        }
+    }
+}
+
+void TopKernelRematch::recordSparse(SinkhornInfo &info) {
+    this->record(info);
+    #pragma omp critical (rematch_record)
+    {
+        n_sparse += 1;
+        sparse_fill_total += info.fill;
+        sparse_bound_max = std::max(sparse_bound_max, info.bound);
+        if (info.bound > sparse_tol) {
+            GLOG() << "WARNING Sparse rematch error estimate " << info.bound 
+                << " exceeds tolerance " << sparse_tol << " (fill=" << info.fill << ")" << std::endl;
+        }
+    }
+}
+
+bpy::dict TopKernelRematch::getInfo() {
+    bpy::dict info;
+    info["solves"] = n_solves;
+    info["unconverged"] = n_unconverged;
+    info["iterations"] = n_iter_total;
+    info["max_iterations"] = n_iter_max;
+    if (n_sparse > 0) {
+        info["sparse_solves"] = n_sparse;
+        info["sparse_fill"] = sparse_fill_total/n_sparse;
+        if (sparse_check) info["sparse_error_max"] = sparse_bound_max;
+    }
+    return info;
+}
+
+double TopKernelRematch::evaluate(DMapMatrix::matrix_t &K) {
+    DMapMatrix::vec_t warm;
+    return this->evaluateWarm(K, warm);
+}
+
+double TopKernelRematch::evaluateWarm(DMapMatrix::matrix_t &K, DMapMatrix::vec_t &warm) {
+    if (!warm_start) warm.resize(0, false);
+    if (sinkhorn.isSparse()) {
+        double k = 0.0;
+        SinkhornInfo info = sinkhorn.solveSparse(K, k, warm);
+        this->recordSparse(info);
+        return k;
+    }
+    DMapMatrix::matrix_t P(K.size1(), K.size2());
+    SinkhornInfo info = sinkhorn.solve(K, P, warm);
+    this->record(info);
     double k = 0.0;
-    ub::matrix<double> Pij(nx, ny, 0.0);
-    for (int i=0; i<nx; ++i) {
+    for (int i=0; i<K.size1(); ++i)
+        for (int j=0; j<K.size2(); ++j)
+            k += P(i,j)*K(i,j);
+    return k;
+}
+
+void TopKernelRematch::attributeGetReductionMatrix(
+    DMapMatrix::matrix_t &K, DMapMatrix::matrix_t &P) {
+    DMapMatrix::vec_t warm;
+    SinkhornInfo info = sinkhorn.solve(K, P, warm);
+    this->record(info);
+}
+
+void TopKernelRematch::attributeLeft(DMapMatrix::matrix_t &K, 
+        DMapMatrix::matrix_t &K_out, int i_off, int j_off) {
+    DMapMatrix::vec_t warm;
+    DMapMatrix::matrix_t P(K.size1(), K.size2());
+    SinkhornInfo info = sinkhorn.solve(K, P, warm);
+    this->record(info);
+    for (int i=0; i<K.size1(); ++i) {
         double ki = 0.0;
-        for (int j=0; j<ny; ++j) {
-            Pij(i,j) = u(i)*Kg(i,j)*v(j);
-            ki += Pij(i,j)*K(i,j);
+        for (int j=0; j<K.size2(); ++j) {
+            ki += P(i,j)*K(i,j);
         }
         K_out(i_off+i, j_off) = ki;
     }
@@ -234,21 +483,427 @@ void TopKernelAverage::attributeLeft(DMapMatrix::matrix_t &K,
     }
 }
 
-BaseKernelDot::BaseKernelDot() : exponent(2.), filter(false) {
+BaseKernelDot::BaseKernelDot() : exponent(2.), filter(false), pack(false), index(false) {
     ;
 }
 
 void BaseKernelDot::configure(Options &options) {
     exponent = options.get<double>("base_exponent");
     filter = options.get<bool>("base_filter");
+    if (options.hasKey("base_pack")) pack = options.get<bool>("base_pack");
+    if (options.hasKey("base_index")) index = options.get<bool>("base_index");
     GLOG() << "Configuring base kernel (dot):";
-    GLOG() << " exponent=" << exponent << " filter=" << filter << std::endl;
+    GLOG() << " exponent=" << exponent << " filter=" << filter << " pack=" << pack 
+        << " index=" << index << std::endl;
+}
+
+void BaseKernelDot::prepare(DMapMatrixSet *dset) {
+    if (pack) {
+        // Matrices packed here are unpacked again by finish, those 
+        // packed by the caller are left as they are
+        for (auto it=dset->begin(); it!=dset->end(); ++it) {
+            if ((*it)->isPacked()) continue;
+            (*it)->pack();
+            packed.push_back(*it);
+        }
+    }
+    // Rebuilt on every evaluation: the DMaps of the set may have been 
+    // modified in place since, which the set cannot detect
+    if (index) dset->buildChannelIndex();
+}
+
+void BaseKernelDot::finish() {
+    for (auto it=packed.begin(); it!=packed.end(); ++it) (*it)->clearPacked();
+    packed.clear();
 }
 
 double BaseKernelDot::evaluate(DMapMatrix *m1, DMapMatrix *m2, DMapMatrix::matrix_t &K_out) {
     dmm_inner_product(*m1, *m2, exponent, filter, K_out);
 }
 
+static void sum_structures(DMapMatrixSet *dset, bool filter, 
+        DMapMatrix &summed, std::vector<int> &owner) {
+    // One summed descriptor per structure, or per (structure, filter) pair
+    for (int i=0; i<dset->size(); ++i) {
+        std::map<std::string, DMap*> sums;
+        for (auto it=dset->get(i)->begin(); it!=dset->get(i)->end(); ++it) {
+            std::string f = (filter) ? (*it)->filter : "";
+            auto st = sums.find(f);
+            if (st == sums.end()) st = sums.insert(std::make_pair(f, new DMap(f))).first;
+            st->second->addIgnoreGradients(*it, 1.0);
+        }
+        for (auto st=sums.begin(); st!=sums.end(); ++st) {
+            summed.adopt(st->second);
+            owner.push_back(i);
+        }
+    }
+}
+
+bool BaseKernelDot::evaluateSummed(DMapMatrixSet *dset1, DMapMatrixSet *dset2, 
+        bool symmetric, DMapMatrix::matrix_t &output) {
+    // sum_ab x_a.y_b = (sum_a x_a).(sum_b y_b), only for the linear kernel
+    if (exponent != 1.) return false;
+    DMapMatrix S1, S2;
+    std::vector<int> owner1, owner2;
+    sum_structures(dset1, filter, S1, owner1);
+    S1.pack();
+    DMapMatrix *s2 = &S1;
+    std::vector<int> *o2 = &owner1;
+    if (!symmetric) {
+        sum_structures(dset2, filter, S2, owner2);
+        S2.pack();
+        s2 = &S2;
+        o2 = &owner2;
+    }
+    DMapMatrix::matrix_t M(S1.rows(), s2->rows());
+    if (filter) S1.dotFilter(s2, M);
+    else S1.dot(s2, M);
+    for (int i=0; i<output.size1(); ++i)
+        for (int j=0; j<output.size2(); ++j)
+            output(i,j) = 0.0;
+    for (int r=0; r<M.size1(); ++r) {
+        for (int c=0; c<M.size2(); ++c) {
+            int i = owner1[r];
+            int j = (*o2)[c];
+            if (symmetric && j < i) continue;
+            output(i,j) += M(r,c);
+        }
+    }
+    return true;
+}
+
+BaseKernelEmbedded::BaseKernelEmbedded() : exponent(2.), filter(false), seed(0), n_threads(1), 
+        n_samples(0), tol(0.05), error_rms(-1.), error_max(-1.) {
+    ;
+}
+
+BaseKernelEmbedded::~BaseKernelEmbedded() {
+    this->finish();
+}
+
+void BaseKernelEmbedded::configure(Options &options) {
+    exponent = options.get<double>("base_exponent");
+    filter = options.get<bool>("base_filter");
+    if (options.hasKey("base_seed")) seed = options.get<int>("base_seed");
+    // Same convention as Kernel: threads over structures, <= 0: all available
+    if (options.hasKey("n_threads")) n_threads = options.get<int>("n_threads");
+    if (options.hasKey("base_error_samples")) n_samples = options.get<int>("base_error_samples");
+    if (options.hasKey("base_error_tol")) tol = options.get<double>("base_error_tol");
+}
+
+void BaseKernelEmbedded::prepare(DMapMatrixSet *dset) {
+    this->fit(dset);
+    std::vector<matrix_t*> Phis(dset->size(), NULL);
+    int n_threads_eff = 1;
+    #ifdef _OPENMP
+    n_threads_eff = (n_threads > 0) ? n_threads : omp_get_max_threads();
+    #endif
+    // Exceptions must not escape the parallel region: the first one is 
+    // kept, remaining structures are skipped and it is rethrown below
+    std::exception_ptr error = NULL;
+    bool failed = false;
+    #pragma omp parallel for schedule(dynamic, 1) num_threads(n_threads_eff)
+    for (int i=0; i<dset->size(); ++i) {
+        bool skip;
+        #pragma omp atomic read
+        skip = failed;
+        if (skip) continue;
+        if (embeddings.find(dset->get(i)) != embeddings.end()) continue;
+        Phis[i] = new matrix_t();
+        try {
+            this->embedMatrix(dset->get(i), *Phis[i]);
+        } catch (...) {
+            #pragma omp critical (kernel_error)
+            {
+                if (!error) error = std::current_exception();
+                #pragma omp atomic write
+                failed = true;
+            }
+        }
+    }
+    if (error) {
+        for (int i=0; i<dset->size(); ++i) delete Phis[i];
+        std::rethrow_exception(error);
+    }
+    for (int i=0; i<dset->size(); ++i) {
+        if (Phis[i] != NULL) embeddings[dset->get(i)] = Phis[i];
+    }
+    // Opt-in: no-op unless base_error_samples > 0
+    this->estimateError(dset);
+}
+
+void BaseKernelEmbedded::finish() {
+    for (auto it=embeddings.begin(); it!=embeddings.end(); ++it) delete it->second;
+    embeddings.clear();
+}
+
+void BaseKernelEmbedded::embedMatrix(DMapMatrix *dmm, matrix_t &Phi) {
+    int dim = this->dimension();
+    Phi.resize(dmm->rows(), dim, false);
+    std::vector<double> phi(dim);
+    int a = 0;
+    for (auto it=dmm->begin(); it!=dmm->end(); ++it, ++a) {
+        this->embed(*it, &phi[0]);
+        for (int d=0; d<dim; ++d) Phi(a,d) = phi[d];
+    }
+}
+
+double BaseKernelEmbedded::evaluate(DMapMatrix *m1, DMapMatrix *m2, DMapMatrix::matrix_t &K_out) {
+    matrix_t *Phi1 = NULL;
+    matrix_t *Phi2 = NULL;
+    matrix_t tmp1, tmp2;
+    // Matrices not seen by prepare are embedded on the fly
+    auto it = embeddings.find(m1);
+    if (it != embeddings.end()) Phi1 = it->second;
+    else {
+        this->embedMatrix(m1, tmp1);
+        Phi1 = &tmp1;
+    }
+    it = embeddings.find(m2);
+    if (it != embeddings.end()) Phi2 = it->second;
+    else {
+        this->embedMatrix(m2, tmp2);
+        Phi2 = &tmp2;
+    }
+    soap::linalg::linalg_matrix_dot(*Phi1, *Phi2, K_out, 1.0, 0.0, false, true);
+    if (filter) {
+        int i = 0;
+        for (auto it=m1->begin(); it!=m1->end(); ++it, ++i) {
+            int j = 0;
+            for (auto jt=m2->begin(); jt!=m2->end(); ++jt, ++j) {
+                if ((*it)->filter != (*jt)->filter) K_out(i,j) = 0.0;
+            }
+        }
+    }
+    return 0.0;
+}
+
+void BaseKernelEmbedded::estimateError(DMapMatrixSet *dset) {
+    // Relative rms error on randomly sampled atom pairs, compared to exact (x.y)^p
+    if (n_samples <= 0 || dset->size() == 0) return;
+    std::mt19937 rng(seed+1);
+    std::uniform_int_distribution<int> pick_structure(0, dset->size()-1);
+    double sum_err2 = 0.0;
+    double sum_ref2 = 0.0;
+    double max_err = 0.0;
+    int n = 0;
+    for (int s=0; s<n_samples; ++s) {
+        int i = pick_structure(rng);
+        int j = pick_structure(rng);
+        DMapMatrix *mi = dset->get(i);
+        DMapMatrix *mj = dset->get(j);
+        if (mi->rows() == 0 || mj->rows() == 0) continue;
+        int a = std::uniform_int_distribution<int>(0, mi->rows()-1)(rng);
+        int b = std::uniform_int_distribution<int>(0, mj->rows()-1)(rng);
+        double k_exact = std::pow(mi->getRow(a)->dot(mj->getRow(b)), exponent);
+        matrix_t &Phi_i = *embeddings[mi];
+        matrix_t &Phi_j = *embeddings[mj];
+        double k_approx = 0.0;
+        for (int d=0; d<Phi_i.size2(); ++d) k_approx += Phi_i(a,d)*Phi_j(b,d);
+        double err = k_approx - k_exact;
+        sum_err2 += err*err;
+        sum_ref2 += k_exact*k_exact;
+        max_err = std::max(max_err, std::abs(err));
+        n += 1;
+    }
+    if (n == 0) return;
+    error_rms = (sum_ref2 > 0.) ? std::sqrt(sum_err2/sum_ref2) : std::sqrt(sum_err2/n);
+    error_max = max_err;
+    GLOG() << "Base kernel (" << this->identify() << "): dim=" << this->dimension() 
+        << " relative rms error=" << error_rms << " max abs error=" << error_max 
+        << " (" << n << " sampled pairs)" << std::endl;
+    if (error_rms > tol) {
+        GLOG() << "WARNING Base kernel approximation error " << error_rms 
+            << " exceeds tolerance " << tol << ": increase the embedding dimension" << std::endl;
+    }
+}
+
+void BaseKernelEmbedded::embedSummed(DMapMatrixSet *dset, matrix_t &Phi) {
+    int dim = this->dimension();
+    Phi.resize(dset->size(), dim, false);
+    for (int i=0; i<dset->size(); ++i) {
+        matrix_t &Phi_i = *embeddings[dset->get(i)];
+        for (int d=0; d<dim; ++d) {
+            double p = 0.0;
+            for (int a=0; a<Phi_i.size1(); ++a) p += Phi_i(a,d);
+            Phi(i,d) = p;
+        }
+    }
+}
+
+bool BaseKernelEmbedded::evaluateSummed(DMapMatrixSet *dset1, DMapMatrixSet *dset2, 
+        bool symmetric, DMapMatrix::matrix_t &output) {
+    // The embedded kernel is bilinear in phi: sum_ab phi_a.phi_b = (sum_a phi_a).(sum_b phi_b)
+    if (filter) return false;
+    matrix_t P1, P2;
+    this->embedSummed(dset1, P1);
+    if (symmetric) P2 = P1;
+    else this->embedSummed(dset2, P2);
+    soap::linalg::linalg_matrix_dot(P1, P2, output, 1.0, 0.0, false, true);
+    if (symmetric) {
+        for (int i=0; i<output.size1(); ++i)
+            for (int j=0; j<i; ++j)
+                output(i,j) = 0.0;
+    }
+    return true;
+}
+
+bpy::dict BaseKernelEmbedded::getInfo() {
+    bpy::dict info;
+    info["type"] = this->identify();
+    info["dim"] = this->dimension();
+    info["error_rms"] = error_rms;
+    info["error_max"] = error_max;
+    info["tol"] = tol;
+    return info;
+}
+
+BaseKernelMaclaurin::BaseKernelMaclaurin() : dim(256), order(2) {
+    ;
+}
+
+BaseKernelMaclaurin::~BaseKernelMaclaurin() {
+    this->finish();
+    for (auto it=weights.begin(); it!=weights.end(); ++it) delete it->second;
+    weights.clear();
+}
+
+void BaseKernelMaclaurin::configure(Options &options) {
+    BaseKernelEmbedded::configure(options);
+    if (options.hasKey("base_dim")) dim = options.get<int>("base_dim");
+    order = int(exponent+0.5);
+    if (order < 1 || std::abs(exponent-order) > 1e-10) throw soap::base::SanityCheckFailed(
+        "Maclaurin features require a positive integer base_exponent");
+    GLOG() << "Configuring base kernel (dot-maclaurin):";
+    GLOG() << " exponent=" << order << " filter=" << filter << " dim=" << dim 
+        << " seed=" << seed << std::endl;
+}
+
+BaseKernelMaclaurin::matrix_t *BaseKernelMaclaurin::getWeights(
+        TypeEncoder::code_t code, int length) {
+    matrix_t *W = NULL;
+    #pragma omp critical (maclaurin_weights)
+    {
+        auto it = weights.find(code);
+        if (it == weights.end()) {
+            // Deterministic in (seed, code), independent of the order of first use
+            W = new matrix_t(dim*order, length);
+            std::mt19937 rng(seed*65537 + code);
+            for (int r=0; r<W->size1(); ++r)
+                for (int k=0; k<length; ++k)
+                    (*W)(r,k) = (rng() & 1) ? 1. : -1.;
+            weights[code] = W;
+        } else {
+            W = it->second;
+        }
+    }
+    if (W->size2() != length) throw soap::base::SanityCheckFailed(
+        "Inconsistent channel dimensions");
+    return W;
+}
+
+void BaseKernelMaclaurin::embed(DMap *x, double *phi) {
+    int n = dim*order;
+    std::vector<double> z(n, 0.0);
+    for (int c=0; c<x->size(); ++c) {
+        matrix_t *W = this->getWeights(x->code(c), x->length(c));
+        DMap::dtype_t *v = x->channel(c);
+        for (int r=0; r<n; ++r) {
+            double zr = 0.0;
+            for (int k=0; k<x->length(c); ++k) zr += (*W)(r,k)*v[k];
+            z[r] += zr;
+        }
+    }
+    double s = 1./std::sqrt(dim);
+    for (int d=0; d<dim; ++d) {
+        double p = s;
+        for (int t=0; t<order; ++t) p *= z[t*dim+d];
+        phi[d] = p;
+    }
+}
+
+BaseKernelNystrom::BaseKernelNystrom() : n_landmarks(256), jitter(1e-8) {
+    ;
+}
+
+void BaseKernelNystrom::configure(Options &options) {
+    BaseKernelEmbedded::configure(options);
+    if (options.hasKey("base_dim")) n_landmarks = options.get<int>("base_dim");
+    if (options.hasKey("base_jitter")) jitter = options.get<double>("base_jitter");
+    GLOG() << "Configuring base kernel (dot-nystrom):";
+    GLOG() << " exponent=" << exponent << " filter=" << filter << " landmarks=" << n_landmarks 
+        << " seed=" << seed << std::endl;
+}
+
+void BaseKernelNystrom::fit(DMapMatrixSet *dset) {
+    // Landmarks are drawn once, from the first set that is prepared
+    if (landmarks.rows() > 0) return;
+    std::vector<std::pair<int,int>> atoms;
+    for (int i=0; i<dset->size(); ++i)
+        for (int a=0; a<dset->get(i)->rows(); ++a)
+            atoms.push_back(std::pair<int,int>(i, a));
+    if (atoms.size() == 0) return;
+    std::mt19937 rng(seed);
+    std::shuffle(atoms.begin(), atoms.end(), rng);
+    int m = std::min(int(atoms.size()), n_landmarks);
+    for (int l=0; l<m; ++l) landmarks.append(dset->get(atoms[l].first)->getRow(atoms[l].second));
+    matrix_t K(m, m);
+    double trace = 0.0;
+    for (int l=0; l<m; ++l) {
+        for (int k=0; k<=l; ++k) {
+            K(l,k) = K(k,l) = std::pow(landmarks.getRow(l)->dot(landmarks.getRow(k)), exponent);
+        }
+        trace += K(l,l);
+    }
+    for (int l=0; l<m; ++l) K(l,l) += jitter*trace/m;
+    soap::linalg::linalg_cholesky_decompose(K);
+    L = K;
+    GLOG() << "Nystrom base kernel: " << m << " landmarks" << std::endl;
+}
+
+void BaseKernelNystrom::embed(DMap *x, double *phi) {
+    int m = landmarks.rows();
+    if (m == 0) throw soap::base::SanityCheckFailed(
+        "Nystrom base kernel has no landmarks: evaluate on a DMapMatrixSet first");
+    // Forward substitution L.phi = k_m(x)
+    for (int l=0; l<m; ++l) {
+        double r = std::pow(landmarks.getRow(l)->dot(x), exponent);
+        for (int k=0; k<l; ++k) r -= L(l,k)*phi[k];
+        phi[l] = r/L(l,l);
+    }
+}
+
+void SelfKernelCache::setCapacity(int n) {
+    max_items = n;
+    while (int(items.size()) > std::max(max_items, 0)) {
+        index.erase(items.back().first);
+        items.pop_back();
+    }
+}
+
+SelfKernelCache::entry_t *SelfKernelCache::find(uint64_t key) {
+    auto it = index.find(key);
+    if (it == index.end()) return NULL;
+    items.splice(items.begin(), items, it->second);
+    return &(it->second->second);
+}
+
+void SelfKernelCache::put(uint64_t key, const entry_t &entry) {
+    auto it = index.find(key);
+    if (it != index.end()) {
+        it->second->second = entry;
+        items.splice(items.begin(), items, it->second);
+        return;
+    }
+    if (max_items <= 0) return;
+    items.push_front(std::make_pair(key, entry));
+    index[key] = items.begin();
+    if (int(items.size()) > max_items) {
+        index.erase(items.back().first);
+        items.pop_back();
+    }
+}
+
 Kernel::~Kernel() {
     delete basekernel;
     delete metadata;
@@ -257,7 +912,13 @@ Kernel::~Kernel() {
     this->clearOutput();
 }
 
-Kernel::Kernel(Options &options) {
+Kernel::Kernel(Options &options) : n_threads(1), tile_size(16), closed_form(false), 
+        normalize(false) {
+    if (options.hasKey("n_threads")) n_threads = options.get<int>("n_threads");
+    if (options.hasKey("closed_form")) closed_form = options.get<bool>("closed_form");
+    if (options.hasKey("normalize")) normalize = options.get<bool>("normalize");
+    if (options.hasKey("tile_size")) tile_size = std::max(1, options.get<int>("tile_size"));
+    if (options.hasKey("self_cache_size")) self_kernels.setCapacity(options.get<int>("self_cache_size"));
     basekernel = BaseKernelCreator().create(options.get<std::string>("basekernel_type"));
     basekernel->configure(options);
     if (options.get<std::string>("topkernel_type") != "") {
@@ -292,18 +953,204 @@ void Kernel::evaluate(DMapMatrixSet *dset1, DMapMatrixSet *dset2,
     int n_cols = dset2->size();
     assert(output.size1() == n_rows && output.size2() == n_cols 
         && "Inconsistent output matrix dimensions");
-    int i_row = 0;
-    for (auto it=dset1->begin(); it!=dset1->end(); ++it, ++i_row) {
-        GLOG() << "\r" << "Row " << i_row+1 << "/" << n_rows << std::flush;
-        int j_col = (symmetric) ? i_row : 0;
-        for (auto jt=(symmetric) ? it : dset2->begin(); jt!=dset2->end(); ++jt, ++j_col) {
-            DMapMatrix::matrix_t Kij((*it)->rows(), (*jt)->rows());
-            //dmm_inner_product(*(*it), *(*jt), power, filter, Kij);
-            basekernel->evaluate(*it, *jt, Kij);
-            output(i_row, j_col) = topkernels[0]->evaluate(Kij);
+    basekernel->prepare(dset1);
+    if (!symmetric) basekernel->prepare(dset2);
+    std::vector<DMapMatrix::matrix_t*> outputs { &output };
+    this->evaluateTiles(dset1, dset2, symmetric, outputs);
+    if (normalize) this->normalizeOutputs(dset1, dset2, symmetric, outputs);
+    basekernel->finish();
+}
+
+void Kernel::evaluateSelf(DMapMatrixSet *dset, DMapMatrix::matrix_t &output) {
+    // Assumes that the base kernel has been prepared for dset
+    int n = dset->size();
+    int n_top = topkernels.size();
+    output.resize(n_top, n, false);
+    std::vector<uint64_t> keys(n);
+    std::vector<int> missing;
+    for (int i=0; i<n; ++i) {
+        keys[i] = dset->get(i)->hash();
+        SelfKernelCache::entry_t *entry = self_kernels.find(keys[i]);
+        if (entry == NULL || int(entry->size()) != n_top) {
+            missing.push_back(i);
+            continue;
+        }
+        for (int k=0; k<n_top; ++k) output(k,i) = (*entry)[k];
+    }
+    if (missing.size() == 0) return;
+    GLOG() << "Self-kernels: " << n-missing.size() << "/" << n << " cached" << std::endl;
+    int n_missing = missing.size();
+    int n_threads_eff = 1;
+    #ifdef _OPENMP
+    n_threads_eff = (n_threads > 0) ? n_threads : omp_get_max_threads();
+    #endif
+    std::exception_ptr error = NULL;
+    bool failed = false;
+    #pragma omp parallel num_threads(n_threads_eff)
+    {
+        DMapMatrix::matrix_t Kii;
+        #pragma omp for schedule(dynamic, 1)
+        for (int m=0; m<n_missing; ++m) {
+            bool skip;
+            #pragma omp atomic read
+            skip = failed;
+            if (skip) continue;
+            int i = missing[m];
+            DMapMatrix *dmap = dset->get(i);
+            try {
+                Kii.resize(dmap->rows(), dmap->rows(), false);
+                basekernel->evaluate(dmap, dmap, Kii);
+                for (int k=0; k<n_top; ++k) output(k,i) = topkernels[k]->evaluate(Kii);
+            } catch (...) {
+                #pragma omp critical (kernel_error)
+                {
+                    if (!error) error = std::current_exception();
+                    #pragma omp atomic write
+                    failed = true;
+                }
+            }
+        }
+    }
+    if (error) std::rethrow_exception(error);
+    SelfKernelCache::entry_t entry(n_top);
+    for (int m=0; m<n_missing; ++m) {
+        int i = missing[m];
+        for (int k=0; k<n_top; ++k) entry[k] = output(k,i);
+        self_kernels.put(keys[i], entry);
+    }
+}
+
+boost::python::object Kernel::evaluateSelfPython(DMapMatrixSet *dset, std::string np_dtype) {
+    if (basekernel == NULL || topkernels.size() == 0)
+        throw soap::base::SanityCheckFailed("Kernel object not initialized");
+    soap::linalg::numpy_converter npc(np_dtype.c_str());
+    DMapMatrix::matrix_t output;
+    basekernel->prepare(dset);
+    this->evaluateSelf(dset, output);
+    basekernel->finish();
+    return npc.ublas_to_numpy<DMapMatrix::dtype_t>(output);
+}
+
+void Kernel::normalizeOutputs(DMapMatrixSet *dset1, DMapMatrixSet *dset2, 
+        bool symmetric, std::vector<DMapMatrix::matrix_t*> &outputs) {
+    int n_rows = dset1->size();
+    int n_cols = dset2->size();
+    int n_top = outputs.size();
+    DMapMatrix::matrix_t self1, self2;
+    if (symmetric) {
+        // The diagonal has just been evaluated: store rather than recompute 
+        // it, unless it covers only part of the top kernels (as for evaluate)
+        bool store = (n_top == int(topkernels.size()));
+        self1.resize(n_top, n_rows, false);
+        SelfKernelCache::entry_t entry(n_top);
+        for (int i=0; i<n_rows; ++i) {
+            for (int k=0; k<n_top; ++k) {
+                self1(k,i) = (*outputs[k])(i,i);
+                entry[k] = self1(k,i);
+            }
+            if (store) self_kernels.put(dset1->get(i)->hash(), entry);
+        }
+    } else {
+        this->evaluateSelf(dset1, self1);
+        this->evaluateSelf(dset2, self2);
+    }
+    DMapMatrix::matrix_t &s1 = self1;
+    DMapMatrix::matrix_t &s2 = (symmetric) ? self1 : self2;
+    for (int k=0; k<n_top; ++k) {
+        DMapMatrix::matrix_t &K = *outputs[k];
+        for (int i=0; i<n_rows; ++i) {
+            for (int j=(symmetric) ? i : 0; j<n_cols; ++j) {
+                double norm = std::sqrt(s1(k,i)*s2(k,j));
+                K(i,j) = (norm > 0.) ? K(i,j)/norm : 0.;
+            }
+        }
+    }
+}
+
+void Kernel::evaluateTiles(DMapMatrixSet *dset1, DMapMatrixSet *dset2, 
+        bool symmetric, std::vector<DMapMatrix::matrix_t*> &outputs) {
+    int n_rows = dset1->size();
+    int n_cols = dset2->size();
+    int n_top = outputs.size();
+    if (closed_form) {
+        bool all_average = true;
+        for (int k=0; k<n_top; ++k) 
+            if (topkernels[k]->identify() != "average") all_average = false;
+        if (all_average && basekernel->evaluateSummed(dset1, dset2, symmetric, *outputs[0])) {
+            GLOG() << "Average kernel evaluated from summed structure descriptors" << std::endl;
+            for (int k=1; k<n_top; ++k) *outputs[k] = *outputs[0];
+            return;
+        }
+    }
+    // Tile schedule, restricted to the upper triangle if symmetric
+    std::vector<std::pair<int,int>> tiles;
+    for (int i0=0; i0<n_rows; i0+=tile_size)
+        for (int j0=(symmetric) ? i0 : 0; j0<n_cols; j0+=tile_size)
+            tiles.push_back(std::pair<int,int>(i0, j0));
+    int n_tiles = tiles.size();
+    int n_done = 0;
+    bool skip_disjoint = basekernel->zeroOnDisjoint() 
+        && dset1->hasChannelIndex() && dset2->hasChannelIndex();
+    int n_threads_eff = 1;
+    #ifdef _OPENMP
+    n_threads_eff = (n_threads > 0) ? n_threads : omp_get_max_threads();
+    #endif
+    // Exceptions (e.g., inconsistent channel dimensions) must not escape 
+    // the parallel region: the first one is kept, remaining tiles are 
+    // skipped and it is rethrown after the region
+    std::exception_ptr error = NULL;
+    bool failed = false;
+    #pragma omp parallel num_threads(n_threads_eff)
+    {
+        // Per-thread workspace
+        DMapMatrix::matrix_t Kij;
+        std::vector<DMapMatrix::vec_t> warm(n_top);
+        #pragma omp for schedule(dynamic, 1)
+        for (int t=0; t<n_tiles; ++t) {
+            bool skip;
+            #pragma omp atomic read
+            skip = failed;
+            if (skip) continue;
+            try {
+                int i0 = tiles[t].first;
+                int j0 = tiles[t].second;
+                int i1 = std::min(i0+tile_size, n_rows);
+                int j1 = std::min(j0+tile_size, n_cols);
+                for (int i=i0; i<i1; ++i) {
+                    DMapMatrix *dmap1 = dset1->get(i);
+                    for (int k=0; k<n_top; ++k) warm[k].resize(0, false);
+                    for (int j=(symmetric) ? std::max(i, j0) : j0; j<j1; ++j) {
+                        if (skip_disjoint && !dset1->overlaps(i, dset2, j)) {
+                            // No shared channels: base kernel, hence also top kernel, vanish
+                            for (int k=0; k<n_top; ++k) (*outputs[k])(i,j) = 0.0;
+                            continue;
+                        }
+                        DMapMatrix *dmap2 = dset2->get(j);
+                        Kij.resize(dmap1->rows(), dmap2->rows(), false);
+                        basekernel->evaluate(dmap1, dmap2, Kij);
+                        for (int k=0; k<n_top; ++k) {
+                            (*outputs[k])(i,j) = topkernels[k]->evaluateWarm(Kij, warm[k]);
+                        }
+                    }
+                }
+            } catch (...) {
+                #pragma omp critical (kernel_error)
+                {
+                    if (!error) error = std::current_exception();
+                    #pragma omp atomic write
+                    failed = true;
+                }
+                continue;
+            }
+            #pragma omp critical (kernel_progress)
+            {
+                n_done += 1;
+                GLOG() << "\r" << "Tile " << n_done << "/" << n_tiles << std::flush;
+            }
         }
     }
     GLOG() << std::endl;
+    if (error) std::rethrow_exception(error);
 }
 
 double Kernel::evaluate(DMapMatrix *dmap1, DMapMatrix *dmap2) {
@@ -340,20 +1187,90 @@ void Kernel::evaluateAll(DMapMatrixSet *dset1, DMapMatrixSet *dset2,
     int n_rows = dset1->size();
     int n_cols = dset2->size();
     this->clearThenAllocateOutput(n_rows, n_cols);
-    int i_row = 0;
-    for (auto it=dset1->begin(); it!=dset1->end(); ++it, ++i_row) {
-        GLOG() << "\r" << "Row " << i_row+1 << "/" << n_rows << std::flush;
-        int j_col = (symmetric) ? i_row : 0;
-        for (auto jt=(symmetric) ? it : dset2->begin(); jt!=dset2->end(); ++jt, ++j_col) {
-            DMapMatrix::matrix_t Kij((*it)->rows(), (*jt)->rows());
-            //dmm_inner_product(*(*it), *(*jt), power, filter, Kij);
-            basekernel->evaluate(*it, *jt, Kij);
-            for (int k=0; k<topkernels.size(); ++k) {
-                (*kernelmats_out[k])(i_row, j_col) = topkernels[k]->evaluate(Kij);
+    basekernel->prepare(dset1);
+    if (!symmetric) basekernel->prepare(dset2);
+    this->evaluateTiles(dset1, dset2, symmetric, kernelmats_out);
+    if (normalize) this->normalizeOutputs(dset1, dset2, symmetric, kernelmats_out);
+    basekernel->finish();
+}
+
+void Kernel::extendBlocks(DMapMatrixSet *dset_old, DMapMatrixSet *dset_new,
+        DMapMatrix::matrix_t &K_cross, DMapMatrix::matrix_t &K_new) {
+    if (basekernel == NULL || topkernels.size() == 0)
+        throw soap::base::SanityCheckFailed("Kernel object not initialized");
+    int n_old = dset_old->size();
+    int n_new = dset_new->size();
+    K_cross.resize(n_old, n_new, false);
+    K_new.resize(n_new, n_new, false);
+    for (int i=0; i<n_new; ++i) {
+        for (int j=0; j<n_old; ++j) K_cross(j,i) = 0.0;
+        for (int j=0; j<n_new; ++j) K_new(j,i) = 0.0;
+    }
+    basekernel->prepare(dset_old);
+    basekernel->prepare(dset_new);
+    std::vector<DMapMatrix::matrix_t*> outputs { &K_cross };
+    this->evaluateTiles(dset_old, dset_new, false, outputs);
+    std::vector<DMapMatrix::matrix_t*> outputs_new { &K_new };
+    this->evaluateTiles(dset_new, dset_new, true, outputs_new);
+    if (normalize) {
+        // Blocks hold the first top kernel only, hence row 0 of the 
+        // self-kernels; those of the old set are typically cached already
+        DMapMatrix::matrix_t self_old, self_new;
+        this->evaluateSelf(dset_old, self_old);
+        this->evaluateSelf(dset_new, self_new);
+        for (int i=0; i<n_new; ++i) {
+            for (int j=0; j<n_old; ++j) {
+                double norm = std::sqrt(self_old(0,j)*self_new(0,i));
+                K_cross(j,i) = (norm > 0.) ? K_cross(j,i)/norm : 0.;
+            }
+            for (int j=0; j<=i; ++j) {
+                double norm = std::sqrt(self_new(0,j)*self_new(0,i));
+                K_new(j,i) = (norm > 0.) ? K_new(j,i)/norm : 0.;
             }
         }
     }
-    GLOG() << std::endl;
+    basekernel->finish();
+}
+
+void Kernel::extend(DMapMatrix::matrix_t &K_old, DMapMatrixSet *dset_old, 
+        DMapMatrixSet *dset_new, DMapMatrix::matrix_t &output) {
+    // The old block is copied as is, new entries follow the layout of 
+    // evaluate(..., symmetric=true), i.e., only the upper triangle is filled
+    int n_old = dset_old->size();
+    int n_new = dset_new->size();
+    if (K_old.size1() != n_old || K_old.size2() != n_old)
+        throw soap::base::SanityCheckFailed("Kernel matrix inconsistent with old set");
+    DMapMatrix::matrix_t K_cross, K_new;
+    this->extendBlocks(dset_old, dset_new, K_cross, K_new);
+    output.resize(n_old+n_new, n_old+n_new, false);
+    for (int i=0; i<n_old+n_new; ++i) {
+        for (int j=0; j<n_old+n_new; ++j) {
+            if (i < n_old && j < n_old) output(i,j) = K_old(i,j);
+            else if (i < n_old) output(i,j) = K_cross(i,j-n_old);
+            else if (j >= n_old) output(i,j) = K_new(i-n_old,j-n_old);
+            else output(i,j) = 0.0;
+        }
+    }
+}
+
+boost::python::object Kernel::extendPython(boost::python::object &np_K_old, 
+        DMapMatrixSet *dset_old, DMapMatrixSet *dset_new, std::string np_dtype) {
+    soap::linalg::numpy_converter npc(np_dtype.c_str());
+    DMapMatrix::matrix_t K_old;
+    npc.numpy_to_ublas<DMapMatrix::dtype_t>(np_K_old, K_old);
+    DMapMatrix::matrix_t output;
+    this->extend(K_old, dset_old, dset_new, output);
+    return npc.ublas_to_numpy<DMapMatrix::dtype_t>(output);
+}
+
+boost::python::tuple Kernel::extendBlocksPython(DMapMatrixSet *dset_old, 
+        DMapMatrixSet *dset_new, std::string np_dtype) {
+    soap::linalg::numpy_converter npc(np_dtype.c_str());
+    DMapMatrix::matrix_t K_cross, K_new;
+    this->extendBlocks(dset_old, dset_new, K_cross, K_new);
+    return bpy::make_tuple(
+        npc.ublas_to_numpy<DMapMatrix::dtype_t>(K_cross),
+        npc.ublas_to_numpy<DMapMatrix::dtype_t>(K_new));
 }
 
 double Kernel::evaluateTopkernel(boost::python::object &np_K, std::string np_dtype) {
@@ -370,6 +1287,16 @@ boost::python::object Kernel::attributeTopkernelGetReductionMatrix(
     return npc.ublas_to_numpy<DMapMatrix::dtype_t>(output);
 }
 
+bpy::dict Kernel::getBasekernelInfo() {
+    return basekernel->getInfo();
+}
+
+bpy::dict Kernel::getTopkernelInfo(int slot) {
+    if (slot >= topkernels.size()) 
+        throw soap::base::OutOfRange("Topkernel slot "+lexical_cast<std::string>(slot, ""));
+    return topkernels[slot]->getInfo();
+}
+
 boost::python::object Kernel::attributeLeftPython(DMapMatrix *dmap1, DMapMatrixSet *dset2, 
         std::string np_dtype) {
     soap::linalg::numpy_converter npc(np_dtype.c_str());
@@ -409,14 +1336,23 @@ void Kernel::registerPython() {
         .def("getMetadata", &Kernel::getMetadata, return_value_policy<reference_existing_object>())
         .add_property("n_output", &Kernel::outputSlots)
         .def("getOutput", &Kernel::getOutput)
+        .def("getTopkernelInfo", &Kernel::getTopkernelInfo)
+        .def("getBasekernelInfo", &Kernel::getBasekernelInfo)
         .def("attributeLeft", &Kernel::attributeLeftPython)
         .def("evaluate", evaluatePythonDset)
         .def("evaluate", evaluatePythonDmap)
-        .def("evaluateAll", &Kernel::evaluateAll);
+        .def("evaluateAll", &Kernel::evaluateAll)
+        .def("evaluateSelf", &Kernel::evaluateSelfPython)
+        .def("clearSelf", &Kernel::clearSelf)
+        .add_property("n_self", &Kernel::selfSize)
+        .def("extend", &Kernel::extendPython)
+        .def("extendBlocks", &Kernel::extendBlocksPython);
 }
 
 void BaseKernelFactory::registerAll(void) {
 	BaseKernelCreator().Register<BaseKernelDot>("dot");
+	BaseKernelCreator().Register<BaseKernelMaclaurin>("dot-maclaurin");
+	BaseKernelCreator().Register<BaseKernelNystrom>("dot-nystrom");
 }
 
 void TopKernelFactory::registerAll(void) {
@@ -1,6 +1,8 @@
 #ifndef _SOAP_DMAP_KERNEL_HPP
 #define _SOAP_DMAP_KERNEL_HPP
 
+#include <list>
+#include <unordered_map>
 #include "soap/base/objectfactory.hpp"
 #include "soap/dmap.hpp"
 
@@ -13,7 +15,70 @@ class BaseKernel
     virtual std::string identify() { return "basekernel"; }
     virtual void configure(Options &options) {;}
     virtual ~BaseKernel() {;}
+    virtual void prepare(DMapMatrixSet *dset) {;}
+    // True if atoms that share no channel have zero base kernel, such that
+    // structure pairs without any overlap in channels can be skipped
+    virtual bool zeroOnDisjoint() { return false; }
+    // Releases state set up by prepare (called after each evaluation)
+    virtual void finish() {;}
     virtual double evaluate(DMapMatrix*, DMapMatrix*, DMapMatrix::matrix_t &K_out) = 0;
+    // Closed form for the sums over all atom pairs, output(i,j) = sum_ab k(x_ia, y_jb),
+    // for all structure pairs (upper triangle if symmetric). Returns false if
+    // the base kernel does not admit one.
+    virtual bool evaluateSummed(DMapMatrixSet *dset1, DMapMatrixSet *dset2, 
+        bool symmetric, DMapMatrix::matrix_t &output) { return false; }
+    virtual bpy::dict getInfo() { return bpy::dict(); }
+};
+
+struct SinkhornInfo
+{
+    int iterations;
+    double error;
+    bool converged;
+    double fill;  // Fraction of kernel entries retained (sparse solves)
+    double bound; // Error estimate versus the dense solution (sparse solves)
+};
+
+class Sinkhorn
+{
+  public:
+    typedef DMapMatrix::matrix_t matrix_t;
+    typedef DMapMatrix::vec_t vec_t;
+    Sinkhorn();
+    void configure(double gamma, double eps, double omega, int max_iter);
+    // Entropy-regularized matching of K with uniform marginals, 
+    // P = diag(u).exp(-(1-K)/gamma).diag(v), solved with stabilized 
+    // (log-domain absorbing) scaling iterations. If f is non-empty 
+    // and sized K.size1(), it is used as warm start for the row 
+    // potentials log(u) and is overwritten with the solution.
+    SinkhornInfo solve(matrix_t &K, matrix_t &P, vec_t &f);
+    // Sparse variant: per row, only entries of exp(-(1-K)/gamma) within a 
+    // factor eps_drop of the row maximum (capped at the topk largest) are 
+    // retained in CSR format, plus each column maximum to keep the problem
+    // feasible. Returns sum_ij P(i,j)K(i,j) via k_out. If check is set, 
+    // info.bound estimates |k_out - k_dense| from the mass that the dropped 
+    // entries would carry at the converged potentials.
+    void configureSparse(int topk, double eps_drop, bool check);
+    bool isSparse() { return sparse_topk > 0 || sparse_eps > 0.; }
+    SinkhornInfo solveSparse(matrix_t &K, double &k_out, vec_t &f);
+  private:
+    struct csr_t
+    {
+        std::vector<int> row_ptr;
+        std::vector<int> cols;
+        std::vector<double> c; // Log-kernel entries -(1-K(i,j))/gamma
+    };
+    void sparsify(matrix_t &K, csr_t &S);
+    void fillScaledKernel(matrix_t &K, vec_t &f, vec_t &g, matrix_t &Kg);
+    void fillScaledKernel(csr_t &S, vec_t &f, vec_t &g, std::vector<double> &Kg);
+    double gamma;     // Temperature
+    double eps;       // Convergence tolerance
+    double omega;     // Mixing factor, successive overrelaxation
+    int max_iter;     // Iteration cap
+    double tau;       // Absorption threshold for the scaling vectors
+    int sparse_topk;  // Max. entries per row retained, <= 0: no cap
+    double sparse_eps; // Relative drop threshold, <= 0: no threshold
+    bool sparse_check; // Estimate the error versus the dense solution
 };
 
 class TopKernel
@@ -25,12 +90,37 @@ class TopKernel
     virtual void configure(Options &options) {;}
     double evaluateNumpy(boost::python::object &np_K, std::string np_dtype);
     virtual double evaluate(DMapMatrix::matrix_t &K) = 0;
+    // Evaluation with state carried over between neighbouring matrix entries
+    virtual double evaluateWarm(DMapMatrix::matrix_t &K, DMapMatrix::vec_t &warm) {
+        return this->evaluate(K);
+    }
+    virtual bpy::dict getInfo() { return bpy::dict(); }
     virtual void attributeGetReductionMatrix(
         DMapMatrix::matrix_t &K, DMapMatrix::matrix_t &P) = 0;
     virtual void attributeLeft(DMapMatrix::matrix_t &K, 
         DMapMatrix::matrix_t &K_out, int i_off, int j_off) = 0;
 };
 
+class SelfKernelCache
+{
+    // Self-similarities k(A,A), one value per top kernel, keyed by the content
+    // hash of A; least recently used entries are dropped beyond max_items
+  public:
+    typedef std::vector<double> entry_t;
+    SelfKernelCache() : max_items(65536) {;}
+    void setCapacity(int n);
+    // Returns NULL if absent, otherwise marks the entry as most recently used
+    entry_t *find(uint64_t key);
+    void put(uint64_t key, const entry_t &entry);
+    void clear() { items.clear(); index.clear(); }
+    int size() { return items.size(); }
+  private:
+    typedef std::list<std::pair<uint64_t, entry_t>> list_t;
+    int max_items;
+    list_t items; // Most recently used first
+    std::unordered_map<uint64_t, list_t::iterator> index;
+};
+
 class Kernel
 {
   public:
@@ -60,12 +150,46 @@ class Kernel
         DMapMatrixSet *dset1,
         DMapMatrixSet *dset2,
         bool symmetric);
+    // Self-similarities k(A,A), one row per top kernel, cached by content hash
+    void evaluateSelf(
+        DMapMatrixSet *dset,
+        DMapMatrix::matrix_t &output);
+    boost::python::object evaluateSelfPython(
+        DMapMatrixSet *dset,
+        std::string np_dtype);
+    void clearSelf() { self_kernels.clear(); }
+    int selfSize() { return self_kernels.size(); }
+    // Incremental extension of a symmetric kernel matrix by new structures:
+    // only the cross block (old x new) and the new diagonal block are evaluated.
+    // As for evaluate, the blocks hold the first top kernel only, which is 
+    // also the one used for normalization
+    void extendBlocks(
+        DMapMatrixSet *dset_old,
+        DMapMatrixSet *dset_new,
+        DMapMatrix::matrix_t &K_cross,
+        DMapMatrix::matrix_t &K_new);
+    void extend(
+        DMapMatrix::matrix_t &K_old,
+        DMapMatrixSet *dset_old,
+        DMapMatrixSet *dset_new,
+        DMapMatrix::matrix_t &output);
+    boost::python::object extendPython(
+        boost::python::object &np_K_old,
+        DMapMatrixSet *dset_old,
+        DMapMatrixSet *dset_new,
+        std::string np_dtype);
+    boost::python::tuple extendBlocksPython(
+        DMapMatrixSet *dset_old,
+        DMapMatrixSet *dset_new,
+        std::string np_dtype);
     double evaluateTopkernel(
         boost::python::object &np_K, 
         std::string np_dtype);
     boost::python::object attributeTopkernelGetReductionMatrix(
         boost::python::object &np_K,
         std::string np_dtype);
+    bpy::dict getTopkernelInfo(int slot);
+    bpy::dict getBasekernelInfo();
     boost::python::object attributeLeftPython(
         DMapMatrix *dmap1,
         DMapMatrixSet *dset2,
@@ -77,8 +201,23 @@ class Kernel
     void addTopkernel(Options &options);
     static void registerPython();
   private:
+    void evaluateTiles(
+        DMapMatrixSet *dset1,
+        DMapMatrixSet *dset2,
+        bool symmetric,
+        std::vector<DMapMatrix::matrix_t*> &outputs);
+    void normalizeOutputs(
+        DMapMatrixSet *dset1,
+        DMapMatrixSet *dset2,
+        bool symmetric,
+        std::vector<DMapMatrix::matrix_t*> &outputs);
     BaseKernel *basekernel;
     metadata_t *metadata;
+    int n_threads; // Threads over structure pairs, <= 0: all available
+    int tile_size; // Edge length of the (i,j) tiles distributed over threads
+    bool closed_form; // Opt-in: summed structure descriptors if all top kernels are averages
+    bool normalize; // Return k(A,B)/sqrt(k(A,A)k(B,B)), with cached k(A,A)
+    SelfKernelCache self_kernels;
     std::vector<TopKernel*> topkernels;
     std::vector<output_t*> kernelmats_out;
 };
@@ -88,10 +227,91 @@ class BaseKernelDot : public BaseKernel
   public:
     BaseKernelDot();
     void configure(Options &options);
+    void prepare(DMapMatrixSet *dset);
+    void finish();
+    // Only with an index built by prepare: one built earlier by the caller 
+    // may be stale, since in-place changes to the DMaps go unnoticed
+    bool zeroOnDisjoint() { return index && exponent > 0.; }
     double evaluate(DMapMatrix*, DMapMatrix*, DMapMatrix::matrix_t &K_out);
+    bool evaluateSummed(DMapMatrixSet *dset1, DMapMatrixSet *dset2, 
+        bool symmetric, DMapMatrix::matrix_t &output);
   private:
     double exponent;
     bool filter;
+    bool pack; // Pack structures into dense channel blocks prior to evaluation
+    std::vector<DMapMatrix*> packed; // Packed by prepare, released by finish
+    bool index; // Build channel index to skip structure pairs without shared channels
+};
+
+class BaseKernelEmbedded : public BaseKernel
+{
+    // Approximates the dot base kernel (x.y)^exponent by the inner product
+    // phi(x).phi(y) of dense, low-dimensional feature maps, such that 
+    // the atom-atom kernel of a structure pair reduces to one small GEMM
+  public:
+    typedef DMapMatrix::matrix_t matrix_t;
+    BaseKernelEmbedded();
+    virtual ~BaseKernelEmbedded();
+    void configure(Options &options);
+    void prepare(DMapMatrixSet *dset);
+    void finish();
+    double evaluate(DMapMatrix*, DMapMatrix*, DMapMatrix::matrix_t &K_out);
+    bool evaluateSummed(DMapMatrixSet *dset1, DMapMatrixSet *dset2, 
+        bool symmetric, DMapMatrix::matrix_t &output);
+    bpy::dict getInfo();
+  protected:
+    void embedSummed(DMapMatrixSet *dset, matrix_t &Phi);
+    virtual void fit(DMapMatrixSet *dset) {;}
+    virtual int dimension() = 0;
+    virtual void embed(DMap *x, double *phi) = 0;
+    void embedMatrix(DMapMatrix *dmm, matrix_t &Phi);
+    void estimateError(DMapMatrixSet *dset);
+    double exponent;
+    bool filter;
+    int seed;
+    int n_threads;   // Threads over structures in prepare, <= 0: all available
+    int n_samples;   // Atom pairs sampled to estimate the approximation error, 0: off
+    double tol;      // Warn if the relative rms error exceeds this threshold
+    double error_rms;
+    double error_max;
+    std::map<DMapMatrix*, matrix_t*> embeddings; // Cached per evaluation
+};
+
+class BaseKernelMaclaurin : public BaseKernelEmbedded
+{
+    // Random Maclaurin features for integer exponents p:
+    // phi_d(x) = D^(-1/2) prod_t (w_dt.x) with Rademacher vectors w_dt, 
+    // such that E[phi(x).phi(y)] = (x.y)^p, with variance ~ 1/D
+  public:
+    BaseKernelMaclaurin();
+    ~BaseKernelMaclaurin();
+    std::string identify() { return "dot-maclaurin"; }
+    void configure(Options &options);
+  protected:
+    int dimension() { return dim; }
+    void embed(DMap *x, double *phi);
+    matrix_t *getWeights(TypeEncoder::code_t code, int length);
+    int dim;
+    int order;
+    std::map<TypeEncoder::code_t, matrix_t*> weights; // Generated per channel on first use
+};
+
+class BaseKernelNystrom : public BaseKernelEmbedded
+{
+    // Nystrom projection onto m landmark atoms: phi(x) = L^-1 k_m(x), where 
+    // L L^T = K_mm is the Cholesky factor of the landmark kernel matrix
+  public:
+    BaseKernelNystrom();
+    std::string identify() { return "dot-nystrom"; }
+    void configure(Options &options);
+  protected:
+    void fit(DMapMatrixSet *dset);
+    int dimension() { return landmarks.rows(); }
+    void embed(DMap *x, double *phi);
+    int n_landmarks;
+    double jitter;
+    DMapMatrix landmarks;
+    matrix_t L;
 };
 
 class TopKernelRematch : public TopKernel
@@ -100,14 +320,33 @@ class TopKernelRematch : public TopKernel
     TopKernelRematch();
     void configure(Options &options);
     double evaluate(DMapMatrix::matrix_t &K);
+    double evaluateWarm(DMapMatrix::matrix_t &K, DMapMatrix::vec_t &warm);
     void attributeGetReductionMatrix(
         DMapMatrix::matrix_t &K, DMapMatrix::matrix_t &P);
     void attributeLeft(DMapMatrix::matrix_t &K, 
         DMapMatrix::matrix_t &K_out, int i_off, int j_off);
+    bpy::dict getInfo();
   private:
+    void record(SinkhornInfo &info);
+    void recordSparse(SinkhornInfo &info);
     double gamma; // Rematch temperature
     double eps;   // Convergence tolerance
     double omega; // Mixing factor, successive overrelaxation
+    int max_iter; // Iteration cap
+    bool warm_start;
+    int sparse_topk;   // Sparse Sinkhorn: entries per row retained
+    double sparse_eps; // Sparse Sinkhorn: relative drop threshold
+    double sparse_tol; // Sparse Sinkhorn: warn if the error estimate exceeds this
+    bool sparse_check; // Sparse Sinkhorn: compute the (dense) error estimate
+    Sinkhorn sinkhorn;
+    // Convergence statistics
+    long n_solves;
+    long n_unconverged;
+    long n_iter_total;
+    int n_iter_max;
+    long n_sparse;
+    double sparse_fill_total;
+    double sparse_bound_max;
 };
 
 class TopKernelCanonical : public TopKernel
@@ -128,6 +367,7 @@ class TopKernelAverage : public TopKernel
 {
   public:
     TopKernelAverage();
+    std::string identify() { return "average"; }
     void configure(Options &options);
     double evaluate(DMapMatrix::matrix_t &K);
     void attributeGetReductionMatrix(
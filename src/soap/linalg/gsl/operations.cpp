@@ -21,6 +21,16 @@ void linalg_dot(ub::vector<float> &x, ub::vector<float> &y, float &r) {
     throw std::runtime_error("gsl::linalg_dot not implemented (only mkl)");
 }
 
+void linalg_dot(double *x, double *y, int n, double &r) {
+    gsl_vector_view gsl_x = gsl_vector_view_array(x, n);
+    gsl_vector_view gsl_y = gsl_vector_view_array(y, n);
+    gsl_blas_ddot(&gsl_x.vector, &gsl_y.vector, &r);
+}
+
+void linalg_dot(float *x, float *y, int n, float &r) {
+    throw std::runtime_error("gsl::linalg_dot not implemented (only mkl)");
+}
+
 void linalg_matrix_vector_dot(
         ub::matrix<double> &A, 
         ub::vector<double> &b, 
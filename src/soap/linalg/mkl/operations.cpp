@@ -23,6 +23,16 @@ void linalg_dot(ub::vector<float> &x, ub::vector<float> &y, float &r) {
     r = cblas_sdot(n, mkl_x, incr, mkl_y, incr);
 }
 
+void linalg_dot(double *x, double *y, int n, double &r) {
+    MKL_INT incr = 1;
+    r = cblas_ddot(MKL_INT(n), x, incr, y, incr);
+}
+
+void linalg_dot(float *x, float *y, int n, float &r) {
+    MKL_INT incr = 1;
+    r = cblas_sdot(MKL_INT(n), x, incr, y, incr);
+}
+
 void linalg_matrix_vector_dot(
     ub::matrix<double> &A, 
     ub::vector<double> &b, 
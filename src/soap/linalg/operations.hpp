@@ -19,6 +19,11 @@ namespace soap { namespace linalg {
         ub::vector<float> &y, 
         float &c);
 
+    // Dot product on raw contiguous buffers of length n
+    void linalg_dot(double *x, double *y, int n, double &c);
+
+    void linalg_dot(float *x, float *y, int n, float &c);
+
     // Standard (inner) matrix-vector product c = alpha*A^(t).b + beta*c
     void linalg_matrix_vector_dot(
         ub::matrix<double> &A, 
@@ -2,6 +2,10 @@
 #include <assert.h>
 #include <fstream>
 #include <numeric>
+#include <unordered_map>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 #include <boost/archive/binary_oarchive.hpp>
 #include <boost/archive/binary_iarchive.hpp>
 #include <boost/python/suite/indexing/vector_indexing_suite.hpp>
@@ -657,9 +661,18 @@ bool FNodeCheck::check(FNode* fnode) {
     return ok;
 }
 
-FGraph::FGraph(Options &options_ref) : options(&options_ref) {
+FGraph::FGraph(Options &options_ref) : options(&options_ref), apply_block_size(256),
+        apply_buffer_mb(256.), apply_threads(1), apply_columnwise(true) {
     GLOG() << "Creating FGraph" << std::endl;
     correlation_measure = options->get<std::string>("correlation_measure");
+    if (options->hasKey("apply_block_size"))
+        apply_block_size = options->get<int>("apply_block_size");
+    if (options->hasKey("apply_buffer_mb"))
+        apply_buffer_mb = options->get<double>("apply_buffer_mb");
+    if (options->hasKey("apply_threads"))
+        apply_threads = options->get<int>("apply_threads");
+    if (options->hasKey("apply_columnwise"))
+        apply_columnwise = options->get<bool>("apply_columnwise");
     // Unary ops
     uop_map["I"] = OP_MAP::get("I");
     uop_map["e"] = OP_MAP::get("e");
@@ -801,7 +814,99 @@ boost::python::object FGraph::applyNumpy(boost::python::object &np_input, std::s
     return npc.ublas_to_numpy<dtype_t>(output);
 }
 
+boost::python::object FGraph::applyRowwiseNumpy(boost::python::object &np_input, std::string np_dtype) {
+    matrix_t input;
+    soap::linalg::numpy_converter npc(np_dtype.c_str());
+    npc.numpy_to_ublas<dtype_t>(np_input, input);
+    matrix_t output = zero_matrix_t(input.size1(), fnodes.size());
+    this->applyRowwise(input, output);
+    return npc.ublas_to_numpy<dtype_t>(output);
+}
+
 void FGraph::apply(matrix_t &input, matrix_t &output) {
+    // Column-wise evaluation: nodes are processed in the order in which they
+    // were generated (i.e., parents before children), each over a whole block
+    // of samples at once, reading its parents' columns from a node-major
+    // buffer. The virtual dispatch is thus paid once per node and block
+    // rather than once per node and sample. The block size is bounded such 
+    // that the buffers of all threads stay within apply_buffer_mb.
+    assert(input.size2() == root_fnodes.size() && "Input size inconsistent with graph");
+    assert(output.size1() == input.size1() && output.size2() == fnodes.size()
+        && "Output size inconsistent with graph");
+    int n_samples = input.size1();
+    int n_roots = root_fnodes.size();
+    int n_nodes = fnodes.size();
+    if (n_samples == 0 || n_nodes == 0) return;
+    if (!apply_columnwise) {
+        this->applyRowwise(input, output);
+        return;
+    }
+    // Operators without a column implementation: fall back to row-wise mode
+    std::vector<const double*> no_args;
+    for (int f=n_roots; f<n_nodes; ++f) {
+        if (!fnodes[f]->getOperator()->evaluateColumn(no_args, NULL, 0, 1.)) {
+            GLOG() << "Operator '" << fnodes[f]->getOperatorTag() 
+                << "' not column-enabled, applying row-wise" << std::endl;
+            this->applyRowwise(input, output);
+            return;
+        }
+    }
+    // Column index of each node's parents
+    std::unordered_map<FNode*, int> node_idx;
+    node_idx.reserve(n_nodes);
+    for (int f=0; f<n_nodes; ++f) node_idx[fnodes[f]] = f;
+    std::vector<std::vector<int> > par_idx(n_nodes);
+    std::vector<double> scale(n_nodes);
+    for (int f=0; f<n_nodes; ++f) {
+        scale[f] = fnodes[f]->getUnitPrefactor()*fnodes[f]->getPrefactor();
+        if (f < n_roots) continue;
+        for (auto par: fnodes[f]->getParents()) {
+            assert(node_idx.find(par) != node_idx.end() && "Parent not registered with graph");
+            par_idx[f].push_back(node_idx[par]);
+        }
+    }
+    int n_threads = 1;
+    #ifdef _OPENMP
+    n_threads = (apply_threads > 0) ? apply_threads : omp_get_max_threads();
+    #endif
+    double budget = apply_buffer_mb*1024.*1024./(n_threads*sizeof(double)*n_nodes);
+    int block_size = std::max(1, std::min(apply_block_size, n_samples));
+    if (budget < block_size) block_size = std::max(1, int(budget));
+    int n_blocks = (n_samples + block_size - 1)/block_size;
+    #pragma omp parallel num_threads(n_threads)
+    {
+        std::vector<double> buffer(size_t(n_nodes)*block_size);
+        std::vector<const double*> args;
+        #pragma omp for schedule(dynamic)
+        for (int blk=0; blk<n_blocks; ++blk) {
+            int i0 = blk*block_size;
+            int n = std::min(block_size, n_samples-i0);
+            // Seed roots
+            for (int r=0; r<n_roots; ++r) {
+                double *col = &buffer[r*block_size];
+                for (int i=0; i<n; ++i) {
+                    col[i] = scale[r]*input(i0+i,r);
+                    output(i0+i,r) = input(i0+i,r);
+                }
+            }
+            // Generated nodes, parents before children
+            for (int f=n_roots; f<n_nodes; ++f) {
+                args.clear();
+                for (int p: par_idx[f]) args.push_back(&buffer[p*block_size]);
+                fnodes[f]->getOperator()->evaluateColumn(
+                    args, &buffer[f*block_size], n, scale[f]);
+            }
+            // Scatter into (row-major) output
+            for (int i=0; i<n; ++i) {
+                for (int f=n_roots; f<n_nodes; ++f) {
+                    output(i0+i,f) = buffer[f*block_size+i];
+                }
+            }
+        }
+    }
+}
+
+void FGraph::applyRowwise(matrix_t &input, matrix_t &output) {
     assert(input.size2() == root_fnodes.size() && "Input size inconsistent with graph");
     // NOTE It is important that we evaluate all nodes in the order in
     // which they are stored in this->fnodes, i.e., in the order in which
@@ -906,6 +1011,7 @@ void FGraph::registerPython() {
             &FGraph::beginNodes, &FGraph::endNodes))
         .def("evaluateSingleNode", &FGraph::evaluateSingleNodeNumpy)
         .def("apply", &FGraph::applyNumpy)
+        .def("applyRowwise", &FGraph::applyRowwiseNumpy)
         .def("applyAndCorrelate", &FGraph::applyAndCorrelateNumpy);    
     class_<nodelist_t>("FNodeList")
         .def(vector_indexing_suite<nodelist_t>());
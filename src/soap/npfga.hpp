@@ -242,6 +242,9 @@ class Operator
     virtual std::string format(std::vector<std::string> &args) { assert(false); }
     virtual double evaluate(std::vector<FNode*> &fnodes) { return -1; }
     virtual double evaluateRecursive(std::vector<FNode*> &fnodes) { return -1; }
+    // Column-wise evaluation: out[i] = scale*op(a[0][i], ...) for i < n;
+    // returns false if not supported by the operator
+    virtual bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) { return false; }
   protected:
     virtual bool checkInput(FNode *f1) { assert(false); }
     virtual FNode* generate(FNode *f1) { assert(false); }
@@ -263,6 +266,10 @@ class OIdent : public Operator
     OIdent() { tag = "I"; }
     double evaluate(std::vector<FNode*> &fnodes) { return fnodes[0]->getValue(); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return fnodes[0]->evaluateRecursive(); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(a[0][i]);
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -278,6 +285,10 @@ class OExp : public Operator
     std::string format(std::vector<std::string> &args);
     double evaluate(std::vector<FNode*> &fnodes) { return std::exp(fnodes[0]->getValue()); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return std::exp(fnodes[0]->evaluateRecursive()); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(std::exp(a[0][i]));
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -293,6 +304,10 @@ class OLog : public Operator
     std::string format(std::vector<std::string> &args);
     double evaluate(std::vector<FNode*> &fnodes) { return std::log(fnodes[0]->getValue()); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return std::log(fnodes[0]->evaluateRecursive()); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(std::log(a[0][i]));
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -308,6 +323,10 @@ class OMod : public Operator
     std::string format(std::vector<std::string> &args);
     double evaluate(std::vector<FNode*> &fnodes) { return std::abs(fnodes[0]->getValue()); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return std::abs(fnodes[0]->evaluateRecursive()); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(std::abs(a[0][i]));
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -322,6 +341,10 @@ class OSqrt : public Operator
     FNode *generate(FNode *f1);
     double evaluate(std::vector<FNode*> &fnodes) { return std::sqrt(fnodes[0]->getValue()); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return std::sqrt(fnodes[0]->evaluateRecursive()); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(std::sqrt(a[0][i]));
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -336,6 +359,10 @@ class OInv : public Operator
     FNode *generate(FNode *f1);
     double evaluate(std::vector<FNode*> &fnodes) { return 1./fnodes[0]->getValue(); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return 1./fnodes[0]->evaluateRecursive(); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(1./a[0][i]);
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -350,6 +377,10 @@ class O2 : public Operator
     FNode *generate(FNode *f1);
     double evaluate(std::vector<FNode*> &fnodes) { return std::pow(fnodes[0]->getValue(), 2.0); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return std::pow(fnodes[0]->evaluateRecursive(), 2.0); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(a[0][i]*a[0][i]);
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -365,6 +396,10 @@ class OPlus : public Operator
     std::string format(std::vector<std::string> &args);
     double evaluate(std::vector<FNode*> &fnodes) { return fnodes[0]->getValue()+fnodes[1]->getValue(); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return fnodes[0]->evaluateRecursive()+fnodes[1]->evaluateRecursive(); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(a[0][i]+a[1][i]);
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -379,6 +414,10 @@ class OMinus : public Operator
     FNode *generate(FNode *f1, FNode *f2);
     double evaluate(std::vector<FNode*> &fnodes) { return fnodes[0]->getValue()-fnodes[1]->getValue(); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return fnodes[0]->evaluateRecursive()-fnodes[1]->evaluateRecursive(); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(a[0][i]-a[1][i]);
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -394,6 +433,10 @@ class OMult : public Operator
     std::string format(std::vector<std::string> &args);
     double evaluate(std::vector<FNode*> &fnodes) { return fnodes[0]->getValue()*fnodes[1]->getValue(); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return fnodes[0]->evaluateRecursive()*fnodes[1]->evaluateRecursive(); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(a[0][i]*a[1][i]);
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -408,6 +451,10 @@ class ODiv : public Operator
     FNode *generate(FNode *f1, FNode *f2);
     double evaluate(std::vector<FNode*> &fnodes) { return fnodes[0]->getValue()/fnodes[1]->getValue(); }
     double evaluateRecursive(std::vector<FNode*> &fnodes) { return fnodes[0]->evaluateRecursive()/fnodes[1]->evaluateRecursive(); }
+    bool evaluateColumn(std::vector<const double*> &a, double *out, int n, double scale) {
+        for (int i=0; i<n; ++i) out[i] = scale*(a[0][i]/a[1][i]);
+        return true;
+    }
     template<class Archive>
     void serialize(Archive &arch, const unsigned int version) {
         arch & boost::serialization::base_object<Operator>(*this);
@@ -439,7 +486,8 @@ class FGraph
   public:
     typedef std::vector<Operator*> op_vec_t;
     typedef std::vector<FNode*>::iterator fgraph_it_t;
-    FGraph() : options(NULL) {;}
+    FGraph() : options(NULL), apply_block_size(256), apply_buffer_mb(256.),
+        apply_threads(1), apply_columnwise(true) {;}
     FGraph(Options &options);
     ~FGraph();
     // Methods
@@ -453,12 +501,14 @@ class FGraph
     void addLayer(std::string uops, std::string bops);
     void generateLayer(op_vec_t &uops, op_vec_t &bops);
     void apply(matrix_t &input, matrix_t &output);
+    void applyRowwise(matrix_t &input, matrix_t &output);
     void applyAndCorrelate(matrix_t &X_in, matrix_t &X_out, matrix_t &Y_in, matrix_t &cov_out);
     void evaluateSingleNode(FNode *fnode, matrix_t &input, matrix_t &output);
     int size() { return fnodes.size(); }
     fgraph_it_t beginNodes() { return fnodes.begin(); }
     fgraph_it_t endNodes() { return fnodes.end(); }
     bpy::object applyNumpy(bpy::object &np_input, std::string np_dtype);
+    bpy::object applyRowwiseNumpy(bpy::object &np_input, std::string np_dtype);
     bpy::object applyAndCorrelateNumpy(bpy::object &np_X, bpy::object &np_y, std::string np_dtype);
     bpy::object evaluateSingleNodeNumpy(FNode *fnode, bpy::object &np_input, std::string np_dtype);
     static void registerPython();
@@ -473,6 +523,10 @@ class FGraph
     std::map<std::string, Operator*> uop_map;
     std::map<std::string, Operator*> bop_map;
     std::map<std::string, FNode*> fnode_map;
+    int apply_block_size;
+    double apply_buffer_mb;
+    int apply_threads; // Threads over sample blocks in apply, <= 0: all available
+    bool apply_columnwise; // false: always use the row-wise fallback in apply
   public:
     // Serialization
     void save(std::string archfile);
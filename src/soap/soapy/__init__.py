@@ -23,13 +23,17 @@ import tuplex
 import tuplex_utils
 import geodesic
 import gylm
+import cache
 
 from wrap import \
     configure, \
     configure_default, \
     configure_default_2d, \
     StructureConverter, \
-    PowerSpectrum
+    PowerSpectrum, \
+    PowerSpectrumStore, \
+    LazyPowerSpectrum, \
+    H5SpectrumSource
 
 XSpace = ExtendableNamespace
 Args = ExtendableNamespace
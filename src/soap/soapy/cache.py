@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import collections
+import numpy as np
+
+def array_digest(a, tol=1e-6):
+    """Hash of an array, with float entries rounded to <tol>"""
+    a = np.asarray(a)
+    if a.dtype.kind == 'f':
+        a = np.round(a/tol).astype('int64')
+    return hashlib.sha1(str(a.shape)+np.ascontiguousarray(a).tostring()).hexdigest()
+
+def structure_hash(config, hyper=None, tol=1e-6):
+    """
+    Content hash of a structure plus calculator hyperparameters
+
+    Parameters
+    ----------
+    config : ASE atoms (or ConfigASE) object
+    hyper : json-serializable dict of calculator settings
+    tol : positions (and other per-atom float arrays) are rounded to this tolerance
+    """
+    h = hashlib.sha1()
+    arrays = getattr(config, "arrays", None)
+    if arrays is None:
+        arrays = {
+            "positions": config.get_positions(),
+            "numbers": config.get_atomic_numbers() }
+    for key in sorted(arrays):
+        h.update(key)
+        h.update(array_digest(arrays[key], tol))
+    cell = getattr(config, "cell", None)
+    if cell is not None:
+        h.update(array_digest(np.array(cell, dtype='float64'), tol))
+    pbc = getattr(config, "pbc", None)
+    if pbc is not None:
+        h.update(np.array(pbc, dtype=bool).tostring())
+    if hyper is not None:
+        h.update(json.dumps(hyper, sort_keys=True, default=str))
+    return h.hexdigest()
+
+class DescriptorCache(object):
+    """
+    LRU cache for descriptor results (numpy arrays or serialized strings),
+    with an optional write-through on-disk layer
+
+    Parameters
+    ----------
+    max_bytes : memory budget of the in-memory LRU; least recently used
+        entries are evicted once exceeded (they remain on disk if path is set)
+    path : directory for on-disk storage, or None for memory only
+    tol : rounding tolerance used by structure_hash
+    """
+    def __init__(self, max_bytes=1024**3, path=None, tol=1e-6):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.tol = tol
+        self.entries = collections.OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+        return
+    def key(self, config, hyper=None):
+        return structure_hash(config, hyper=hyper, tol=self.tol)
+    def __len__(self):
+        return len(self.entries)
+    def __contains__(self, key):
+        return key in self.entries or (self.path is not None \
+            and self.findFile(key) is not None)
+    def clear(self, disk=False):
+        self.entries.clear()
+        self.n_bytes = 0
+        if disk and self.path is not None:
+            for f in os.listdir(self.path):
+                if f.endswith(".npy") or f.endswith(".bin"):
+                    os.remove(os.path.join(self.path, f))
+        return
+    def findFile(self, key):
+        for ext in [".npy", ".bin"]:
+            f = os.path.join(self.path, key+ext)
+            if os.path.isfile(f): return f
+        return None
+    def get(self, key, default=None):
+        if key in self.entries:
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            self.hits += 1
+            return self.export(value)
+        if self.path is not None:
+            f = self.findFile(key)
+            if f is not None:
+                if f.endswith(".npy"): value = np.load(f)
+                else: value = open(f, 'rb').read()
+                self.insert(key, value)
+                self.hits += 1
+                return self.export(value)
+        self.misses += 1
+        return default
+    def put(self, key, value):
+        if isinstance(value, np.ndarray):
+            value = np.copy(value)
+        elif not isinstance(value, str):
+            raise TypeError("Cache values must be numpy arrays or strings")
+        if self.path is not None:
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(self.path, key+".npy"), value)
+            else:
+                with open(os.path.join(self.path, key+".bin"), 'wb') as f:
+                    f.write(value)
+        self.insert(key, value)
+        return
+    def insert(self, key, value):
+        if key in self.entries:
+            self.n_bytes -= self.sizeOf(self.entries.pop(key))
+        size = self.sizeOf(value)
+        if size > self.max_bytes: return
+        self.entries[key] = value
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes:
+            k, v = self.entries.popitem(last=False)
+            self.n_bytes -= self.sizeOf(v)
+        return
+    def export(self, value):
+        # Hand out copies so that callers can modify results in place
+        if isinstance(value, np.ndarray): return np.copy(value)
+        return value
+    def sizeOf(self, value):
+        if isinstance(value, np.ndarray): return value.nbytes
+        return len(value)
+    def stats(self):
+        return { "hits": self.hits, "misses": self.misses,
+            "entries": len(self.entries), "bytes": self.n_bytes }
+
+class ObjectLRU(object):
+    """
+    LRU of materialised objects (e.g., lazily loaded graphs), bounded by 
+    the number of entries rather than by bytes
+
+    Parameters
+    ----------
+    max_items : number of objects kept; least recently used ones are dropped
+    """
+    def __init__(self, max_items=256):
+        self.max_items = max_items
+        self.entries = collections.OrderedDict()
+        return
+    def __len__(self):
+        return len(self.entries)
+    def __contains__(self, key):
+        return key in self.entries
+    def clear(self):
+        self.entries.clear()
+        return
+    def get(self, key, default=None):
+        if key not in self.entries: return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+    def put(self, key, value):
+        if key in self.entries: self.entries.pop(key)
+        if self.max_items <= 0: return
+        self.entries[key] = value
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+        return
@@ -67,6 +67,34 @@ class SuperKernel(object):
             return K
         else:
             assert False
+    def extend(self, K_top_old, K_super_old, d_old, d_new, dtype_str="float64"):
+        """
+        Extends the symmetric top and super kernel matrices of d_old by the
+        ensembles in d_new, evaluating only rows and columns that involve d_new.
+        K_top_old and K_super_old are the full (symmetrized) matrices returned 
+        by evaluate(d_old, d_old, symmetric=True). As for evaluate, K_top holds
+        (and, if the top kernel normalizes, is normalized by) the first top
+        kernel of kernel_top only.
+        """
+        n_old = len(d_old.dset)
+        K_top = self.kernel_top.extend(K_top_old, d_old.dset, d_new.dset, dtype_str)
+        # Complete lower triangle of the new rows
+        K_top[n_old:,0:n_old] = K_top[0:n_old,n_old:].T
+        K_new = np.copy(K_top[n_old:,n_old:])
+        K_top[n_old:,n_old:] = K_new + np.triu(K_new, 1).T
+        slices = list(d_old.slices) + [ np.array(sl)+n_old for sl in d_new.slices ]
+        n_sup_old = len(d_old)
+        n_sup = n_sup_old + len(d_new)
+        K_super = np.zeros((n_sup, n_sup), dtype=K_top.dtype)
+        K_super[0:n_sup_old,0:n_sup_old] = K_super_old
+        for i in range(n_sup):
+            log << log.back << "Row %d/%d" % (i,n_sup) << log.flush
+            for j in range(max(i, n_sup_old), n_sup):
+                kij = self.kernel_super.evaluateTop(K_top[slices[i]][:,slices[j]], dtype_str)
+                K_super[i,j] = kij
+                K_super[j,i] = kij
+        log << log.endl
+        return K_top, K_super
     def attributeLeft(self, dmap_ensemble_probe, dmap_ensemble_set, dtype_str):
         degree = len(dmap_ensemble_probe)
         # Evaluate K_Aa|B
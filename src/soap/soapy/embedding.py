@@ -69,7 +69,7 @@ def soap_configure_default(typemap={}, types=[]):
     log << "Using type encoder with %d types:" % (len(soap.encoder.types())) << ",".join(soap.encoder.types()) << log.endl
     return
 
-def soap_evaluate(configs, options, output_file):
+def soap_evaluate(configs, options, output_file, cache=None):
     dset = soap.DMapMatrixSet()
     for cidx, config in enumerate(configs):
         # Handle exclusions
@@ -84,7 +84,8 @@ def soap_evaluate(configs, options, output_file):
         spectrum = soap.soapy.PowerSpectrum(
             config=config, 
             options=options,
-            label="config-%d" % cidx)
+            label="config-%d" % cidx,
+            cache=cache)
         dmap = spectrum.exportDMapMatrix()
         log << "Config %d: %d centers" % (cidx, dmap.rows) << log.endl
         dset.append(dmap)
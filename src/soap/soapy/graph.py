@@ -7,6 +7,7 @@ import h5py
 import time
 import datetime
 import os
+import atexit
 
 # ============
 # GRAPH OBJECT
@@ -80,7 +81,7 @@ class Graph(object):
         group.attrs['graph_info'] = json.dumps(self.graph_info)
         group.attrs['P_type_str'] = self.P_type_str
         return
-    def load_from_h5(self, h5f):
+    def load_header_from_h5(self, h5f):
         self.idx = h5f.attrs['idx']
         self.label = h5f.attrs['label']
         self.vertex_info = json.loads(h5f.attrs['vertex_info'])
@@ -90,33 +91,112 @@ class Graph(object):
             self.P_type_str = h5f.attrs['P_type_str']
         else:
             self.P_type_str = "<type 'numpy.ndarray'>"
-        if self.P_type_str == "<class 'soap.soapy.kernel.DescriptorMapMatrix'>":
+        return self
+    def load_from_h5(self, h5f):
+        self.load_header_from_h5(h5f)
+        self.P = read_graph_field(h5f, self.P_type_str, 'P')
+        self.P_avg = read_graph_field(h5f, self.P_type_str, 'P_avg')
+        self.R = read_graph_field(h5f, self.P_type_str, 'R')
+        self.C = read_graph_field(h5f, self.P_type_str, 'C')
+        return self
+
+def read_graph_field(h5f, P_type_str, field):
+    """
+    Reads one field of a graph stored via Graph.save_to_h5
+
+    Parameters
+    ----------
+    h5f : HDF5 group of the graph
+    P_type_str : feature matrix type, as stored in the group attributes
+    field : 'P' (features), 'P_avg' (averaged features), 'R' (positions)
+        or 'C' (connectivity)
+    """
+    if field == 'R':
+        return h5f['position_mat'].value
+    elif field == 'C':
+        return h5f['connectivity_mat'].value
+    if P_type_str == "<class 'soap.soapy.kernel.DescriptorMapMatrix'>":
+        if field == 'P':
             # Load list of descriptor maps
-            self.P = soap.soapy.kernel.DescriptorMapMatrix()
+            P = soap.soapy.kernel.DescriptorMapMatrix()
             g0 = h5f['feature_dmap']
             for i in range(len(g0)):
                 Pi = soap.soapy.kernel.DescriptorMap()
                 g1 = g0['%d' % i]
                 for key in g1:
                     Pi[key] = g1[key].value
-                self.P.append(Pi)
+                P.append(Pi)
+            return P
+        elif field == 'P_avg':
             # Load averaged descriptor map
-            self.P_avg = soap.soapy.kernel.DescriptorMap()
+            P_avg = soap.soapy.kernel.DescriptorMap()
             if 'feature_dmap_avg' in h5f:
                 g0_avg = h5f['feature_dmap_avg']
                 for key in g0_avg:
-                    self.P_avg[key] = g0_avg[key].value
-        elif self.P_type_str == "<type 'numpy.ndarray'>":
-            self.P = h5f['feature_mat'].value
+                    P_avg[key] = g0_avg[key].value
+            return P_avg
+    elif P_type_str == "<type 'numpy.ndarray'>":
+        if field == 'P':
+            return h5f['feature_mat'].value
+        elif field == 'P_avg':
             if 'feature_mat_avg' in h5f:
-                self.P_avg = h5f['feature_mat_avg'].value
-            else: self.P_avg = None
-        else: raise NotImplementedError(self.P_type_str)
-        self.R = h5f['position_mat'].value
-        self.C = h5f['connectivity_mat'].value
-        return self
+                return h5f['feature_mat_avg'].value
+            else: return None
+    else: raise NotImplementedError(P_type_str)
+    raise KeyError(field)
 
-def load_graphs(hdf5, n=-1):
+def lazy_graph_field(field):
+    def get(self):
+        if field not in self.loaded:
+            self.loaded[field] = read_graph_field(self.h5f, self.P_type_str, field)
+        return self.loaded[field]
+    def set(self, value):
+        self.loaded[field] = value
+    return property(get, set)
+
+class LazyGraph(Graph):
+    """
+    Graph proxy that keeps a handle to its HDF5 group: only the attributes 
+    (idx, label, vertex and graph info) are read upfront, the feature, 
+    position and connectivity matrices on first access. Hence a kernel 
+    that only uses P_avg does not read P, R or C.
+
+    Pickles as a fully loaded Graph, since HDF5 handles cannot cross 
+    process boundaries.
+    """
+    fields = [ 'P', 'P_avg', 'R', 'C' ]
+    P = lazy_graph_field('P')
+    P_avg = lazy_graph_field('P_avg')
+    R = lazy_graph_field('R')
+    C = lazy_graph_field('C')
+    def __init__(self, h5f):
+        self.h5f = h5f
+        self.loaded = {}
+        self.load_header_from_h5(h5f)
+        return
+    def isLoaded(self, field):
+        return field in self.loaded
+    def release(self):
+        self.loaded = {}
+        return
+    def materialise(self):
+        g = Graph()
+        g.__dict__.update({ k: v for k, v in self.__dict__.items() \
+            if k not in [ 'h5f', 'loaded' ] })
+        for field in self.fields: setattr(g, field, getattr(self, field))
+        return g
+    def __reduce__(self):
+        return (Graph, (), self.materialise().__dict__)
+
+def load_graphs(hdf5, n=-1, lazy=False, n_cache=256):
+    """
+    Loads the graphs stored in group 'graphs' of file hdf5. With lazy=True, 
+    returns an H5GraphSource instead of a list, which hands out LazyGraph 
+    proxies (at most n_cache of them kept in memory) without reading 
+    the file upfront.
+    """
+    if lazy:
+        return H5GraphSource(hdf5, n=n, n_cache=n_cache)
     h = h5py.File(hdf5, 'r')
     gsec = h['graphs']
     if n == None or n < 0: n = len(gsec)
@@ -183,12 +263,49 @@ class BaseKernelDot(object):
     def compute(self, X, Y):
         return self.delta**2 * X.dot(Y.T)**self.xi
 
-class TopKernelRematch(object):
+class TopKernel(object):
+    """
+    Common base of the top kernels. Self-similarities k(g,g) are cached
+    per graph, keyed by a content hash of its descriptors (key='hash') or
+    by (g.idx, g.label) (key='id'), such that normalised evaluations
+    k(g1,g2)/sqrt(k(g1,g1)k(g2,g2)) rarely recompute a diagonal entry.
+    The cache keeps the options["cache_size"] most recently used entries.
+    """
     def __init__(self, options, basekernel):
-        self.gamma = options['gamma']
         self.basekernel = basekernel
+        self.key_type = options["cache_key"] if "cache_key" in options else "hash"
+        self.self_kernels = soap.soapy.cache.ObjectLRU(
+            options["cache_size"] if "cache_size" in options else 65536)
+        return
+    def key(self, g):
+        if self.key_type == "id": return (g.idx, g.label)
+        return soap.soapy.cache.array_digest(g.P)
+    def computeSelf(self, g, log=None):
+        key = self.key(g)
+        k = self.self_kernels.get(key)
+        if k is None:
+            k = self.evaluate(g, g, log=log)
+            if type(k) == tuple: k = k[0]
+            self.self_kernels.put(key, k)
+        return k
+    def clearSelf(self):
+        self.self_kernels.clear()
+        return
+    def compute(self, g1, g2, log=None, normalize=False):
+        k = self.evaluate(g1, g2, log=log)
+        if not normalize: return k
+        norm = (self.computeSelf(g1)*self.computeSelf(g2))**0.5
+        if type(k) == tuple: return (k[0]/norm,) + k[1:]
+        return k/norm
+    def preprocess(self, g, log=None):
+        return g
+
+class TopKernelRematch(TopKernel):
+    def __init__(self, options, basekernel):
+        TopKernel.__init__(self, options, basekernel)
+        self.gamma = options['gamma']
         return
-    def compute(self, g1, g2, log=None):
+    def evaluate(self, g1, g2, log=None):
         if log: log << "[Kernel] %s %s" % (g1.graph_info['label'], g2.graph_info['label']) << log.endl
         K_base = self.basekernel.compute(g1.P, g2.P)
         # Only works with float64 (due to C-casts?) ...
@@ -199,11 +316,11 @@ class TopKernelRematch(object):
     def preprocess(self, g, log=None):
         return g
 
-class TopKernelCanonical(object):
+class TopKernelCanonical(TopKernel):
     def __init__(self, options, basekernel):
+        TopKernel.__init__(self, options, basekernel)
         self.xi = options['xi']
-        self.basekernel = basekernel
-    def compute(self, g1, g2, log=None):
+    def evaluate(self, g1, g2, log=None):
         if log: log << "[Kernel] %s %s" % (g1.graph_info['label'], g2.graph_info['label']) << log.endl
         K_base = self.basekernel.compute(g1.P, g2.P)
         k_top = soap.soapy.lamatch.reduce_kernel_canonical(K_base, self.xi)
@@ -211,14 +328,18 @@ class TopKernelCanonical(object):
     def preprocess(self, g, log=None):
         return g
 
-class TopKernelRematchHierarchical(object):
+class TopKernelRematchHierarchical(TopKernel):
     def __init__(self, options, basekernel):
+        TopKernel.__init__(self, options, basekernel)
         self.gamma = options['gamma']
-        self.basekernel = basekernel
         self.bond_order = options['bond-order']
         self.concatenate = options['concatenate']
         return
-    def compute(self, g1, g2, log=None):
+    def key(self, g):
+        if self.key_type == "id": return (g.idx, g.label)
+        return soap.soapy.cache.array_digest(np.concatenate(
+            [ g.P ] + [ g.P_avg_n_dict[n] for n in self.concatenate ], axis=1))
+    def evaluate(self, g1, g2, log=None):
         K_base = self.basekernel.compute(g1.P, g2.P)
         for n in self.concatenate:
             K_base = K_base*self.basekernel.compute(g1.P_avg_n_dict[n], g2.P_avg_n_dict[n])
@@ -291,12 +412,12 @@ class TopKernelRematchHierarchical(object):
         #g.B = B_idcs
         return
 
-class TopKernelRematchAtomic(object):
+class TopKernelRematchAtomic(TopKernel):
     def __init__(self, options, basekernel):
+        TopKernel.__init__(self, options, basekernel)
         self.gamma = options['gamma']
-        self.basekernel = basekernel
         return
-    def compute(self, g1, g2, log=None):
+    def evaluate(self, g1, g2, log=None):
         if log: log << "[Kernel] %s %s" % (g1.graph_info['label'], g2.graph_info['label']) << log.endl
         K_base = self.basekernel.compute(g1.P, g2.P)
         # Only works with float64 (due to C-casts?) ...
@@ -308,14 +429,14 @@ class TopKernelRematchAtomic(object):
     def preprocess(self, g, log=None):
         return g
 
-class TopKernelAverage(object):
+class TopKernelAverage(TopKernel):
     def __init__(self, options, basekernel):
-        self.basekernel = basekernel
+        TopKernel.__init__(self, options, basekernel)
         self.normalise = True
         if "normalise" in options:
             self.normalise = options["normalise"]
         return
-    def compute(self, g1, g2, log=None):
+    def evaluate(self, g1, g2, log=None):
         p1_avg = np.average(g1.P, axis=0)
         p2_avg = np.average(g2.P, axis=0)
         if self.normalise:
@@ -382,6 +503,172 @@ def mp_compute_graph(
         graph_info=config.info)
     return graph
 
+class GraphBatch(object):
+    """
+    Compact storage of a batch of graphs: concatenated feature and position 
+    matrices with an offset index, connectivity in CSR form (local column 
+    indices), plus per-graph metadata. Indexing returns Graph objects whose 
+    feature and position matrices are views into the batch arrays.
+    Graphs must carry numpy feature matrices.
+    """
+    def __init__(self, P=None, R=None, offsets=None, 
+            C_indptr=None, C_indices=None, C_offsets=None, C_dims=None,
+            meta=None):
+        self.P = P
+        self.R = R
+        self.offsets = offsets
+        self.C_indptr = C_indptr
+        self.C_indices = C_indices
+        self.C_offsets = C_offsets
+        self.C_dims = C_dims
+        self.meta = meta if meta is not None else []
+        return
+    @staticmethod
+    def fromArrays(features, positions, connectivities, meta):
+        offsets = np.concatenate([[0], np.cumsum([ X.shape[0] for X in features ])]).astype('int64')
+        C_dims = np.array([ C.shape[0] if C.size > 0 else 0 for C in connectivities ], dtype='int64')
+        C_offsets = np.concatenate([[0], np.cumsum(C_dims)]).astype('int64')
+        rows, cols = [], []
+        for C, c0 in zip(connectivities, C_offsets[:-1]):
+            if C.size == 0: continue
+            r, c = np.nonzero(C)
+            rows.append(r + c0)
+            cols.append(c)
+        rows = np.concatenate(rows) if len(rows) else np.zeros((0,), dtype='int64')
+        cols = np.concatenate(cols) if len(cols) else np.zeros((0,), dtype='int64')
+        C_indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=C_offsets[-1]))]).astype('int64')
+        return GraphBatch(
+            P=np.concatenate(features) if len(features) else None,
+            R=np.concatenate(positions) if len(positions) else None,
+            offsets=offsets,
+            C_indptr=C_indptr,
+            C_indices=cols.astype('int32'),
+            C_offsets=C_offsets,
+            C_dims=C_dims,
+            meta=meta)
+    @staticmethod
+    def concatenate(batches):
+        batches = [ b for b in batches if len(b) > 0 ]
+        if len(batches) == 0: return GraphBatch(offsets=np.zeros((1,), dtype='int64'))
+        if len(batches) == 1: return batches[0]
+        def cat_offsets(offsets):
+            out = [ offsets[0] ]
+            for o in offsets[1:]: out.append(o[1:] + out[-1][-1])
+            return np.concatenate(out)
+        # CSR row pointers are shifted by the number of entries before each batch
+        # (counted separately: batches without connectivity add no row pointers)
+        C_indptr = [ batches[0].C_indptr ]
+        n_entries = batches[0].C_indptr[-1]
+        for b in batches[1:]:
+            C_indptr.append(b.C_indptr[1:] + n_entries)
+            n_entries += b.C_indptr[-1]
+        meta = []
+        for b in batches: meta.extend(b.meta)
+        return GraphBatch(
+            P=np.concatenate([ b.P for b in batches ]),
+            R=np.concatenate([ b.R for b in batches ]),
+            offsets=cat_offsets([ b.offsets for b in batches ]),
+            C_indptr=np.concatenate(C_indptr),
+            C_indices=np.concatenate([ b.C_indices for b in batches ]),
+            C_offsets=cat_offsets([ b.C_offsets for b in batches ]),
+            C_dims=np.concatenate([ b.C_dims for b in batches ]),
+            meta=meta)
+    def __len__(self):
+        return len(self.meta)
+    def getConnectivity(self, idx):
+        n = self.C_dims[idx]
+        if n == 0: return np.array([], dtype=bool)
+        c0 = self.C_offsets[idx]
+        indptr = self.C_indptr[c0:c0+n+1]
+        C = np.zeros((n, n), dtype=bool)
+        rows = np.repeat(np.arange(n), np.diff(indptr))
+        C[rows, self.C_indices[indptr[0]:indptr[-1]]] = True
+        return C
+    def __getitem__(self, idx):
+        if idx < 0: idx += len(self)
+        if idx < 0 or idx >= len(self): raise IndexError(idx)
+        i0, i1 = self.offsets[idx:idx+2]
+        meta = self.meta[idx]
+        return Graph(
+            idx=meta["idx"],
+            label=meta["label"],
+            feature_mat=self.P[i0:i1],
+            position_mat=self.R[i0:i1],
+            connectivity_mat=self.getConnectivity(idx),
+            vertex_info=meta["vertex_info"],
+            graph_info=meta["graph_info"])
+    def __iter__(self):
+        for idx in range(len(self)): yield self[idx]
+
+def mp_compute_graph_batch(
+        configs,
+        fragment_based,
+        descriptor_type,
+        descriptor_options,
+        log):
+    """
+    Batch variant of mp_compute_graph: converts and describes a list of 
+    configs, with the descriptor options and adaptor set up once per batch, 
+    and returns the graphs as a GraphBatch
+    """
+    if log and len(configs):
+        soap.soapy.util.MP_LOCK.acquire()
+        log << log.back << "[Graph] Processing batch %s ... %s (%d configs)" % (
+            configs[0].info['label'], configs[-1].info['label'], len(configs)) << log.endl
+        soap.soapy.util.MP_LOCK.release()
+    compute_descriptor = DescriptorFactory[descriptor_type]
+    setup = DescriptorSetupFactory[descriptor_type](descriptor_options, fragment_based)
+    features, positions, connectivities, meta = [], [], [], []
+    for config in configs:
+        # NOTE This will reorder the atoms in config if fragment_based
+        config, struct, top, frag_bond_mat, atom_bond_mat, frag_labels, atom_labels = \
+            soap.tools.structure_from_ase(
+                config, 
+                do_partition=fragment_based, 
+                add_fragment_com=fragment_based, 
+                log=None)
+        feature_mat, position_mat, type_vec = compute_descriptor(
+            struct, 
+            descriptor_options, 
+            fragment_based=fragment_based,
+            setup=setup)
+        if fragment_based:
+            connectivities.append(np.asarray(frag_bond_mat))
+            vertex_info = frag_labels
+        else:
+            connectivities.append(np.asarray(atom_bond_mat))
+            vertex_info = type_vec
+        features.append(feature_mat)
+        positions.append(position_mat)
+        meta.append({ "idx": config.info['idx'], "label": str(config.info['label']),
+            "vertex_info": vertex_info, "graph_info": config.info })
+    return GraphBatch.fromArrays(features, positions, connectivities, meta)
+
+def mp_compute_graphs(
+        configs,
+        n_procs,
+        fragment_based,
+        descriptor_type,
+        descriptor_options,
+        batch_size=32,
+        log=None):
+    """
+    Graphs for all configs, computed in batches of batch_size configs per 
+    task, returned as a single GraphBatch
+    """
+    batches = [ configs[b0:b0+batch_size] for b0 in range(0, len(configs), batch_size) ]
+    kwargs = { "fragment_based": fragment_based, "descriptor_type": descriptor_type,
+        "descriptor_options": descriptor_options, "log": log }
+    if n_procs < 2:
+        results = [ mp_compute_graph_batch(b, **kwargs) for b in batches ]
+    else:
+        results = soap.soapy.util.mp_compute_vector(
+            kfct=mp_compute_graph_batch,
+            g_list=batches,
+            n_procs=n_procs,
+            **kwargs)
+    return GraphBatch.concatenate(results)
+
 def mp_compute_kernel_idx_pair(idx1, idx2, kernel, h5f):
     g1 = Graph()
     g2 = Graph()
@@ -390,23 +677,250 @@ def mp_compute_kernel_idx_pair(idx1, idx2, kernel, h5f):
     k = kernel.compute(g1, g2)
     return k
 
-def mp_compute_kernel_g_pair(g1, g2, kernel, h5f):
-    k = kernel.compute(g1, g2)
+def mp_compute_kernel_g_pair(g1, g2, kernel, h5f, normalize=False):
+    k = kernel.compute(g1, g2, normalize=normalize)
+    return k
+
+def mp_compute_kernel_g_list_pair(g_pair, kernel, normalize=False):
+    # Pair convention of util.mp_compute_kernel_blocks
+    k = kernel.compute(g_pair[0], g_pair[1], normalize=normalize)
     return k
 
-def mp_compute_kernel_block_hdf5(block, kernel, log, dtype_result, h5_file):
+_H5_HANDLES = {}
+
+def open_h5_cached(h5_file):
+    # One read-only handle per file and process (handles must not cross a fork),
+    # open until close_h5_cached (e.g., via H5GraphSource.close) or process exit
+    key = (h5_file, os.getpid())
+    if key not in _H5_HANDLES:
+        _H5_HANDLES[key] = h5py.File(h5_file, 'r')
+    return _H5_HANDLES[key]
+
+def close_h5_cached(h5_file=None):
+    # Closes the handles of this process (all files if h5_file is None)
+    pid = os.getpid()
+    for key in list(_H5_HANDLES.keys()):
+        if key[1] != pid or (h5_file is not None and key[0] != h5_file): continue
+        _H5_HANDLES.pop(key).close()
+    return
+
+atexit.register(close_h5_cached)
+
+class H5GraphSource(object):
+    """
+    Sequence view onto the graphs stored in an HDF5 file, handing out 
+    LazyGraph proxies that read their data on access. The n_cache most 
+    recently used proxies (and hence the fields they have read) are kept. 
+    Suited as g_source for util.mp_compute_kernel_blocks.
+    """
+    def __init__(self, h5_file, group='graphs', n=-1, n_cache=256):
+        self.h5_file = h5_file
+        self.group = group
+        f = h5py.File(h5_file, 'r')
+        self.n_graphs = len(f[group])
+        f.close()
+        if n is not None and n >= 0: self.n_graphs = min(n, self.n_graphs)
+        self.cache = soap.soapy.cache.ObjectLRU(n_cache)
+    def __len__(self):
+        return self.n_graphs
+    def __getitem__(self, idx):
+        if idx < 0: idx += self.n_graphs
+        if idx < 0 or idx >= self.n_graphs: raise IndexError(idx)
+        key = (os.getpid(), idx)
+        g = self.cache.get(key)
+        if g is None:
+            h5_graphs = open_h5_cached(self.h5_file)[self.group]
+            g = LazyGraph(h5_graphs['%06d' % idx])
+            self.cache.put(key, g)
+        return g
+    def __iter__(self):
+        for idx in range(self.n_graphs): yield self[idx]
+    def close(self):
+        self.cache.clear()
+        close_h5_cached(self.h5_file)
+        return
+    def __getstate__(self):
+        # Proxies hold HDF5 handles: workers start with an empty cache
+        state = dict(self.__dict__)
+        state["cache"] = soap.soapy.cache.ObjectLRU(self.cache.max_items)
+        return state
+
+class SharedGraphStore(object):
+    """
+    Graph store backed by flat, memory-mapped arrays plus an offset index, 
+    such that worker processes share the descriptor data via the page cache 
+    rather than receiving pickled graphs. Only the file prefix is pickled: 
+    each process maps the arrays once, on first access, and graphs are 
+    handed out as views.
+
+    Files: <prefix>.P.npy (atoms x dim), <prefix>.P_avg.npy (graphs x dim, 
+    optional), <prefix>.R.npy (atoms x 3), <prefix>.C.npy (flattened 
+    connectivity blocks), <prefix>.offsets.npy (graphs+1, into atoms), 
+    <prefix>.meta.json (labels, vertex and graph info)
+
+    Graphs must carry numpy feature matrices (descriptor-map features 
+    are not supported).
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix+'.meta.json') as f:
+            self.meta = json.load(f)
+        self.n_graphs = len(self.meta["graphs"])
+        self.arrays = None
+        self.pid = None
+        return
+    @staticmethod
+    def create(graphs, prefix, dtype=None, log=None):
+        """
+        Writes graphs (list, or e.g. an H5GraphSource) to the store at prefix
+
+        Feature matrices keep the dtype of the source graphs (float64 for 
+        non-floating sources) unless dtype is given: dtype='float32' halves 
+        the size of the store at the cost of precision.
+        """
+        n_graphs = len(graphs)
+        offsets = np.zeros((n_graphs+1,), dtype='int64')
+        meta = []
+        for i in range(n_graphs):
+            g = graphs[i]
+            if g.P_type_str != "<type 'numpy.ndarray'>":
+                raise NotImplementedError(g.P_type_str)
+            offsets[i+1] = offsets[i] + g.R.shape[0]
+            meta.append({ "idx": int(g.idx), "label": g.label, 
+                "vertex_info": g.vertex_info, "graph_info": g.graph_info })
+        g0 = graphs[0]
+        dim = g0.P.shape[1]
+        if dtype is None:
+            dtype = np.asarray(g0.P).dtype
+            if not np.issubdtype(dtype, np.floating): dtype = np.dtype('float64')
+        has_avg = g0.P_avg is not None
+        c_offsets = np.concatenate([[0], np.cumsum(np.diff(offsets)**2)])
+        n_atoms, n_c = int(offsets[-1]), int(c_offsets[-1])
+        P = np.lib.format.open_memmap(prefix+'.P.npy', mode='w+', 
+            dtype=dtype, shape=(n_atoms, dim))
+        R = np.lib.format.open_memmap(prefix+'.R.npy', mode='w+', 
+            dtype='float64', shape=(n_atoms, 3))
+        C = np.lib.format.open_memmap(prefix+'.C.npy', mode='w+', 
+            dtype='float64', shape=(n_c,))
+        P_avg = np.lib.format.open_memmap(prefix+'.P_avg.npy', mode='w+', 
+            dtype=dtype, shape=(n_graphs, dim)) if has_avg else None
+        for i in range(n_graphs):
+            if log: log << log.back << "Writing graph %d/%d" % (i+1, n_graphs) << log.flush
+            g = graphs[i]
+            P[offsets[i]:offsets[i+1]] = g.P
+            R[offsets[i]:offsets[i+1]] = g.R
+            C[c_offsets[i]:c_offsets[i+1]] = np.asarray(g.C).flatten()
+            if has_avg: P_avg[i] = g.P_avg
+        if log: log << log.endl
+        for X in [ P, R, C, P_avg ]:
+            if X is not None: X.flush()
+        np.save(prefix+'.offsets.npy', offsets)
+        with open(prefix+'.meta.json', 'w') as f:
+            json.dump({ "graphs": meta, "dim": dim, "dtype": str(np.dtype(dtype)), 
+                "has_avg": has_avg }, f)
+        return SharedGraphStore(prefix)
+    def attach(self):
+        # Maps the arrays once per process (maps must not cross a fork)
+        if self.arrays is not None and self.pid == os.getpid(): return self
+        offsets = np.load(self.prefix+'.offsets.npy')
+        self.arrays = {
+            "offsets": offsets,
+            "c_offsets": np.concatenate([[0], np.cumsum(np.diff(offsets)**2)]),
+            "P": np.load(self.prefix+'.P.npy', mmap_mode='r'),
+            "R": np.load(self.prefix+'.R.npy', mmap_mode='r'),
+            "C": np.load(self.prefix+'.C.npy', mmap_mode='r'),
+            "P_avg": np.load(self.prefix+'.P_avg.npy', mmap_mode='r') \
+                if self.meta["has_avg"] else None }
+        self.pid = os.getpid()
+        return self
+    def __len__(self):
+        return self.n_graphs
+    def __getitem__(self, idx):
+        self.attach()
+        if idx < 0: idx += self.n_graphs
+        if idx < 0 or idx >= self.n_graphs: raise IndexError(idx)
+        a = self.arrays
+        i0, i1 = a["offsets"][idx:idx+2]
+        c0, c1 = a["c_offsets"][idx:idx+2]
+        meta = self.meta["graphs"][idx]
+        return Graph(
+            idx=meta["idx"],
+            label=meta["label"],
+            feature_mat=a["P"][i0:i1],
+            feature_mat_avg=a["P_avg"][idx] if a["P_avg"] is not None else None,
+            position_mat=a["R"][i0:i1],
+            connectivity_mat=a["C"][c0:c1].reshape((i1-i0, i1-i0)),
+            vertex_info=meta["vertex_info"],
+            graph_info=meta["graph_info"])
+    def __iter__(self):
+        for idx in range(self.n_graphs): yield self[idx]
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["arrays"] = None
+        state["pid"] = None
+        return state
+
+def mp_compute_kernel_matrix_shared(store, kernel, out_file, n_procs, 
+        block_size=256, log=None, **kwargs):
+    """
+    As mp_compute_kernel_matrix_hdf5, for graphs in a SharedGraphStore
+    (or the prefix of one)
+
+    See Also
+    --------
+    soap.soapy.util.mp_compute_kernel_blocks
+    """
+    if isinstance(store, str): store = SharedGraphStore(store)
+    return soap.soapy.util.mp_compute_kernel_blocks(
+        mp_compute_kernel_g_list_pair,
+        store,
+        out_file,
+        n_procs,
+        block_size=block_size,
+        mplog=log,
+        kernel=kernel,
+        **kwargs)
+
+def mp_compute_kernel_block_hdf5(block, kernel, log, dtype_result, h5_file, normalize=False):
+    # The file is opened for this block only: the lazy graphs are done 
+    # with once the block is evaluated, and no handle outlives the task
     rows = list(block[0])
     cols = list(block[1])
-    #soap.soapy.util.MP_LOCK.acquire()
-    f = h5py.File(h5_file, 'r')
-    h5_graphs = f['graphs']
-    g_rows = [ Graph().load_from_h5(h5_graphs['%06d' % i]) for i in rows ]
-    g_cols = [ Graph().load_from_h5(h5_graphs['%06d' % i]) for i in cols ]
-    f.close()
-    #soap.soapy.util.MP_LOCK.release()
-    return mp_compute_kernel_block([g_rows, g_cols], kernel, log, dtype_result)
-
-def mp_compute_kernel_block(block, kernel, log, dtype_result, symmetric=True):
+    h5 = h5py.File(h5_file, 'r')
+    try:
+        h5_graphs = h5['graphs']
+        g_rows = [ LazyGraph(h5_graphs['%06d' % i]) for i in rows ]
+        g_cols = [ LazyGraph(h5_graphs['%06d' % i]) for i in cols ]
+        return mp_compute_kernel_block([g_rows, g_cols], kernel, log, dtype_result, 
+            normalize=normalize)
+    finally:
+        h5.close()
+
+def mp_compute_kernel_matrix_hdf5(h5_file, kernel, out_file, n_procs, 
+        block_size=256, log=None, **kwargs):
+    """
+    Out-of-core kernel matrix between all graphs in h5_file, written 
+    tile by tile to out_file (.h5/.hdf5 or .npy), resumable
+
+    See Also
+    --------
+    soap.soapy.util.mp_compute_kernel_blocks
+    """
+    source = H5GraphSource(h5_file)
+    try:
+        return soap.soapy.util.mp_compute_kernel_blocks(
+            mp_compute_kernel_g_list_pair,
+            source,
+            out_file,
+            n_procs,
+            block_size=block_size,
+            mplog=log,
+            kernel=kernel,
+            **kwargs)
+    finally:
+        source.close()
+
+def mp_compute_kernel_block(block, kernel, log, dtype_result, symmetric=True, normalize=False):
     gi_block = block[0]
     gj_block = block[1]
     if log: 
@@ -417,7 +931,7 @@ def mp_compute_kernel_block(block, kernel, log, dtype_result, symmetric=True):
     for i,gi in enumerate(gi_block):
         for j,gj in enumerate(gj_block):
             if symmetric and gi.idx > gj.idx: pass
-            else: kmat[i,j] = kernel.compute(gi,gj)
+            else: kmat[i,j] = kernel.compute(gi,gj,normalize=normalize)
     return kmat
 
 def matrix_blocks(array, block_size, upper_triangular):
@@ -442,6 +956,13 @@ def matrix_blocks_by_row(array, block_size, upper_triangular):
     return blocks
 
 def read_graph_block(h5_graphs, block, log):
+    """
+    Graphs of block (row and column indices) from a list, or as LazyGraph 
+    proxies from the HDF5 group h5_graphs. The proxies read from the 
+    caller's handle on access, hence the file must stay open until the 
+    block has been evaluated (or the graphs materialised or pickled); 
+    closing it is up to the caller.
+    """
     if log: 
         soap.soapy.util.MP_LOCK.acquire()
         log << "Reading block    %4d:%-4d %4d:%-4d" % (block[0][0], block[0][-1], block[1][0], block[1][-1]) << "PID =" << os.getpid() << log.endl
@@ -452,8 +973,8 @@ def read_graph_block(h5_graphs, block, log):
         g_rows = [ h5_graphs[i] for i in rows ]
         g_cols = [ h5_graphs[j] for j in cols ]
     else:
-        g_rows = [ Graph().load_from_h5(h5_graphs['%06d' % i]) for i in rows ]
-        g_cols = [ Graph().load_from_h5(h5_graphs['%06d' % i]) for i in cols ]
+        g_rows = [ LazyGraph(h5_graphs['%06d' % i]) for i in rows ]
+        g_cols = [ LazyGraph(h5_graphs['%06d' % i]) for i in cols ]
     return [g_rows, g_cols]
 
 # ==========
@@ -507,47 +1028,54 @@ def remove_duplicates(array, key=lambda a: a):
 # DESC WRAPPERS
 # =============
 
-def compute_ftd(struct, options, fragment_based):
-    for atom in struct:
-        atom.sigma = options["fieldtensor.sigma"]
-        log << atom.name << atom.type << atom.weight << atom.sigma << atom.pos << log.endl
-    # OPTIONS
+def setup_descriptor_options(options, fragment_based):
+    """Converts descriptor options into soap.Options, including exclusions"""
     options_soap = soap.Options()
     for key, val in options.items():
         if type(val) == list: continue
         options_soap.set(key, val)
-    # Exclusions
-    excl_targ_list = options['exclude_targets']
-    excl_cent_list = options['exclude_centers']
+    # Exclusions (copied, such that repeated calls do not grow the lists)
+    excl_targ_list = list(options['exclude_targets'])
+    excl_cent_list = list(options['exclude_centers'])
     excl_targ_list.append('COM')
     if not fragment_based:
         excl_cent_list.append('COM')
     options_soap.excludeCenters(excl_cent_list)
     options_soap.excludeTargets(excl_targ_list)
+    return options_soap
+
+def setup_ftd(options, fragment_based):
+    options_soap = setup_descriptor_options(options, fragment_based)
+    adaptor = soap.soapy.kernel.KernelAdaptorFactory["ftd-specific"](
+        {}, 
+        options["type_list"])
+    return options_soap, adaptor
+
+def setup_soap(options, fragment_based):
+    options_soap = setup_descriptor_options(options, fragment_based)
+    adaptor = soap.soapy.kernel.KernelAdaptorFactory[options['kernel.adaptor']](
+        options_soap,
+        types_global=options['type_list'])
+    return options_soap, adaptor
+
+def compute_ftd(struct, options, fragment_based, setup=None):
+    for atom in struct:
+        atom.sigma = options["fieldtensor.sigma"]
+        log << atom.name << atom.type << atom.weight << atom.sigma << atom.pos << log.endl
+    # OPTIONS
+    if setup is None: setup = setup_ftd(options, fragment_based)
+    options_soap, adaptor = setup
     # SPECTRUM
     ftspectrum = soap.FTSpectrum(struct, options_soap)
     ftspectrum.compute()
     # Adapt spectra
-    adaptor = soap.soapy.kernel.KernelAdaptorFactory["ftd-specific"](
-        {}, 
-        options["type_list"])
     IX, IR, types = adaptor.adapt(ftspectrum, return_pos_matrix=True)
     return IX, IR, types
 
-def compute_soap(struct, options, fragment_based=False):
+def compute_soap(struct, options, fragment_based=False, setup=None):
     # OPTIONS
-    options_soap = soap.Options()
-    for key, val in options.items():
-        if type(val) == list: continue
-        options_soap.set(key, val)
-    # Exclusions
-    excl_targ_list = options['exclude_targets']
-    excl_cent_list = options['exclude_centers']
-    excl_targ_list.append('COM')
-    if not fragment_based:
-        excl_cent_list.append('COM')
-    options_soap.excludeCenters(excl_cent_list)
-    options_soap.excludeTargets(excl_targ_list)
+    if setup is None: setup = setup_soap(options, fragment_based)
+    options_soap, adaptor = setup
     # SPECTRUM
     spectrum = soap.Spectrum(struct, options_soap)
     # Compute density expansion
@@ -573,9 +1101,6 @@ def compute_soap(struct, options, fragment_based=False):
     if options['spectrum.global']:
         spectrum.computeGlobal()
     # Adapt spectrum
-    adaptor = soap.soapy.kernel.KernelAdaptorFactory[options['kernel.adaptor']](
-        options_soap,
-        types_global=options['type_list'])
     IX, IR, types = adaptor.adapt(spectrum, return_pos_matrix=True)
     return IX, IR, types
 
@@ -585,5 +1110,10 @@ DescriptorFactory = {
     'ftd'  : compute_ftd
 }
 
+DescriptorSetupFactory = {
+    'soap' : setup_soap,
+    'ftd'  : setup_ftd
+}
+
 
 
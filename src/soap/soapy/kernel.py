@@ -3,6 +3,7 @@ import soap
 import soap.tools
 
 import os
+import pickle
 import numpy as np
 import logging
 from momo import osio, endl, flush
@@ -107,33 +108,45 @@ class TrajectoryLogger(object):
         self.ofs.close()
         return
 
+def adapt_spectrum(spectrum, types_global, layout, use_global=False, normalize=True, IX=None):
+    """
+    Feature matrix (one row per centre, or a single row for the global 
+    spectrum) assembled natively by Spectrum.adapt in one call
+
+    Parameters
+    ----------
+    layout : type-pair layout, 'full', 'unique', 'specific' or 'generic'
+    IX : optional preallocated C-contiguous float64 output array
+
+    The matrix holds the real part of the power spectrum and is always 
+    float64, as were the rows of the former per-centre adaptors. Only the 
+    empty-spectrum placeholder of the generic adaptors used to be complex128.
+    """
+    types_global = list(types_global)
+    n_rows = 1 if use_global else len(spectrum)
+    dim = spectrum.adaptDimension(types_global, layout)
+    if IX is None:
+        IX = np.zeros((n_rows, dim), dtype='float64')
+    spectrum.adapt(IX, types_global, layout, use_global, normalize)
+    return IX
+
+def adapt_positions(spectrum):
+    IR = np.zeros((len(spectrum), 3), dtype='float64') # position matrix
+    types = []
+    for idx, atomic_i in enumerate(spectrum):
+        IR[idx,:] = atomic_i.getCenter().pos
+        types.append(atomic_i.getCenter().type)
+    return IR, types
+
 class KernelAdaptorFTD(object):
     def __init__(self, options, types_global):
         self.types = types_global
         self.S = len(types_global)
         return
     def adapt(self, spectrum, return_pos_matrix=False):
-        IX = np.zeros((0,0), dtype='float64') # feature matrix
-        dimX = -1
-        IR = np.zeros((0,0), dtype='float64') # position matrix
-        types = []
-        for atomic_i in spectrum:
-            Xi_unnorm, Xi_norm = self.adaptScalar(atomic_i)
-            Ri = atomic_i.getCenter().pos
-            types.append(atomic_i.getCenter().type)
-            dimX = Xi_norm.shape[0]
-            if not IX.any():
-                IX = np.copy(Xi_norm) # TODO Is this necessary?
-                IX.resize((1, dimX))
-                IR = np.copy(Ri)
-                IR.resize((1, 3))
-            else:
-                i = IX.shape[0]
-                IX.resize((i+1, dimX))
-                IX[-1,:] = Xi_norm
-                IR.resize((i+1, 3))
-                IR[-1,:] = Ri
+        IX = adapt_spectrum(spectrum, self.types, "full")
         if return_pos_matrix:
+            IR, types = adapt_positions(spectrum)
             return IX, IR, types
         else:
             return IX
@@ -160,7 +173,7 @@ class KernelAdaptorFTD(object):
             for j in range(S_atomic):
                 b = types_atomic[j]
                 sb = types_global.index(b)
-                x = atomic.getPower(a,b)
+                x = atomic.getPower(a,b).array.real
                 # Initialize aggregated array
                 if i == 0 and j == 0:
                     dim_ab = x.shape[0]*x.shape[1]
@@ -354,27 +367,9 @@ class KernelAdaptorSpecificUnique(object):
         self.S = len(types_global)
         return
     def adapt(self, spectrum, return_pos_matrix=False):
-        IX = np.zeros((0,0), dtype='float64') # feature matrix
-        dimX = -1
-        IR = np.zeros((0,0), dtype='float64') # position matrix
-        types = []
-        for atomic_i in spectrum:
-            Xi_unnorm, Xi_norm = self.adaptScalar(atomic_i)
-            Ri = atomic_i.getCenter().pos
-            types.append(atomic_i.getCenter().type)
-            dimX = Xi_norm.shape[0]
-            if not IX.any():
-                IX = np.copy(Xi_norm) # TODO Is this necessary?
-                IX.resize((1, dimX))
-                IR = np.copy(Ri)
-                IR.resize((1, 3))
-            else:
-                i = IX.shape[0]
-                IX.resize((i+1, dimX))
-                IX[-1,:] = Xi_norm
-                IR.resize((i+1, 3))
-                IR[-1,:] = Ri
+        IX = adapt_spectrum(spectrum, self.types, "unique")
         if return_pos_matrix:
+            IR, types = adapt_positions(spectrum)
             return IX, IR, types
         else:
             return IX
@@ -395,19 +390,7 @@ class KernelAdaptorSpecific(object):
         self.S = len(types_global)
         return
     def adapt(self, spectrum):
-        IX = np.zeros((0,0), dtype='float64')
-        dimX = -1
-        for atomic_i in spectrum:
-            Xi_unnorm, Xi_norm = self.adaptScalar(atomic_i)
-            dimX = Xi_norm.shape[0]
-            if not IX.any():
-                IX = np.copy(Xi_norm) # TODO Is this necessary?
-                IX.resize((1, dimX))
-            else:
-                i = IX.shape[0]
-                IX.resize((i+1, dimX))
-                IX[-1,:] = Xi_norm
-        return IX
+        return adapt_spectrum(spectrum, self.types, "specific")
     def adaptScalar(self, atomic):
         xnklab_atomic = Xnklab(atomic, self.types)
         X = xnklab_atomic.reduce()
@@ -454,15 +437,8 @@ class KernelAdaptorGlobalSpecific(object):
     def getListAtomic(self, spectrum):
         return [ spectrum.getGlobal() ]
     def adapt(self, spectrum, return_pos_matrix=False):
-        # EXTRACT A SET OF CENTER-BASED POWER EXPANSIONS
         # Here: only global
-        IX = np.zeros((0,0), dtype='complex128')
-        dimX = -1
-        atomic_global = spectrum.getGlobal()
-        Xi_unnorm, Xi_norm = self.adaptScalar(atomic_global)
-        dimX = Xi_norm.shape[0]
-        IX = np.copy(Xi_norm)
-        IX.resize((1,dimX))
+        IX = adapt_spectrum(spectrum, self.types, "specific", use_global=True)
         if return_pos_matrix:
             return IX, np.array([0.,0.,0.]), ["global"]
         else: return IX
@@ -530,35 +506,7 @@ class KernelAdaptorGeneric(object):
         #    X2 ->,
         #    ...
         # ]
-        IX = np.zeros((0,0), dtype='complex128')
-        dimX = -1
-        # TODO More adaptors:
-        # TODO Particle ID mask, center-type mask
-        # TODO For type-resolved adaptors, increase dimensionality accordingly
-        for atomic_i in spectrum:
-            #print atomic_i.getCenter().pos
-            #if pid_list:
-            #    pid = atomic_i.getCenter().id
-            #    if not pid in pid_list:
-            #        logging.debug("Skip, adapt atomic, pid = %d" % pid)
-            #        continue
-
-            Xi_unnorm, Xi_norm = self.adaptScalar(atomic_i)
-            dimX = Xi_norm.shape[0]
-            #Xi = np.real(atomic_i.getPower("","").array)
-            #dimX = Xi.shape[0]*Xi.shape[1]
-            #Xi = Xi.reshape((dimX))
-
-            #print "dim(X) =", dimX
-            if not IX.any():
-                IX = np.copy(Xi_norm) # TODO Is this necessary?
-                IX.resize((1, dimX))
-            else:
-                i = IX.shape[0]
-                IX.resize((i+1, dimX))
-                IX[-1,:] = Xi_norm
-            #print IX
-        return IX
+        return adapt_spectrum(spectrum, [], "generic")
     def adaptScalar(self, atomic):
         X = np.real(atomic.getPower("","").array)
         dimX = X.shape[0]*X.shape[1]
@@ -589,16 +537,8 @@ class KernelAdaptorGlobalGeneric(object):
     def getListAtomic(self, spectrum):
         return [ spectrum.getGlobal() ]
     def adapt(self, spectrum):
-        # EXTRACT A SET OF CENTER-BASED POWER EXPANSIONS
-        # Here: only global
-        IX = np.zeros((0,0), dtype='complex128')
-        dimX = -1
-        atomic_global = spectrum.getGlobal()
-        Xi_unnorm, Xi_norm = self.adaptScalar(atomic_global)
-        dimX = Xi_norm.shape[0]
-        IX = np.copy(Xi_norm)
-        IX.resize((1,dimX))
-        return IX
+        # Here: only global, type "":"" (= generic)
+        return adapt_spectrum(spectrum, [], "generic", use_global=True)
     def adaptScalar(self, atomic):
         # EXTRACT POWER EXPANSION FROM ATOMIC SPECTRUM
         # Here: type "":"" (= generic)
@@ -651,6 +591,14 @@ class KernelFunctionDotShifted(object):
         return self.delta**2 * k**self.xi
 
 class KernelFunctionDot(object):
+    """
+    k_i = d^2 [ IX_i.X ]^xi
+
+    X is either a single descriptor (shape D) or a batch of descriptors
+    (shape M x D), in which case results carry an extra trailing axis M.
+    Derivatives are represented by per-reference weights W, such that
+    dk_i/dX = W_i IX_i, and never as N x N intermediates.
+    """
     def __init__(self, options):
         if (type(options) == dict):
             self.delta = float(options['kernel.delta'])
@@ -662,12 +610,15 @@ class KernelFunctionDot(object):
     def evaluate(self, IX, IY):
         return self.delta**2 * IX.dot(IY.T)**self.xi
     def computeDot(self, IX, X, xi, delta):
-        return delta**2 * np.dot(IX,X)**xi
+        return delta**2 * np.dot(IX,X.T)**xi
     def compute(self, IX, X):
         return self.computeDot(IX, X, self.xi, self.delta)
+    def computeDerivativeWeights(self, IX, X):
+        return self.xi*self.computeDot(IX, X, self.xi-1, self.delta)
     def computeDerivativeOuter(self, IX, X):
-        c = self.computeDot(IX, X, self.xi-1, self.delta)
-        return self.xi*np.diag(c).dot(IX)
+        return derivative_outer(self.computeDerivativeWeights(IX, X), IX)
+    def computeDerivativeContracted(self, IX, X, alpha):
+        return derivative_contracted(self.computeDerivativeWeights(IX, X), IX, alpha)
     def computeBlock(self, IX, return_distance=False):
         # Order such that: IX[i] => fingerprint observation i
         K = self.delta**2 * IX.dot(IX.T)**self.xi
@@ -678,6 +629,20 @@ class KernelFunctionDot(object):
     def computeBlockDot(self, IX, return_distance=False):
         return self.computeBlock(IX, return_distance)
 
+def derivative_outer(W, IX):
+    # dk_i/dX = W_i IX_i: (N x D) for a single X, (M x N x D) for a batch
+    if W.ndim == 1: return W[:,np.newaxis]*IX
+    return W.T[:,:,np.newaxis]*IX[np.newaxis,:,:]
+
+def derivative_contracted(W, IX, alpha):
+    # sum_i alpha_i dk_i/dX: (D) for a single X, (M x D) for a batch, via one GEMV/GEMM
+    if W.ndim == 1: return (alpha*W).dot(IX)
+    return (alpha[:,np.newaxis]*W).T.dot(IX)
+
+def broadcast_reference(v, C):
+    # Per-reference vector v (N) aligned with C (N or N x M)
+    return v if C.ndim == 1 else v[:,np.newaxis]
+
 class KernelFunctionDotHarmonic(object):
     """
     C_i = ( d^2 [ IX.X ]^xi - mu_i )^2
@@ -688,21 +653,26 @@ class KernelFunctionDotHarmonic(object):
         self.mu = float(options.get('kernel.mu'))
         self.kfctdot = KernelFunctionDot(options)
         return
-    def compute(self, IX, X):
+    def getMu(self, IX):
         if type(self.mu) == float:
+            self.mu0 = self.mu
+        if type(self.mu) == float or self.mu.shape[0] != IX.shape[0]:
+            # (Re-)expand, e.g., after the reference set has grown
             mu = np.zeros((IX.shape[0]))
-            mu.fill(self.mu)
+            mu.fill(self.mu0)
             self.mu = mu
+        return self.mu
+    def compute(self, IX, X):
         C = self.kfctdot.compute(IX, X)
-        return (C-self.mu)**2
-    def computeDerivativeOuter(self, IX, X):
-        if type(self.mu) == float:
-            mu = np.zeros((IX.shape[0]))
-            mu.fill(self.mu)
-            self.mu = mu
+        return (C-broadcast_reference(self.getMu(IX), C))**2
+    def computeDerivativeWeights(self, IX, X):
         C = self.kfctdot.compute(IX, X)
-        IC = self.kfctdot.computeDerivativeOuter(IX, X)
-        return 2*(C-self.mu)*IC
+        W = self.kfctdot.computeDerivativeWeights(IX, X)
+        return 2*(C-broadcast_reference(self.getMu(IX), C))*W
+    def computeDerivativeOuter(self, IX, X):
+        return derivative_outer(self.computeDerivativeWeights(IX, X), IX)
+    def computeDerivativeContracted(self, IX, X, alpha):
+        return derivative_contracted(self.computeDerivativeWeights(IX, X), IX, alpha)
     def computeBlockDot(self, IX, return_distance=False):
         return self.kfctdot.computeBlock(IX, return_distance)
 
@@ -716,11 +686,15 @@ class KernelFunctionDotHarmonicDist(object):
         C = self.kfctdot.compute(IX, X)
         D = (1.-C+self.eps)**0.5
         return (D-self.d0)**2
-    def computeDerivativeOuter(self, IX, X):
+    def computeDerivativeWeights(self, IX, X):
         C = self.kfctdot.compute(IX, X)
         D = (1.-C+self.eps)**0.5
-        IC = self.kfctdot.computeDerivativeOuter(IX, X)
-        return 2*(D-self.d0)*0.5/D*(-1.)*IC
+        W = self.kfctdot.computeDerivativeWeights(IX, X)
+        return 2*(D-self.d0)*0.5/D*(-1.)*W
+    def computeDerivativeOuter(self, IX, X):
+        return derivative_outer(self.computeDerivativeWeights(IX, X), IX)
+    def computeDerivativeContracted(self, IX, X, alpha):
+        return derivative_contracted(self.computeDerivativeWeights(IX, X), IX, alpha)
 
 class KernelFunctionDotLj(object):
     def __init__(self, options):
@@ -731,11 +705,15 @@ class KernelFunctionDotLj(object):
         C = self.kfctdot.compute(IX, X)
         D = (1.-C+self.eps_cap)**0.5
         return (self.sigma/D)**12 - (self.sigma/D)**6
-    def computeDerivativeOuter(self, IX, X):
+    def computeDerivativeWeights(self, IX, X):
         C = self.kfctdot.compute(IX, X)
         D = (1.-C+self.eps_cap)**0.5
-        IC = self.kfctdot.computeDerivativeOuter(IX, X)
-        return (-6.*self.sigma**12*(1./D)**7 + 3.*self.sigma**6*(1./D)**4)*IC
+        W = self.kfctdot.computeDerivativeWeights(IX, X)
+        return (-6.*self.sigma**12*(1./D)**7 + 3.*self.sigma**6*(1./D)**4)*W
+    def computeDerivativeOuter(self, IX, X):
+        return derivative_outer(self.computeDerivativeWeights(IX, X), IX)
+    def computeDerivativeContracted(self, IX, X, alpha):
+        return derivative_contracted(self.computeDerivativeWeights(IX, X), IX, alpha)
     def computeBlockDot(self, IX, return_distance=False):
         return self.kfctdot.computeBlock(IX, return_distance)
 
@@ -814,16 +792,154 @@ KernelFunctionFactory = {
     'dot-3-harmonic-dist': KernelFunctionDot3HarmonicDist
 }
 
+def select_fps(IX, n_select, idx_start=0):
+    """
+    Farthest-point selection of n_select rows of IX (Euclidean distance)
+    """
+    n_select = min(n_select, IX.shape[0])
+    norm2 = np.sum(IX*IX, axis=1)
+    idcs = [ idx_start ]
+    d2 = norm2 + norm2[idx_start] - 2*IX.dot(IX[idx_start])
+    # Selected rows are excluded explicitly: with duplicate rows (or round-off
+    # in d2), a zero distance does not single out the rows already selected
+    d2[idx_start] = -np.inf
+    for n in range(1, n_select):
+        idx = int(np.argmax(d2))
+        idcs.append(idx)
+        d2 = np.minimum(d2, norm2 + norm2[idx] - 2*IX.dot(IX[idx]))
+        d2[idx] = -np.inf
+    return np.array(idcs)
+
+def select_cur(IX, n_select, k=None):
+    """
+    CUR-type selection of the n_select rows of IX with the largest 
+    statistical leverage with respect to the top-k left singular vectors
+    """
+    n_select = min(n_select, IX.shape[0])
+    if k is None: k = n_select
+    U, S, Vt = np.linalg.svd(IX, full_matrices=False)
+    k = min(k, U.shape[1])
+    leverage = np.sum(U[:,0:k]**2, axis=1)
+    return np.sort(np.argsort(leverage)[::-1][0:n_select])
+
+SparseSelectionFactory = {
+    'fps': select_fps,
+    'cur': select_cur
+}
+
+class ReferenceStore(object):
+    """
+    Growable set of reference environments (descriptor rows IX, weights 
+    alpha, labels) with capacity doubling, such that appends are O(1)
+    amortised. IX and alpha are views onto the first n rows of the buffers
+    and remain valid until the next reallocation.
+
+    Parameters
+    ----------
+    capacity : initial number of rows
+    path : if given, the descriptor buffer is a memory-mapped .npy file
+        (path+'.IX.buffer.npy'), reallocated on growth
+    """
+    def __init__(self, capacity=1024, path=None, dtype='float64'):
+        self.capacity = max(1, capacity)
+        self.path = path
+        self.dtype = dtype
+        self.n = 0
+        self.dim = None
+        self._IX = None
+        self._alpha = None
+        self.labels = []
+        return
+    def __len__(self):
+        return self.n
+    @property
+    def IX(self):
+        return None if self._IX is None else self._IX[0:self.n]
+    @property
+    def alpha(self):
+        return None if self._alpha is None else self._alpha[0:self.n]
+    def allocate(self, capacity):
+        if self.path is not None:
+            f = self.path+'.IX.buffer.npy'
+            IX_old = None
+            if self._IX is not None:
+                # Move the old buffer aside so that it can be read while copying
+                os.rename(f, f+'.old')
+                IX_old = np.load(f+'.old', mmap_mode='r')
+            IX = np.lib.format.open_memmap(f, mode='w+', dtype=self.dtype, shape=(capacity, self.dim))
+            if IX_old is not None:
+                IX[0:self.n] = IX_old[0:self.n]
+                del IX_old
+                os.remove(f+'.old')
+        else:
+            IX = np.zeros((capacity, self.dim), dtype=self.dtype)
+            if self._IX is not None: IX[0:self.n] = self._IX[0:self.n]
+        alpha = np.zeros((capacity,), dtype='float64')
+        if self._alpha is not None: alpha[0:self.n] = self._alpha[0:self.n]
+        self._IX = IX
+        self._alpha = alpha
+        self.capacity = capacity
+        return
+    def reserve(self, n_total):
+        if self._IX is not None and n_total <= self.capacity: return
+        capacity = self.capacity
+        while capacity < n_total: capacity *= 2
+        self.allocate(capacity)
+        return
+    def append(self, IX, alpha, labels=None):
+        IX = np.atleast_2d(IX)
+        n_add = IX.shape[0]
+        if self.dim is None: self.dim = IX.shape[1]
+        assert self.dim == IX.shape[1] # Acquired descr. should match linear dim. of previous descr.'s
+        self.reserve(self.n+n_add)
+        self._IX[self.n:self.n+n_add] = IX
+        self._alpha[self.n:self.n+n_add] = alpha
+        if labels is None: labels = [ None for i in range(n_add) ]
+        self.labels.extend(labels)
+        self.n += n_add
+        return
+    def select(self, idcs):
+        # Keeps only the references idcs (index array or boolean mask), in place
+        idcs = np.arange(self.n)[np.asarray(idcs)]
+        n_keep = idcs.shape[0]
+        self._IX[0:n_keep] = self._IX[idcs]
+        self._alpha[0:n_keep] = self._alpha[idcs]
+        self.labels = [ self.labels[i] for i in idcs ]
+        self.n = n_keep
+        return
+    def remove(self, idcs):
+        mask = np.ones((self.n,), dtype=bool)
+        mask[np.asarray(idcs)] = False
+        self.select(mask)
+        return
+    def save(self, prefix):
+        np.save(prefix+'.IX.npy', self.IX)
+        np.save(prefix+'.alpha.npy', self.alpha)
+        # Labels are arbitrary (picklable) objects
+        with open(prefix+'.labels.pkl', 'wb') as f:
+            pickle.dump(self.labels, f, pickle.HIGHEST_PROTOCOL)
+        return
+    def load(self, prefix):
+        IX = np.load(prefix+'.IX.npy', mmap_mode='r')
+        alpha = np.load(prefix+'.alpha.npy')
+        with open(prefix+'.labels.pkl', 'rb') as f:
+            labels = pickle.load(f)
+        self.n = 0
+        self.dim = IX.shape[1]
+        self._IX = None
+        self._alpha = None
+        self.labels = []
+        self.append(IX, alpha, labels)
+        return self
+
 class KernelPotential(object):
-    def __init__(self, options):
+    def __init__(self, options, capacity=1024, store_path=None):
         logging.info("Construct kernel potential ...")
         self.basis = soap.Basis(options)
         self.options = options
         # CORE DATA
-        self.IX = None
-        self.alpha = None
-        self.dimX = None # <- Also used as flag set by first ::acquire call
-        self.labels = []
+        self.store = ReferenceStore(capacity=capacity, path=store_path)
+        self.sparse = None # <- Inducing environments and weights, see ::sparsify
         # KERNEL
         logging.info("Choose kernel function ...")
         self.kernelfct = KernelFunctionFactory[options.get('kernel.type')](options)
@@ -834,6 +950,82 @@ class KernelPotential(object):
         # INCLUSIONS / EXCLUSIONS
         # -> Already be enforced when computing spectra
         return
+    @property
+    def IX(self):
+        return self.store.IX
+    @property
+    def alpha(self):
+        return self.store.alpha
+    @property
+    def labels(self):
+        return self.store.labels
+    @property
+    def dimX(self):
+        return self.store.dim
+    def getReferences(self):
+        # Environments and weights used for prediction
+        if self.sparse is not None:
+            return self.sparse["IZ"], self.sparse["beta"]
+        return self.IX, self.alpha
+    def sparsify(self, n_inducing, method='fps', sigma=1e-3, targets=None, block_size=1024):
+        """
+        Switches to a sparse (projected-process) model with n_inducing
+        environments Z selected from the acquired set, such that predictions
+        cost O(M) per environment independent of the number of references:
+
+            beta = (sigma^2 K_MM + K_MN K_NM)^-1 K_MN y
+
+        Parameters
+        ----------
+        method : 'fps' (farthest-point) or 'cur' (leverage-score) selection
+        sigma : regularization (noise level) of the projected process
+        targets : per-reference targets y; by default, the predictions of the
+            full model at the references, evaluated in blocks of block_size.
+            NOTE These default targets cost O(N^2) kernel evaluations for N 
+            references (once, at sparsification); pass targets to avoid this.
+
+        Any change of the reference set (acquire, removeReferences, 
+        selectReferences, load) discards the sparse model, such that 
+        predictions fall back to the full model until sparsify is called again.
+        """
+        IX = self.IX
+        alpha = self.alpha
+        idcs = SparseSelectionFactory[method](IX, n_inducing)
+        IZ = np.copy(IX[idcs])
+        if targets is None:
+            targets = np.zeros((IX.shape[0],), dtype='float64')
+            for i0 in range(0, IX.shape[0], block_size):
+                i1 = min(i0+block_size, IX.shape[0])
+                targets[i0:i1] = alpha.dot(self.kernelfct.compute(IX, IX[i0:i1]))
+        K_NM = self.kernelfct.compute(IX, IZ)
+        K_MM = self.kernelfct.compute(IZ, IZ)
+        A = sigma**2*K_MM + K_NM.T.dot(K_NM)
+        beta = np.linalg.lstsq(A, K_NM.T.dot(targets))[0]
+        residual = K_NM.dot(beta) - targets
+        logging.info("Sparse model: %d/%d inducing environments, rms residual %+1.4e" % (
+            IZ.shape[0], IX.shape[0], np.sqrt(np.mean(residual**2))))
+        self.sparse = { "idcs": idcs, "IZ": IZ, "beta": beta, "method": method, "sigma": sigma }
+        return self.sparse
+    def desparsify(self):
+        if self.sparse is not None:
+            logging.info("Reference set changed: discarding sparse model")
+        self.sparse = None
+        return
+    def removeReferences(self, idcs):
+        self.store.remove(idcs)
+        self.desparsify()
+        return
+    def selectReferences(self, idcs):
+        self.store.select(idcs)
+        self.desparsify()
+        return
+    def save(self, prefix):
+        self.store.save(prefix)
+        return
+    def load(self, prefix):
+        self.store.load(prefix)
+        self.desparsify()
+        return
     def computeKernelMatrix(self, return_distance=False):
         return self.kernelfct.computeBlock(self.IX, return_distance)
     def computeDotKernelMatrix(self, return_distance=False):
@@ -844,132 +1036,92 @@ class KernelPotential(object):
         return self.IX.shape[0]
     def importAcquire(self, IX_acqu, alpha):
         n_acqu = IX_acqu.shape[0]
-        dim_acqu = IX_acqu.shape[1]
-        alpha_acqu = np.zeros((n_acqu))
-        alpha_acqu.fill(alpha)
-        if not self.dimX:
-            # First time ...
-            self.dimX = dim_acqu
-            self.IX = IX_acqu
-            self.alpha = alpha_acqu
-        else:
-            # Check and extend ...
-            assert self.dimX == dim_acqu # Acquired descr. should match linear dim. of previous descr.'s
-            I = self.IX.shape[0]
-            self.IX.resize((I+n_acqu, self.dimX))
-            self.IX[I:I+n_acqu,:] = IX_acqu
-            self.alpha.resize((I+n_acqu))
-            self.alpha[I:I+n_acqu] = alpha_acqu
-        #print self.alpha
-        #print self.IX
+        self.store.append(IX_acqu, alpha)
+        self.desparsify()
         logging.info("Imported %d environments." % n_acqu)
         return
     def acquire(self, structure, alpha, label=None):
         logging.info("Acquire ...")
-        spectrum = soap.Spectrum(structure, self.options, self.basis)
-        spectrum.compute()
-        spectrum.computePower()
-        spectrum.computePowerGradients()
-        if self.use_global_spectrum:
-            spectrum.computeGlobal()
+        spectrum = self.computeSpectrum(structure, gradients=False)
         # New X's
         logging.info("Adapt spectrum ...")
         IX_acqu = self.adaptor.adapt(spectrum)
         n_acqu = IX_acqu.shape[0]
-        dim_acqu = IX_acqu.shape[1]
-        # New alpha's
-        alpha_acqu = np.zeros((n_acqu))
-        alpha_acqu.fill(alpha)
-        # Labels
-        labels = [ label for i in range(n_acqu) ]
-        self.labels = self.labels + labels
-        if not self.dimX:
-            # First time ...
-            self.dimX = dim_acqu
-            self.IX = IX_acqu
-            self.alpha = alpha_acqu
-        else:
-            # Check and extend ...
-            assert self.dimX == dim_acqu # Acquired descr. should match linear dim. of previous descr.'s
-            I = self.IX.shape[0]
-            self.IX.resize((I+n_acqu, self.dimX))
-            self.IX[I:I+n_acqu,:] = IX_acqu
-            self.alpha.resize((I+n_acqu))
-            self.alpha[I:I+n_acqu] = alpha_acqu
-        #print self.alpha
-        #print self.IX
+        # New alpha's, labels
+        self.store.append(IX_acqu, alpha, [ label for i in range(n_acqu) ])
+        self.desparsify()
         logging.info("Acquired %d environments." % n_acqu)
         return
-    def computeEnergy(self, structure, return_prj_mat=False):
-        logging.info("Start energy ...")
-        energy = 0.0
+    def computeSpectrum(self, structure, gradients=False):
         spectrum = soap.Spectrum(structure, self.options, self.basis)
         spectrum.compute()
         spectrum.computePower()
-        spectrum.computePowerGradients()
+        # Gradients are only needed for forces
+        if gradients:
+            spectrum.computePowerGradients()
         # TODO The kernel policy should take care of this:
         if self.use_global_spectrum:
             spectrum.computeGlobal()
+        return spectrum
+    def computeEnergyForces(self, structure, forces=True, return_prj_mat=False):
+        """
+        Energy and (optionally) forces of a structure, with the kernel 
+        between all environments and all references from one matrix product
+
+        Returns
+        -------
+        energy, forces (n_particles x 3 array, or None), 
+        and the projection matrix (n_envs x n_refs) if return_prj_mat
+        """
+        spectrum = self.computeSpectrum(structure, gradients=forces)
+        # Normalized environment descriptors, assembled in one native call
         IX_acqu = self.adaptor.adapt(spectrum)
-        n_acqu = IX_acqu.shape[0]
-        dim_acqu = IX_acqu.shape[1]
-        logging.info("Compute energy from %d atomic environments ..." % n_acqu)
-        projection_matrix = []
-        for n in range(n_acqu):
-            X = IX_acqu[n]
-            #print "X_MAG", np.dot(X,X)
-            ic = self.kernelfct.compute(self.IX, X)
-            energy += self.alpha.dot(ic)
-            #print "Projection", ic
-            projection_matrix.append(ic)
+        logging.info("Compute energy from %d atomic environments ..." % IX_acqu.shape[0])
+        IX_ref, alpha_ref = self.getReferences()
+        IC = self.kernelfct.compute(IX_ref, IX_acqu) # <- n_refs x n_envs
+        energy = np.sum(alpha_ref.dot(IC))
+        F = None
+        if forces:
+            logging.info("Compute forces on %d particles ..." % structure.n_particles)
+            # Neighbour-pid-independent kernel "prevectors" (outer derivatives)
+            alpha_dIC = self.kernelfct.computeDerivativeContracted(IX_ref, IX_acqu, alpha_ref)
+            # Unnormalized descriptors, as required by the adaptor gradients
+            if self.use_global_spectrum:
+                atomics = [ spectrum.getGlobal() ]
+            else:
+                atomics = [ atomic for atomic in spectrum ]
+            IX_unnorm = [ self.adaptor.adaptScalar(atomic)[0] for atomic in atomics ]
+            # Sparse neighbour gradients: one (3 x dim) block per (centre, neighbour) pair
+            centre_idcs = []
+            nb_idcs = []
+            dX = []
+            for i, atomic in enumerate(atomics):
+                for nb_pid in atomic.getNeighbourPids():
+                    dX_dx, dX_dy, dX_dz = self.adaptor.adaptGradients(atomic, nb_pid, IX_unnorm[i])
+                    centre_idcs.append(i)
+                    nb_idcs.append(nb_pid-1)
+                    dX.append(np.array([ dX_dx, dX_dy, dX_dz ]))
+            F = np.zeros((structure.n_particles, 3), dtype='float64')
+            if len(dX) > 0:
+                dX = np.array(dX)
+                F_pairs = -np.einsum('pkd,pd->pk', dX, alpha_dIC[np.array(centre_idcs)])
+                np.add.at(F, np.array(nb_idcs), F_pairs)
         if return_prj_mat:
-            return energy, projection_matrix
+            return energy, F, IC.T
+        return energy, F
+    def computeEnergy(self, structure, return_prj_mat=False):
+        logging.info("Start energy ...")
+        energy, F, prj_mat = self.computeEnergyForces(structure, forces=False, return_prj_mat=True)
+        if return_prj_mat:
+            return energy, [ ic for ic in prj_mat ]
         else:
             return energy
     def computeForces(self, structure, verbose=False):
         logging.info("Start forces ...")
         if verbose:
             for p in structure: print p.pos
-        forces = [ np.zeros((3)) for i in range(structure.n_particles) ]
-        logging.info("Compute forces on %d particles ..." % structure.n_particles)
-        # Compute X's, dX's
-        spectrum = soap.Spectrum(structure, self.options, self.basis)
-        spectrum.compute()
-        spectrum.computePower()
-        spectrum.computePowerGradients()
-        if self.use_global_spectrum:
-            atomic_global = spectrum.computeGlobal()
-            spectrum_iter = [ atomic_global ]
-        else:
-            spectrum_iter = spectrum
-        # Extract & compute force
-        for atomic in spectrum_iter:
-            pid = atomic.getCenter().id if not self.use_global_spectrum else -1
-            #if not pid in self.pid_list_force:
-            #    logging.debug("Skip forces derived from environment with pid = %d" % pid)
-            #    continue
-            #if pid != 1: continue
-            nb_pids = atomic.getNeighbourPids()
-            logging.info("  Center %d" % (pid))
-            # neighbour-pid-independent kernel "prevector" (outer derivative)
-            X_unnorm, X_norm = self.adaptor.adaptScalar(atomic)
-            dIC = self.kernelfct.computeDerivativeOuter(self.IX, X_norm)
-            alpha_dIC = self.alpha.dot(dIC)
-            for nb_pid in nb_pids:
-                # Force on neighbour
-                logging.info("    -> Nb %d" % (nb_pid))
-                dX_dx, dX_dy, dX_dz = self.adaptor.adaptGradients(atomic, nb_pid, X_unnorm)
-
-                force_x = -alpha_dIC.dot(dX_dx)
-                force_y = -alpha_dIC.dot(dX_dy)
-                force_z = -alpha_dIC.dot(dX_dz)
-
-                forces[nb_pid-1][0] += force_x
-                forces[nb_pid-1][1] += force_y
-                forces[nb_pid-1][2] += force_z
-                #print forces
-                #raw_input('...')
-        return forces
+        energy, F = self.computeEnergyForces(structure, forces=True)
+        return [ f for f in F ]
 
 def restore_positions(structure, positions):
     idx = 0
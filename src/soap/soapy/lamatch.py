@@ -1,9 +1,11 @@
+import json
 import numpy as np
 import numpy.linalg as la
 import soap
 from .. import linalg as perm
 import kernel as kern
 import lagraph
+from cache import ObjectLRU
 
 def reduce_kernel_canonical(K, xi):
     N = K.shape[0]
@@ -46,12 +48,45 @@ def compare_graphs_global(g1, g2, options):
     return np.dot(g1.P[0], g2.P[0])**xi
 
 def compare_graphs_rematch(g1, g2, options):
+    if options['lamatch'].get('normalize', False):
+        return compare_graphs_rematch_normalized(g1, g2, options)
     if options['graph']['hierarchical']:
         k = compare_graphs_rematch_hierarchical(g1, g2, options)
     else:
         k = compare_graphs_rematch_base(g1, g2, options)
     return k
 
+# Self-similarities k(g,g), keyed by graph content and all options,
+# least recently used entries are dropped beyond max_items
+SELF_KERNELS = ObjectLRU(max_items=65536)
+
+def rematch_self_key(g, options):
+    key = [ soap.soapy.cache.array_digest(g.P) ]
+    if options['graph']['hierarchical']:
+        key.append(soap.soapy.cache.array_digest(g.L))
+    key.append(json.dumps(options, sort_keys=True, default=str))
+    return tuple(key)
+
+def compare_graphs_rematch_self(g, options):
+    key = rematch_self_key(g, options)
+    k = SELF_KERNELS.get(key)
+    if k is None:
+        if options['graph']['hierarchical']:
+            k = compare_graphs_rematch_hierarchical(g, g, options)
+        else:
+            k = compare_graphs_rematch_base(g, g, options)
+        SELF_KERNELS.put(key, k)
+    return k
+
+def compare_graphs_rematch_normalized(g1, g2, options):
+    if options['graph']['hierarchical']:
+        k = compare_graphs_rematch_hierarchical(g1, g2, options)
+    else:
+        k = compare_graphs_rematch_base(g1, g2, options)
+    k11 = compare_graphs_rematch_self(g1, options)
+    k22 = compare_graphs_rematch_self(g2, options)
+    return k/(k11*k22)**0.5
+
 def compare_graphs_rematch_base(g1, g2, options):
     # Kernel matrix of feature vectors
     kfunc_type = options['basekernel']['kernel.type']
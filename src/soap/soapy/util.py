@@ -2,7 +2,9 @@ import os
 import numpy as np
 import multiprocessing as mp
 import functools as fct
+import collections
 import json
+import time
 import datetime
 import resource
 
@@ -11,29 +13,91 @@ HARTREE_TO_KCALMOL = 627.509469
 
 MP_LOCK = mp.Lock()
 
+_MP_STATE = {}
+
+def _mp_init_items(items, kfct_primed, kmat_shared=None, dtype=None):
+    # Runs once per worker: items (e.g., a graph.SharedGraphStore) are sent once
+    _MP_STATE["items"] = items
+    _MP_STATE["kfct"] = kfct_primed
+    if kmat_shared is not None:
+        n = len(items)
+        _MP_STATE["kmat"] = np.frombuffer(kmat_shared, dtype=dtype).reshape((n,n))
+    return
+
+def _mp_compute_tile(tile):
+    # Writes the tile straight into the shared output matrix
+    r0, r1, c0, c1 = tile
+    items = _MP_STATE["items"]
+    kfct = _MP_STATE["kfct"]
+    kmat = _MP_STATE["kmat"]
+    g_cols = [ items[j] for j in range(c0, c1) ]
+    n_computed = 0
+    for i in range(r0, r1):
+        gi = items[i]
+        for j in range(max(i, c0), c1):
+            kmat[i,j] = kfct([gi, g_cols[j-c0]])
+            n_computed += 1
+    return n_computed
+
+def upper_triangle_tiles(n, tile_size):
+    """
+    Tiles (r0, r1, c0, c1) covering the upper triangle of an (n x n) matrix,
+    most expensive first (off-diagonal before diagonal tiles, larger before 
+    smaller), for balanced dynamic scheduling
+    """
+    bounds = [ (b0, min(b0+tile_size, n)) for b0 in range(0, n, tile_size) ]
+    tiles = []
+    for bi in range(len(bounds)):
+        for bj in range(bi, len(bounds)):
+            tiles.append(bounds[bi] + bounds[bj])
+    def cost(t):
+        r0, r1, c0, c1 = t
+        if r0 == c0: return 0.5*(r1-r0)*(c1-c0+1)
+        return (r1-r0)*(c1-c0)
+    tiles.sort(key=cost, reverse=True)
+    return tiles
+
 def mp_pool_compute_upper_triangle(
         kfct,
         g_list,
         n_procs,
         dtype='float64',
         mplog=None,
+        tile_size=64,
         **kwargs):
+    """
+    Upper triangle of the kernel matrix between items of g_list, with kfct 
+    evaluated on pairs as kfct([gi, gj], **kwargs)
+
+    A single pool is kept for the whole matrix. g_list is handed to each worker
+    once; tasks are (tile_size x tile_size) tiles of the upper triangle, given 
+    only by index ranges and dispatched one at a time, largest first, to 
+    balance the load. Workers write their results directly into a shared 
+    output matrix. With a graph.SharedGraphStore as g_list, no descriptor 
+    data is pickled at all.
+    """
     kfct_primed=fct.partial(kfct, **kwargs)
     n_rows = len(g_list)
-    kmat = np.zeros((n_rows, n_rows), dtype=dtype)
-    for i in range(n_rows):
-        if mplog: mplog << mplog.back << "Computing row %d" % i << mplog.endl
-        g_pair_list = []
-        gi = g_list[i]
-        for j in range(i, n_rows):
-            gj = g_list[j]
-            g_pair_list.append([gi,gj])
-        pool = mp.Pool(processes=n_procs)
-        krow = pool.map(kfct_primed, g_pair_list)
+    dtype = np.dtype(dtype)
+    kmat_shared = mp.RawArray(dtype.char, n_rows*n_rows)
+    tiles = upper_triangle_tiles(n_rows, tile_size)
+    n_total = n_rows*(n_rows+1)/2
+    n_done = 0
+    pool = mp.Pool(processes=n_procs, initializer=_mp_init_items, 
+        initargs=(g_list, kfct_primed, kmat_shared, dtype))
+    try:
+        for n_tile in pool.imap_unordered(_mp_compute_tile, tiles, chunksize=1):
+            n_done += n_tile
+            if mplog: mplog << mplog.back << "Computed %5.1f%% of kernel matrix" % (
+                100.*n_done/max(n_total, 1)) << mplog.flush
+        if mplog: mplog << mplog.endl
         pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
         pool.join()
-        kmat[i,i:] = krow
-    return kmat
+    return np.frombuffer(kmat_shared, dtype=dtype).reshape((n_rows, n_rows))
 
 def mp_compute_vector(
         kfct,
@@ -118,6 +182,10 @@ def mp_compute_upper_triangle(
     n_procs: number of processors requested
     n_blocks: number of column blocks onto which computation is split
     kwargs: keyword arguments supplied to kfct
+
+    See Also
+    --------
+    mp_compute_kernel_blocks : out-of-core variant with a resumable manifest
     """
     if not verbose: mplog=None
     t_start = tstart_twall[0]
@@ -174,6 +242,273 @@ def mp_compute_upper_triangle(
             else: pass
     return kmat
 
+# ===========================
+# OUT-OF-CORE KERNEL MATRICES
+# ===========================
+
+_OOC_STATE = {}
+
+def _ooc_init(source, kfct_primed, symmetric, mirror, n_cache):
+    # Runs once per worker: state persists across all blocks handled by it
+    _OOC_STATE["source"] = source
+    _OOC_STATE["kfct"] = kfct_primed
+    _OOC_STATE["symmetric"] = symmetric
+    _OOC_STATE["mirror"] = mirror
+    _OOC_STATE["n_cache"] = n_cache
+    _OOC_STATE["cache"] = collections.OrderedDict()
+    return
+
+def _ooc_get_items(i0, i1):
+    # LRU over item blocks: consecutive tasks sharing a row block only load it once
+    cache = _OOC_STATE["cache"]
+    key = (i0, i1)
+    if key in cache:
+        items = cache.pop(key)
+    else:
+        source = _OOC_STATE["source"]
+        items = [ source[i] for i in range(i0, i1) ]
+        while len(cache) >= _OOC_STATE["n_cache"]:
+            cache.popitem(last=False)
+    cache[key] = items
+    return items
+
+def _ooc_compute_block(task):
+    bi, bj, r0, r1, c0, c1 = task
+    g_rows = _ooc_get_items(r0, r1)
+    g_cols = _ooc_get_items(c0, c1)
+    kfct = _OOC_STATE["kfct"]
+    diagonal = _OOC_STATE["symmetric"] and bi == bj
+    kblock = np.zeros((r1-r0, c1-c0))
+    for i, gi in enumerate(g_rows):
+        for j, gj in enumerate(g_cols):
+            if diagonal and j < i: continue
+            kblock[i,j] = kfct([gi, gj])
+    if diagonal and _OOC_STATE["mirror"]:
+        kblock = kblock + np.triu(kblock, 1).T
+    return bi, bj, kblock
+
+def ooc_open_target(out_file, shape, dtype, block_size):
+    """
+    Opens (or creates) the on-disk kernel matrix: a chunked HDF5 dataset
+    'kernel' for .h5/.hdf5 files, a numpy memmap otherwise. Returns (handle, K),
+    where handle is the HDF5 file (None for memmaps).
+    """
+    if out_file.endswith('.h5') or out_file.endswith('.hdf5'):
+        import h5py
+        h5 = h5py.File(out_file, 'a')
+        if 'kernel' in h5:
+            K = h5['kernel']
+        else:
+            chunks = (min(block_size, shape[0]), min(block_size, shape[1]))
+            K = h5.create_dataset('kernel', shape=shape, dtype=dtype, 
+                chunks=chunks, fillvalue=0)
+        handle = h5
+    else:
+        if os.path.isfile(out_file):
+            K = np.load(out_file, mmap_mode='r+')
+        else:
+            K = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=shape)
+        handle = None
+    if tuple(K.shape) != tuple(shape):
+        raise ValueError("Target '%s' has shape %s, expected %s" % (
+            out_file, str(K.shape), str(shape)))
+    return handle, K
+
+def ooc_load_manifest(manifest_file, settings):
+    """
+    Reads the list of completed tiles from an append-only manifest: 
+    the first line holds the run settings, each further line one tile [bi, bj].
+    A truncated last line (from an interrupted run) is dropped, an empty 
+    manifest or one with a truncated header is started afresh.
+    """
+    done = []
+    lines = []
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            lines = f.readlines()
+    if len(lines) == 0 or not lines[0].endswith('\n'):
+        with open(manifest_file, 'w') as f:
+            f.write(json.dumps(settings, sort_keys=True)+'\n')
+        return done
+    stored = json_loads_utf8(lines[0])
+    for key in settings:
+        if stored[key] != settings[key]:
+            raise ValueError("Manifest '%s' inconsistent in '%s': %s != %s" % (
+                manifest_file, key, str(stored[key]), str(settings[key])))
+    for line in lines[1:]:
+        if not line.endswith('\n'):
+            # Drop the truncated line, such that further tiles are not
+            # appended onto it
+            with open(manifest_file, 'w') as f:
+                f.write(''.join(lines[0:1+len(done)]))
+            break
+        done.append(tuple(json.loads(line)))
+    return done
+
+def mp_compute_kernel_blocks(
+        kfct,
+        g_source,
+        out_file,
+        n_procs,
+        block_size=256,
+        symmetric=True,
+        mirror=True,
+        dtype='float64',
+        n_cache=4,
+        chunksize=4,
+        flush_every=16,
+        t_wall=None,
+        mplog=None,
+        **kwargs):
+    """
+    Out-of-core kernel matrix between all pairs of items in g_source,
+    evaluated in (block_size x block_size) tiles that are written straight 
+    to disk, such that memory use is bounded by the tiles in flight
+
+    Parameters
+    ----------
+    kfct : function evaluated on pairs as kfct([gi, gj], **kwargs)
+    g_source : list, or any object with __len__ and __getitem__ that loads
+        items on demand (e.g., graph.H5GraphSource)
+    out_file : target file, HDF5 (.h5, .hdf5) or numpy memmap (.npy)
+    n_procs : number of worker processes, kept alive for the whole run
+    symmetric : only compute tiles in the upper triangle
+    mirror : if symmetric, also write the transposed tiles into the lower 
+        triangle; otherwise diagonal tiles only hold their upper triangle
+    n_cache : number of item blocks cached per worker
+    chunksize : tiles handed to a worker at once (tiles are row-major, hence
+        consecutive tiles share their row block)
+    flush_every : number of tiles after which the target is flushed and 
+        the tiles since the last flush are recorded in the manifest
+    t_wall : wall time in seconds after which the run stops; completed tiles
+        are kept and the next call with the same arguments resumes
+
+    Completed tiles are recorded in out_file+'.manifest' once flushed to 
+    disk, such that tiles lost with an interruption are recomputed on resume 
+    (at most flush_every of them). Returns True once 
+    the matrix is complete, False if the run stopped early.
+    """
+    n = len(g_source)
+    settings = { "shape": [n, n], "block_size": block_size, 
+        "symmetric": symmetric, "mirror": mirror, "dtype": str(np.dtype(dtype)) }
+    manifest_file = out_file+'.manifest'
+    if os.path.isfile(manifest_file) and not os.path.isfile(out_file):
+        # Tiles recorded as done were lost with the target: start over
+        if mplog: mplog << "Target '%s' missing, discarding manifest" % out_file << mplog.endl
+        os.remove(manifest_file)
+    done = set(ooc_load_manifest(manifest_file, settings))
+    bounds = [ (b0, min(b0+block_size, n)) for b0 in range(0, n, block_size) ]
+    tasks = []
+    for bi, (r0, r1) in enumerate(bounds):
+        for bj in range(bi if symmetric else 0, len(bounds)):
+            if (bi, bj) in done: continue
+            c0, c1 = bounds[bj]
+            tasks.append((bi, bj, r0, r1, c0, c1))
+    n_total = len(done) + len(tasks)
+    if mplog: mplog << "Kernel tiles: %d total, %d to compute" % (n_total, len(tasks)) << mplog.endl
+    handle, K = ooc_open_target(out_file, (n, n), dtype, block_size)
+    kfct_primed = fct.partial(kfct, **kwargs)
+    pool = mp.Pool(processes=n_procs, initializer=_ooc_init, 
+        initargs=(g_source, kfct_primed, symmetric, mirror, n_cache))
+    t_start = time.time()
+    finished = False
+    n_done = len(done)
+    manifest = open(manifest_file, 'a')
+    pending = []
+    def checkpoint():
+        # Tiles are only recorded as done once the target is flushed
+        if len(pending) == 0: return
+        if handle is not None: handle.flush()
+        else: K.flush()
+        for tile in pending: manifest.write(json.dumps(tile)+'\n')
+        manifest.flush()
+        del pending[:]
+    try:
+        for bi, bj, kblock in pool.imap_unordered(_ooc_compute_block, tasks, chunksize):
+            r0, r1 = bounds[bi]
+            c0, c1 = bounds[bj]
+            K[r0:r1,c0:c1] = kblock
+            if symmetric and mirror and bi != bj:
+                K[c0:c1,r0:r1] = kblock.T
+            pending.append([bi, bj])
+            if len(pending) >= flush_every: checkpoint()
+            n_done += 1
+            if mplog: mplog << mplog.back << "Tile %d/%d (maxmem = %d)" % (
+                n_done, n_total,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) << mplog.endl
+            if t_wall is not None and time.time()-t_start > t_wall:
+                break
+        else:
+            finished = True
+    finally:
+        # Outstanding tiles are dropped if stopped early (or on error),
+        # tiles already written are kept
+        if finished: pool.close()
+        else: pool.terminate()
+        pool.join()
+        try:
+            checkpoint()
+        finally:
+            manifest.close()
+        if handle is not None: handle.close()
+        else: del K
+    if not finished and mplog:
+        mplog << "Wall time exceeded, %d/%d tiles done" % (n_done, n_total) << mplog.endl
+    return n_done == n_total
+
+def kernel_extend_hdf5(kernel, h5_file, dset_old, dset_new, normalize=True, dtype='float64'):
+    """
+    Extends the symmetric kernel matrix stored in h5_file in place by the 
+    structures in dset_new, evaluating only the cross block and the new diagonal block
+
+    The file holds the (full) matrix 'kernel' and the raw self-similarities 'self',
+    which are reused to normalise the new entries if normalize is set:
+    K_ij -> K_ij/(K_ii*K_jj)**0.5. A missing file is created, hence repeated
+    calls with an empty dset_old at first build the matrix incrementally.
+    Only the first top kernel of kernel is stored (and normalised).
+
+    Parameters
+    ----------
+    kernel : soap.Kernel, configured without normalize, as the stored 
+        self-similarities are taken from its raw output
+    dset_old : soap.DMapMatrixSet covered by the stored matrix (same order)
+    dset_new : soap.DMapMatrixSet with the structures to append
+    """
+    import h5py
+    n_old = len(dset_old)
+    n_new = len(dset_new)
+    h5 = h5py.File(h5_file, 'a')
+    try:
+        if 'kernel' not in h5:
+            h5.create_dataset('kernel', shape=(0,0), maxshape=(None,None), 
+                dtype=dtype, chunks=True)
+            h5.create_dataset('self', shape=(0,), maxshape=(None,), 
+                dtype='float64', chunks=True)
+            h5.attrs['normalized'] = normalize
+        K = h5['kernel']
+        s = h5['self']
+        if K.shape != (n_old, n_old) or s.shape != (n_old,):
+            raise ValueError("Stored kernel %s inconsistent with %d old structures" % (
+                str(K.shape), n_old))
+        if bool(h5.attrs['normalized']) != bool(normalize):
+            raise ValueError("Stored kernel has normalized=%s" % str(h5.attrs['normalized']))
+        K_cross, K_new = kernel.extendBlocks(dset_old, dset_new, "float64")
+        K_new = K_new + np.triu(K_new, 1).T
+        s_new = np.copy(K_new.diagonal())
+        if normalize:
+            s_old = s[:]
+            K_cross = K_cross/np.sqrt(np.outer(s_old, s_new))
+            K_new = K_new/np.sqrt(np.outer(s_new, s_new))
+        K.resize((n_old+n_new, n_old+n_new))
+        K[0:n_old,n_old:] = K_cross
+        K[n_old:,0:n_old] = K_cross.T
+        K[n_old:,n_old:] = K_new
+        s.resize((n_old+n_new,))
+        s[n_old:] = s_new
+    finally:
+        h5.close()
+    return
+
 def json_load_utf8(file_handle):
     return _byteify(
         json.load(file_handle, object_hook=_byteify),
@@ -9,6 +9,7 @@ import datetime
 import os
 from defaults import convert_json_to_cxx
 from momo import log
+from cache import structure_hash, ObjectLRU
 
 def configure(types=[], silent=True, verbose=False):
     if silent: soap.silence()
@@ -140,6 +141,17 @@ class StructureConverter(object):
             typemap=self.typemap,
             laplace_cutoff=self.laplace_cutoff)
 
+def deferred_spectrum_field(field):
+    # Attributes filled by PowerSpectrum.compute: reading one completes a 
+    # computation that was deferred because of a descriptor cache
+    attr = "_%s" % field
+    def get(self):
+        if self.__dict__.get("deferred", False): self.requireSpectrum()
+        return self.__dict__.get(attr, None)
+    def set(self, value):
+        self.__dict__[attr] = value
+    return property(get, set)
+
 class PowerSpectrum(object):
     # TODO Need option for normalisation of gsdmap, sdmap
     # ----
@@ -159,12 +171,25 @@ class PowerSpectrum(object):
         'store_gsd' : False,
         'store_sdmap' : False,
         'store_gsdmap' : False,
-        'dtype': 'float32' # TODO implement
+        'dtype': 'float32' # NOTE Storage type used by PowerSpectrumStore
     }
     struct_converter = StructureConverter()
     verbose = False
     log = log
-    def __init__(self, config=None, config_target=None, options=None, label="?", converter=None):
+    cache = None # NOTE Set to a soapy.cache.DescriptorCache to enable
+    h5_fields = [ "cmap", "gcmap", "sdmap", "gsdmap", "sd", "gsd" ]
+    structure = deferred_spectrum_field("structure")
+    structure_target = deferred_spectrum_field("structure_target")
+    spectrum = deferred_spectrum_field("spectrum")
+    spectrum_global = deferred_spectrum_field("spectrum_global")
+    cmap = deferred_spectrum_field("cmap")
+    gcmap = deferred_spectrum_field("gcmap")
+    sd = deferred_spectrum_field("sd")
+    gsd = deferred_spectrum_field("gsd")
+    sdmap = deferred_spectrum_field("sdmap")
+    gsdmap = deferred_spectrum_field("gsdmap")
+    def __init__(self, config=None, config_target=None, options=None, label="?", converter=None, cache=None):
+        self.deferred = False
         if type(config) != type(None):
             if self.verbose: self.log << self.log.mg << "Initialising power spectrum '%s'" % label << self.log.endl
         self.label = label
@@ -189,12 +214,42 @@ class PowerSpectrum(object):
         self.gsd = None
         self.gsdmap = None
         self.sdmap = None
+        # Descriptor cache: with a cache, the spectrum is computed lazily, 
+        # i.e., only if the exported descriptor is not found in the cache, 
+        # or once any of the computed fields above is read
+        if cache is not None: self.cache = cache
+        self.converter = converter
         if type(config) != type(None):
             if options is None: raise ValueError("No options provided")
             if converter is None:
-                converter = PowerSpectrum.struct_converter
-            self.compute(config=config, config_target=config_target, options=options, converter=converter)
+                self.converter = PowerSpectrum.struct_converter
+            if self.cache is None:
+                self.compute(config=config, config_target=config_target, options=options, converter=self.converter)
+            else:
+                self.deferred = True
+        return
+    def requireSpectrum(self):
+        # Computes the spectrum if it was deferred (see cache), no-op 
+        # otherwise (e.g., for spectra loaded from hdf5)
+        if self.deferred:
+            self.deferred = False
+            try:
+                self.compute(config=self.config, config_target=self.config_target, 
+                    options=self.options, converter=self.converter)
+            except:
+                self.deferred = True
+                raise
         return
+    def getHyperparameters(self, coherent=False):
+        hyper = { 
+            "options": self.options, 
+            "converter": self.converter.__dict__ if self.converter is not None else None,
+            "types": list(soap.encoder.types()),
+            "coherent": coherent,
+            "cxx_compute_power": PowerSpectrum.settings["cxx_compute_power"] }
+        if self.config_target is not None:
+            hyper["target"] = structure_hash(self.config_target, tol=self.cache.tol)
+        return hyper
     def compute(self, config, options, config_target=None, converter=None):
         if self.has_cnlm: pass
         else:
@@ -239,6 +294,7 @@ class PowerSpectrum(object):
                 self.computePower()
         return
     def computePower(self):
+        self.requireSpectrum()
         if not self.has_cnlm:
             raise RuntimeError("Cannot compute power spectrum without computing spectrum first")
         if self.has_pnkl: pass
@@ -283,6 +339,7 @@ class PowerSpectrum(object):
                 self.gsdmap = IX
         return
     def save(self, hdf5_handle):
+        self.requireSpectrum()
         g = hdf5_handle
         # Class settings
         g.attrs.update(self.settings)
@@ -336,54 +393,313 @@ class PowerSpectrum(object):
         self.settings = g.attrs
         self.label = g["class"].attrs["label"]
         if self.verbose: self.log << self.log.mb << "Loading power spectrum '%s'" % self.label << self.log.endl
-        # HELPER FUNCTIONS
-        def load_dict_array_data(h):
-            D = []
-            for idx in range(len(h)):
-                hh = h["%d" % idx]
-                d = { t: hh[t].value for t in hh }
-                D.append(d)
-            return D
-        def load_descriptor_map_matrix(h):
-            D = soap.soapy.kernel.DescriptorMapMatrix()
-            for idx in range(len(h)):
-                d = soap.soapy.kernel.DescriptorMap()
-                hh = h['%d' % idx]
-                for t in hh: d[t] = hh[t].value
-                D.append(d)
-            return D
         # LOAD FIELDS
         if self.settings["store_cxx_serial"]:
             if self.verbose: self.log << "[h5] Loading cxx serial and spectrum" << self.log.endl
-            cxx_serial = g["cxx_serial"].value.tostring()
-            self.spectrum = soap.Spectrum()
-            self.spectrum.loads(cxx_serial)
+            self.spectrum = load_spectrum_field(g, "spectrum")
             self.has_spectrum = True
-        # DENSITY EXPANSION COEFFICIENTS
-        if self.settings["store_cmap"]:
-            if self.verbose: self.log << "[h5] Loading coefficient map" << self.log.endl
-            self.cmap = load_dict_array_data(g["cmap"])
-        if self.settings["store_gcmap"]:
-            if self.verbose: self.log << "[h5] Loading global coefficient map" << self.log.endl
-            self.cmap = load_dict_array_data(g["gcmap"])
-        # POWER SPECTRUM COEFFICIENTS
-        if self.settings["store_sdmap"]:
-            if self.verbose: self.log << "[h5] Loading descriptor map" << self.log.endl
-            self.sdmap = load_descriptor_map_matrix(g["sdmap"])
-        if self.settings["store_gsdmap"]:
-            if self.verbose: self.log << "[h5] Loading global descriptor map" << self.log.endl
-            self.gsdmap = load_descriptor_map_matrix(g["gsdmap"])
-        if self.settings["store_sd"]:
-            if self.verbose: self.log << "[h5] Loading descriptor matrix" << self.log.endl
-            self.sd = g["sd"].value
+        for field in PowerSpectrum.h5_fields:
+            if self.settings.get("store_%s" % field, False):
+                if self.verbose: self.log << "[h5] Loading field '%s'" % field << self.log.endl
+                setattr(self, field, load_spectrum_field(g, field))
         return self
     def exportSparse(self, coherent=False):
         return self.exportDMapMatrix(coherent=coherent)
     def exportDMapMatrix(self, coherent=False):
+        key = None
+        if self.cache is not None and self.config is not None:
+            key = self.cache.key(self.config, self.getHyperparameters(coherent))
+            serial = self.cache.get(key)
+            if serial is not None:
+                if self.verbose: self.log << "[py] Descriptor cache hit" << self.log.endl
+                dmap_mat = soap.DMapMatrix()
+                dmap_mat.loads(serial)
+                return dmap_mat
+        self.requireSpectrum()
         dmap_mat = soap.DMapMatrix()
         if coherent: dmap_mat.appendCoherent(self.spectrum)
         else: dmap_mat.append(self.spectrum)
+        if key is not None:
+            self.cache.put(key, dmap_mat.dumps())
         return dmap_mat
     def exportDistanceMatrix(self, dtype="float64"):
+        self.requireSpectrum()
         return self.spectrum.getDistanceMatrix(dtype)
 
+def load_dict_array_data(h):
+    D = []
+    for idx in range(len(h)):
+        hh = h["%d" % idx]
+        d = { t: hh[t].value for t in hh }
+        D.append(d)
+    return D
+
+def load_descriptor_map_matrix(h):
+    D = soap.soapy.kernel.DescriptorMapMatrix()
+    for idx in range(len(h)):
+        d = soap.soapy.kernel.DescriptorMap()
+        hh = h['%d' % idx]
+        for t in hh: d[t] = hh[t].value
+        D.append(d)
+    return D
+
+def load_spectrum_field(g, field):
+    """Reads one field of a spectrum stored via PowerSpectrum.save"""
+    if field == "spectrum":
+        spectrum = soap.Spectrum()
+        spectrum.loads(g["cxx_serial"].value.tostring())
+        return spectrum
+    elif field in [ "cmap", "gcmap" ]:
+        return load_dict_array_data(g[field])
+    elif field in [ "sdmap", "gsdmap" ]:
+        return load_descriptor_map_matrix(g[field])
+    elif field in [ "sd", "gsd" ]:
+        return g[field].value
+    raise KeyError(field)
+
+def lazy_spectrum_field(field):
+    def get(self):
+        if field not in self.loaded:
+            self.loaded[field] = load_spectrum_field(self.h5, field) \
+                if self.isStored(field) else None
+        return self.loaded[field]
+    def set(self, value):
+        self.__dict__.setdefault("loaded", {})[field] = value
+    return property(get, set)
+
+class LazyPowerSpectrum(PowerSpectrum):
+    """
+    PowerSpectrum proxy that keeps a handle to its HDF5 group (as written 
+    by PowerSpectrum.save), reading only the settings and label upfront, 
+    and the stored fields (spectrum, cmap, gcmap, sdmap, gsdmap, sd, gsd) 
+    on first access
+    """
+    spectrum = lazy_spectrum_field("spectrum")
+    cmap = lazy_spectrum_field("cmap")
+    gcmap = lazy_spectrum_field("gcmap")
+    sdmap = lazy_spectrum_field("sdmap")
+    gsdmap = lazy_spectrum_field("gsdmap")
+    sd = lazy_spectrum_field("sd")
+    gsd = lazy_spectrum_field("gsd")
+    def __init__(self, hdf5_handle):
+        PowerSpectrum.__init__(self)
+        self.loaded = {}
+        self.h5 = hdf5_handle
+        self.settings = dict(hdf5_handle.attrs)
+        self.label = hdf5_handle["class"].attrs["label"]
+        self.has_spectrum = self.isStored("spectrum")
+        return
+    def isStored(self, field):
+        key = "store_cxx_serial" if field == "spectrum" else "store_%s" % field
+        return bool(self.settings.get(key, False))
+    def isLoaded(self, field):
+        return field in self.loaded
+    def release(self):
+        self.loaded = {}
+        return
+
+class H5SpectrumSource(object):
+    """
+    Sequence view onto power spectra saved as subgroups of an HDF5 group, 
+    handing out LazyPowerSpectrum proxies; the n_cache most recently used 
+    ones are kept
+
+    Parameters
+    ----------
+    h5_file : file name
+    group : HDF5 group containing one subgroup per spectrum (sorted by name)
+    """
+    def __init__(self, h5_file, group='/', n_cache=256):
+        self.h5_file = h5_file
+        self.group = group
+        self.h5 = h5py.File(h5_file, 'r')
+        self.keys = sorted(self.h5[group].keys())
+        self.cache = ObjectLRU(n_cache)
+        return
+    def __len__(self):
+        return len(self.keys)
+    def __getitem__(self, idx):
+        spectrum = self.cache.get(idx)
+        if spectrum is None:
+            spectrum = LazyPowerSpectrum(self.h5[self.group][self.keys[idx]])
+            self.cache.put(idx, spectrum)
+        return spectrum
+    def __iter__(self):
+        for idx in range(len(self.keys)): yield self[idx]
+    def close(self):
+        self.cache.clear()
+        self.h5.close()
+        return
+
+class PowerSpectrumStore(object):
+    """
+    Collection-level HDF5 store for PowerSpectrum objects: the descriptor 
+    rows of all structures are concatenated into a few large chunked 
+    datasets, located via offset indices, rather than stored as one group 
+    per structure and one dataset per atom and type key. Structures are 
+    buffered and written in batches; reading back one structure is a slice.
+
+    Layout (per field, written if set on the appended spectra):
+        sd, gsd:      <field>/rows (n_rows x dim), <field>/offsets (n_structs+1)
+        cmap, gcmap,
+        sdmap, gsdmap: <field>/values (flat), <field>/value_offsets, <field>/keys,
+                      <field>/shapes (per key entry), <field>/atom_offsets 
+                      (per atom, into entries), <field>/offsets (per structure, 
+                      into atoms), key table in <field>.attrs["key_table"]
+
+    Parameters
+    ----------
+    mode : h5py file mode; 'a' appends to an existing store
+    dtype : storage type of real-valued descriptors (complex coefficients 
+        use the matching complex type); defaults to PowerSpectrum.settings, 
+        and is fixed by the first writer of a file
+    compression : h5py filter, e.g., 'lzf' (fast) or 'gzip'
+    """
+    matrix_fields = [ "sd", "gsd" ]
+    map_fields = [ "cmap", "gcmap", "sdmap", "gsdmap" ]
+    def __init__(self, h5_file, mode='a', dtype=None, batch_size=256, 
+            chunk_size=4096, compression='lzf'):
+        self.h5_file = h5_file
+        self.h5 = h5py.File(h5_file, mode)
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.compression = compression
+        if "dtype" in self.h5.attrs:
+            self.dtype = str(self.h5.attrs["dtype"])
+        else:
+            self.dtype = dtype if dtype is not None else PowerSpectrum.settings.get("dtype", "float64")
+            if mode != 'r': self.h5.attrs["dtype"] = self.dtype
+        self.complex_dtype = 'complex64' if np.dtype(self.dtype).itemsize <= 4 else 'complex128'
+        self.buffer = []
+        return
+    def __len__(self):
+        n_stored = self.h5["labels"].shape[0] if "labels" in self.h5 else 0
+        return n_stored + len(self.buffer)
+    def __getitem__(self, idx):
+        return self.load(idx)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+        return
+    def close(self):
+        if self.h5.mode != 'r': self.flush()
+        self.h5.close()
+        return
+    def append(self, spectrum):
+        spectrum.requireSpectrum()
+        self.buffer.append(spectrum)
+        if len(self.buffer) >= self.batch_size: self.flush()
+        return
+    def extend(self, spectra):
+        for spectrum in spectra: self.append(spectrum)
+        return
+    def appendDataset(self, name, data):
+        if name not in self.h5:
+            chunks = (self.chunk_size,) + data.shape[1:]
+            self.h5.create_dataset(name, data=data, maxshape=(None,)+data.shape[1:], 
+                chunks=chunks, compression=self.compression)
+        else:
+            ds = self.h5[name]
+            n = ds.shape[0]
+            ds.resize((n+data.shape[0],)+ds.shape[1:])
+            ds[n:n+data.shape[0]] = data
+        return
+    def appendOffsets(self, name, counts, n_skipped=0):
+        # n_skipped: entries stored before this index was created, which
+        # hence hold no rows (e.g., structures stored before a field appeared)
+        last = self.h5[name][-1] if name in self.h5 else 0
+        if name not in self.h5: self.appendDataset(name, np.zeros((1+n_skipped,), dtype='int64'))
+        self.appendDataset(name, last + np.cumsum(np.array(counts, dtype='int64')))
+        return
+    def flush(self):
+        if len(self.buffer) == 0: return
+        batch = self.buffer
+        self.buffer = []
+        labels = np.array([ str(s.label) for s in batch ], dtype=object)
+        if "labels" not in self.h5:
+            self.h5.create_dataset("labels", data=labels, maxshape=(None,), 
+                dtype=h5py.special_dtype(vlen=str))
+        else: self.appendDataset("labels", labels)
+        n_prev = self.h5["labels"].shape[0] - len(batch)
+        for field in self.matrix_fields:
+            rows = [ getattr(s, field) for s in batch ]
+            if field not in self.h5 and all(r is None for r in rows): continue
+            dim = self.h5[field+"/rows"].shape[1] if field in self.h5 else \
+                [ r for r in rows if r is not None ][0].shape[1]
+            rows = [ np.zeros((0, dim)) if r is None else np.atleast_2d(r) for r in rows ]
+            self.appendDataset(field+"/rows", np.concatenate(rows).astype(self.dtype))
+            self.appendOffsets(field+"/offsets", [ r.shape[0] for r in rows ], n_skipped=n_prev)
+        for field in self.map_fields:
+            maps = [ getattr(s, field) for s in batch ]
+            if field not in self.h5 and all(m is None for m in maps): continue
+            self.flushMaps(field, [ [] if m is None else m for m in maps ], n_prev)
+        self.h5.flush()
+        return
+    def flushMaps(self, field, maps, n_prev=0):
+        g = self.h5.require_group(field)
+        key_table = json.loads(g.attrs["key_table"]) if "key_table" in g.attrs else []
+        key_index = { k: i for i, k in enumerate(key_table) }
+        is_complex = field in [ "cmap", "gcmap" ]
+        values = []
+        keys = []
+        shapes = []
+        value_counts = []
+        atom_counts = []
+        struct_counts = []
+        for m in maps:
+            struct_counts.append(len(m))
+            for atom in m:
+                atom_keys = list(atom)
+                atom_counts.append(len(atom_keys))
+                for k in atom_keys:
+                    if k not in key_index:
+                        key_index[k] = len(key_table)
+                        key_table.append(k)
+                    x = np.asarray(atom[k])
+                    keys.append(key_index[k])
+                    shapes.append(x.shape if x.ndim == 2 else (x.shape[0], 0))
+                    values.append(x.flatten())
+                    value_counts.append(x.size)
+        dtype = self.complex_dtype if is_complex else self.dtype
+        values = np.concatenate(values).astype(dtype) if len(values) else np.zeros((0,), dtype=dtype)
+        self.appendDataset(field+"/values", values)
+        self.appendDataset(field+"/keys", np.array(keys, dtype='int32'))
+        self.appendDataset(field+"/shapes", np.array(shapes, dtype='int32').reshape((-1,2)))
+        self.appendOffsets(field+"/value_offsets", value_counts)
+        self.appendOffsets(field+"/atom_offsets", atom_counts)
+        self.appendOffsets(field+"/offsets", struct_counts, n_skipped=n_prev)
+        g.attrs["key_table"] = json.dumps(key_table)
+        return
+    def loadField(self, idx, field):
+        if len(self.buffer): self.flush()
+        if field not in self.h5: return None
+        g = self.h5[field]
+        i0, i1 = g["offsets"][idx:idx+2]
+        if field in self.matrix_fields:
+            return g["rows"][i0:i1]
+        atom_offsets = g["atom_offsets"][i0:i1+1]
+        e0, e1 = atom_offsets[0], atom_offsets[-1]
+        keys = g["keys"][e0:e1]
+        shapes = g["shapes"][e0:e1]
+        value_offsets = g["value_offsets"][e0:e1+1]
+        values = g["values"][value_offsets[0]:value_offsets[-1]]
+        value_offsets = value_offsets - value_offsets[0]
+        key_table = json.loads(g.attrs["key_table"])
+        is_dmap = field in [ "sdmap", "gsdmap" ]
+        D = soap.soapy.kernel.DescriptorMapMatrix() if is_dmap else []
+        for a in range(i1-i0):
+            d = soap.soapy.kernel.DescriptorMap() if is_dmap else {}
+            for e in range(atom_offsets[a]-e0, atom_offsets[a+1]-e0):
+                x = values[value_offsets[e]:value_offsets[e+1]]
+                if shapes[e][1] > 0: x = x.reshape(tuple(shapes[e]))
+                d[key_table[keys[e]]] = x
+            D.append(d)
+        return D
+    def load(self, idx):
+        if len(self.buffer): self.flush()
+        spectrum = PowerSpectrum()
+        spectrum.label = self.h5["labels"][idx]
+        for field in self.matrix_fields + self.map_fields:
+            setattr(spectrum, field, self.loadField(idx, field))
+        return spectrum
@@ -5,6 +5,7 @@
 
 #include "soap/spectrum.hpp"
 #include "soap/linalg/numpy.hpp"
+#include "soap/base/exceptions.hpp"
 
 namespace soap {
 
@@ -117,6 +118,125 @@ boost::python::object Spectrum::getDistanceMatrixNumpy(std::string np_dtype) {
     return npc.ublas_to_numpy<Structure::dtype_t>(out);
 }
 
+int Spectrum::adaptDimension(std::vector<std::string> &types, std::string layout) {
+    int N = _basis->N();
+    int L = _basis->L();
+    int S = types.size();
+    int dim_ab = N*N*(L+1);
+    if (layout == "full") return S*S*dim_ab;
+    else if (layout == "unique") return S*(N*N+N)/2*(L+1) + (S*S-S)/2*dim_ab;
+    else if (layout == "specific") return (S*S+S)/2*dim_ab;
+    else if (layout == "generic") return dim_ab;
+    throw soap::base::APIError("Unknown adaptor layout '"+layout+"'");
+}
+
+int Spectrum::adaptDimensionPython(boost::python::list &py_types, std::string layout) {
+    std::vector<std::string> types;
+    for (int i=0; i<boost::python::len(py_types); ++i)
+        types.push_back(boost::python::extract<std::string>(py_types[i]));
+    return this->adaptDimension(types, layout);
+}
+
+static void adapt_block(AtomicSpectrum *atomic, std::string a, std::string b, 
+        bool reduce_nk, double *x) {
+    // Copies Re(xnkl) of type pair (a,b) to x, with n<=k only if reduce_nk
+    AtomicSpectrum::map_xnkl_t &map_xnkl = atomic->getXnklMap();
+    auto it = map_xnkl.find(AtomicSpectrum::type_pair_t(a, b));
+    if (it == map_xnkl.end()) return;
+    PowerExpansion::coeff_t &c = it->second->getCoefficients();
+    int N = it->second->getBasis()->N();
+    int L1 = c.size2();
+    int off = 0;
+    for (int n=0; n<N; ++n) {
+        for (int k=(reduce_nk) ? n : 0; k<N; ++k) {
+            for (int l=0; l<L1; ++l) x[off+l] = c(n*N+k, l).real();
+            off += L1;
+        }
+    }
+}
+
+void Spectrum::adapt(std::vector<std::string> &types, std::string layout, bool global, 
+        bool normalize, double *X, int n_rows, int dim) {
+    int N = _basis->N();
+    int L = _basis->L();
+    int S = types.size();
+    int dim_ab = N*N*(L+1);
+    int dim_aa = (N*N+N)/2*(L+1);
+    for (int r=0; r<n_rows; ++r) {
+        AtomicSpectrum *atomic = (global) ? this->getGlobal() : _atomspec_array[r];
+        double *x = X + long(r)*dim;
+        for (int d=0; d<dim; ++d) x[d] = 0.0;
+        if (layout == "full") {
+            for (int sa=0; sa<S; ++sa)
+                for (int sb=0; sb<S; ++sb)
+                    adapt_block(atomic, types[sa], types[sb], false, x+(sa*S+sb)*dim_ab);
+        } else if (layout == "unique") {
+            for (int sa=0; sa<S; ++sa) {
+                adapt_block(atomic, types[sa], types[sa], true, x+sa*dim_aa);
+                for (int sb=sa+1; sb<S; ++sb) {
+                    // Stored under the lexically ordered pair, as getTypes is sorted
+                    std::string a = std::min(types[sa], types[sb]);
+                    std::string b = std::max(types[sa], types[sb]);
+                    int sab = sa*S - (sa*sa+sa)/2 + sb-sa-1;
+                    adapt_block(atomic, a, b, false, x+S*dim_aa+sab*dim_ab);
+                }
+            }
+        } else if (layout == "specific") {
+            for (int sa=0; sa<S; ++sa) {
+                for (int sb=sa; sb<S; ++sb) {
+                    int sab = S*sa - (sa*sa-sa)/2 + (sb-sa);
+                    adapt_block(atomic, types[sa], types[sb], false, x+sab*dim_ab);
+                }
+            }
+        } else if (layout == "generic") {
+            PowerExpansion *generic = atomic->getPower("", "");
+            if (!generic) throw soap::base::APIError(
+                "Adaptor layout 'generic' requires the generic power spectrum (type pair '':''), "
+                "which has not been computed");
+            PowerExpansion::coeff_t &c = generic->getCoefficients();
+            if (int(c.size1()*c.size2()) != dim) throw soap::base::APIError(
+                "Generic power spectrum inconsistent with adaptor dimension");
+            for (int i=0; i<c.size1(); ++i)
+                for (int l=0; l<c.size2(); ++l)
+                    x[i*c.size2()+l] = c(i,l).real();
+        } else throw soap::base::APIError("Unknown adaptor layout '"+layout+"'");
+        if (normalize) {
+            double norm = 0.0;
+            for (int d=0; d<dim; ++d) norm += x[d]*x[d];
+            norm = std::sqrt(norm);
+            if (norm < 1e-20) norm = 1.;
+            for (int d=0; d<dim; ++d) x[d] /= norm;
+        }
+    }
+}
+
+void Spectrum::adaptNumpy(boost::python::object &np_X, boost::python::list &py_types, 
+        std::string layout, bool global, bool normalize) {
+    std::vector<std::string> types;
+    for (int i=0; i<boost::python::len(py_types); ++i)
+        types.push_back(boost::python::extract<std::string>(py_types[i]));
+    if (global && !_global_atomic) 
+        throw soap::base::APIError("Global adaptor requires computeGlobal to be called first");
+    int n_rows = (global) ? 1 : _atomspec_array.size();
+    int dim = this->adaptDimension(types, layout);
+    Py_buffer view;
+    if (PyObject_GetBuffer(np_X.ptr(), &view, 
+            PyBUF_C_CONTIGUOUS | PyBUF_WRITABLE | PyBUF_FORMAT) != 0)
+        boost::python::throw_error_already_set();
+    std::string format = (view.format) ? view.format : "B";
+    bool valid = (view.ndim == 2 && view.itemsize == sizeof(double) 
+        && format[format.size()-1] == 'd'
+        && view.shape[0] == n_rows && view.shape[1] == dim);
+    if (!valid) {
+        PyBuffer_Release(&view);
+        throw soap::base::APIError("Adaptor output must be a C-contiguous float64 array of shape ("
+            + boost::lexical_cast<std::string>(n_rows) + ", " 
+            + boost::lexical_cast<std::string>(dim) + ")");
+    }
+    this->adapt(types, layout, global, normalize, static_cast<double*>(view.buf), n_rows, dim);
+    PyBuffer_Release(&view);
+}
+
 void Spectrum::getDistanceMatrix(Structure::laplace_t &out) {
     assert(out.size1() == _atomspec_array.size() && out.size2() == _atomspec_array.size() && 
         "Output dimensions inconsistent with spectrum");
@@ -458,6 +578,8 @@ void Spectrum::registerPython() {
 		.def("getGlobal", &Spectrum::getGlobal, 
             return_value_policy<reference_existing_object>())
         .def("getDistanceMatrix", &Spectrum::getDistanceMatrixNumpy)
+        .def("adaptDimension", &Spectrum::adaptDimensionPython)
+        .def("adapt", &Spectrum::adaptNumpy)
 	    .def("saveAndClean", &Spectrum::saveAndClean)
 		.def("save", &Spectrum::save)
 		.def("load", &Spectrum::load)
@@ -70,6 +70,20 @@ class Spectrum
     boost::python::object getDistanceMatrixNumpy(std::string np_dtype);
     void getDistanceMatrix(Structure::laplace_t &out);
 
+    // Feature matrix of all centres (or of the global spectrum), one row per 
+    // centre, written into a preallocated C-contiguous float64 array. Layouts 
+    // follow the python kernel adaptors:
+    //   "full":     all ordered type pairs (a,b), N*N*(L+1) each
+    //   "unique":   pairs a=b with n<=k, then a<b, duplicates removed
+    //   "specific": pairs a<=b (by position in types), N*N*(L+1) each
+    //   "generic":  type-agnostic power spectrum, N*N*(L+1)
+    int adaptDimension(std::vector<std::string> &types, std::string layout);
+    int adaptDimensionPython(boost::python::list &types, std::string layout);
+    void adapt(std::vector<std::string> &types, std::string layout, bool global, 
+        bool normalize, double *X, int n_rows, int dim);
+    void adaptNumpy(boost::python::object &np_X, boost::python::list &types, 
+        std::string layout, bool global, bool normalize);
+
 	void writeDensityOnGrid(int slot_idx, std::string center_type, std::string density_type);
     void writeDensityCubeFile(int atom_idx, std::string density_type, std::string filename, bool from_expansion);
 	void writeDensityOnGridInverse(int slot_idx, std::string center_type, std::string type1, std::string type2);